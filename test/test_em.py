@@ -9,8 +9,46 @@ import pylab as plt
 from tractor.psfex import *
 from tractor import *
 
-from ngmix.em import *
-#from ngmix.observation import *
+def test_fit_stamps_batch():
+    r = np.arange(-10, 11)
+    r2 = r[:,np.newaxis]**2 + r[np.newaxis,:]**2
+    stamps = [0.7 * np.exp(-0.5 * r2 / s**2) / s**2 +
+              0.3 * np.exp(-0.5 * r2 / (2.5*s)**2) / (2.5*s)**2
+              for s in [1.5, 1.6, 1.7, 1.8]]
+    P0 = (np.array([0.6, 0.4]), np.zeros((2,2)),
+          np.array([np.eye(2), 4. * np.eye(2)]))
+    # No tolerance & no warm start: same as fitting one at a time
+    fits,iters,conv = GaussianMixturePSF.fromStamps(
+        stamps, P0=P0, emsteps=50, tol=0., warmstart=False)
+    assert(np.all(iters == 50))
+    assert(not np.any(conv))
+    for stamp,fit in zip(stamps, fits):
+        P = [a.copy() for a in P0]
+        one = GaussianMixturePSF.fromStamp(stamp, P0=P, emsteps=50)
+        assert(np.allclose(one.getAllParams(), fit.getAllParams()))
+    # Warm-started, stopping at convergence
+    fits,iters,conv = GaussianMixturePSF.fromStamps(stamps, P0=P0, tol=1e-8)
+    assert(np.all(conv))
+    assert(np.all(iters < 1000))
+    cold = GaussianMixturePSF.fromStamps(stamps, P0=P0, tol=1e-8,
+                                         warmstart=False)[1]
+    assert(iters[1:].sum() < cold[1:].sum())
+    for stamp,fit in zip(stamps, fits):
+        P = [a.copy() for a in P0]
+        one = GaussianMixturePSF.fromStamp(stamp, P0=P)
+        assert(np.allclose(one.getAllParams(), fit.getAllParams(), atol=1e-5))
+
+def test_fit_stamps_refcount():
+    import sys, gc
+    stamps = [np.ones((5,5))]
+    GaussianMixturePSF.fromStamps(stamps, N=1, emsteps=3)
+    gc.collect()
+    r0 = sys.getrefcount(np.dtype(float)), sys.getrefcount(np.dtype(np.intc))
+    for i in range(100):
+        GaussianMixturePSF.fromStamps(stamps, N=1, emsteps=3)
+    gc.collect()
+    r1 = sys.getrefcount(np.dtype(float)), sys.getrefcount(np.dtype(np.intc))
+    assert(r0 == r1)
 
 def plot_result(gpsf, psfimg):
     psfimg2 = np.maximum(psfimg, 0)
@@ -72,6 +110,12 @@ def plot_result(gpsf, psfimg):
     
 
 if __name__ == '__main__':
+    from ngmix.em import *
+    #from ngmix.observation import *
+
+    test_fit_stamps_batch()
+    test_fit_stamps_refcount()
+
     ps = PlotSequence('test-em')
 
     truepsf = GaussianMixturePSF(np.array([1.]),
@@ -0,0 +1,133 @@
+import numpy as np
+
+from tractor import *
+from tractor.galaxy import *
+
+def galaxy_image(H, W, psf=None):
+    if psf is None:
+        psf = NCircularGaussianPSF([1.5], [1.0])
+    return Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf,
+                 wcs=NullWCS(), sky=ConstantSky(0.),
+                 photocal=LinearPhotoCal(1.))
+
+def test_phase_cache():
+    tim = galaxy_image(60, 70)
+    gal = ExpGalaxy(PixPos(30.23, 25.61), Flux(100.),
+                    GalaxyShape(3., 0.6, 30.))
+    exact = gal.getUnitFluxModelPatch(tim)
+    cache = get_galaxy_cache()
+    try:
+        for shift in ['linear', 'fft']:
+            set_galaxy_cache_phase(0.1, shift=shift)
+            p = gal.getUnitFluxModelPatch(tim)
+            m0 = np.zeros(tim.shape)
+            m1 = np.zeros(tim.shape)
+            exact.addTo(m0)
+            p.addTo(m1)
+            assert(np.abs(m0 - m1).max() < 1e-3 * m0.max())
+            # an integer move is a cache hit
+            hits = cache.hits
+            gal.pos.x += 1.
+            p2 = gal.getUnitFluxModelPatch(tim)
+            gal.pos.x -= 1.
+            assert(cache.hits == hits + 1)
+            assert(p2.x0 == p.x0 + 1)
+            assert(np.allclose(p2.patch, p.patch))
+    finally:
+        set_galaxy_cache_phase(None)
+
+def test_analytic_derivs():
+    from tractor.ellipses import EllipseESoft
+    tim = galaxy_image(50, 60)
+    tim.modelMinval = 0.
+    for shape in [GalaxyShape(3., 0.6, 30.),
+                  EllipseESoft(0.8, 0.2, -0.3)]:
+        gal = ExpGalaxy(PixPos(30.3, 24.6), Flux(100.), shape)
+        derivs = gal.getParamDerivatives(tim)
+        p0 = np.array(gal.getParams())
+        for i,deriv in enumerate(derivs):
+            h = 1e-5
+            mods = []
+            for sign in [1, -1]:
+                p = p0.copy()
+                p[i] += sign * h
+                gal.setParams(p)
+                mod = np.zeros(tim.shape)
+                gal.getModelPatch(tim).addTo(mod)
+                mods.append(mod)
+            gal.setParams(p0)
+            dn = (mods[0] - mods[1]) / (2. * h)
+            d = np.zeros(tim.shape)
+            deriv.addTo(d)
+            assert(np.abs(d - dn).max() < 1e-5 * np.abs(dn).max())
+
+def test_mixture_pruning():
+    tim = galaxy_image(60, 70,
+                       psf=GaussianMixturePSF(np.array([0.8, 0.15, 0.05]),
+                                              np.zeros((3,2)),
+                                              np.array([[[1.5,0.],[0.,1.5]],
+                                                        [[4.,0.],[0.,4.]],
+                                                        [[20.,0.],[0.,20.]]])))
+    gal = ExpGalaxy(PixPos(30.23, 25.61), Flux(100.),
+                    GalaxyShape(3., 0.6, 30.))
+    m0 = np.zeros(tim.shape)
+    gal.getUnitFluxModelPatch(tim, minval=1e-6).addTo(m0)
+    try:
+        set_galaxy_mixture_pruning(1e-3)
+        m1 = np.zeros(tim.shape)
+        gal.getUnitFluxModelPatch(tim, minval=1e-6).addTo(m1)
+        st = get_galaxy_mixture_pruning_stats()
+        assert(st['renders'] == 1)
+        assert(st['components_in'] == 18)
+        assert(st['components_out'] < 10)
+        assert(np.abs(m1 - m0).max() < 1e-2 * m0.max())
+        assert(abs(m0.sum() - m1.sum() - st['fluxerr_total']) < 1e-3)
+    finally:
+        set_galaxy_mixture_pruning(None)
+
+def test_multires():
+    tim = galaxy_image(150, 160)
+    gal = DevGalaxy(PixPos(60.3, 75.6), Flux(100.),
+                    GalaxyShape(20., 0.7, 30.))
+    for minval in [0., 1e-7]:
+        m0 = np.zeros(tim.shape)
+        gal.getUnitFluxModelPatch(tim, minval=minval).addTo(m0)
+        try:
+            set_galaxy_multires(1e-3)
+            m1 = np.zeros(tim.shape)
+            gal.getUnitFluxModelPatch(tim, minval=minval).addTo(m1)
+        finally:
+            set_galaxy_multires(None)
+        assert(np.abs(m1 - m0).max() < 1e-3 * m0.max())
+
+def test_fft_prefetch():
+    x = np.arange(-7, 8)
+    psfimg = np.exp(-0.5 * (x[:,np.newaxis]**2 + x[np.newaxis,:]**2) / 2.)
+    tim = galaxy_image(60, 70, psf=PixelizedPSF(psfimg / psfimg.sum()))
+    srcs = [ExpGalaxy(PixPos(x, y), Flux(100.), GalaxyShape(re, 0.6, 30.))
+            for x,y,re in [(10.3, 12.6, 1.), (40.7, 30.2, 2.),
+                           (65.1, 50.5, 1.5), (-50., 20., 1.)]]
+    tractor = Tractor([tim], srcs)
+    minvals = [1e-4] * len(srcs)
+    cache = get_galaxy_cache()
+    cache.clear()
+    ref = [src.getUnitFluxModelPatch(tim, minval=mv)
+           for src,mv in zip(srcs, minvals)]
+    cache.clear()
+    tractor._prefetchUnitFluxModelPatches(tim, srcs, minvals)
+    hits = cache.hits
+    for src,mv,p in zip(srcs, minvals, ref):
+        p2 = src.getUnitFluxModelPatch(tim, minval=mv)
+        if p is None:
+            assert(p2 is None)
+            continue
+        assert(p.getExtent() == p2.getExtent())
+        assert(np.allclose(p.patch, p2.patch))
+    assert(cache.hits == hits + len(srcs))
+
+if __name__ == '__main__':
+    test_phase_cache()
+    test_analytic_derivs()
+    test_mixture_pruning()
+    test_multires()
+    test_fft_prefetch()
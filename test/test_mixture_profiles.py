@@ -0,0 +1,41 @@
+import numpy as np
+
+from tractor import mixture_profiles as mp
+from tractor import *
+
+def test_mixture_vectorized():
+    T = np.array([[3., 1.], [0.5, 2.]])
+    amix = mp.get_exp_mixture().apply_affine(np.array([30., 33.]), T)
+    for k in range(amix.K):
+        assert(np.allclose(amix.var[k],
+                           np.dot(T.T, np.dot(mp.get_exp_mixture().var[k], T))))
+    psf = mp.MixtureOfGaussians(np.array([0.7, 0.3]),
+                                np.array([[0.1, -0.2], [0., 0.3]]),
+                                np.array([[[2., 0.3], [0.3, 1.]],
+                                          [[5., 0.], [0., 6.]]]))
+    cmix = amix.convolve(psf)
+    assert(cmix.K == 2 * amix.K)
+    k = amix.K + 3
+    assert(cmix.amp[k] == amix.amp[3] * psf.amp[1])
+    assert(np.all(cmix.mean[k] == amix.mean[3] + psf.mean[1]))
+    assert(np.all(cmix.var[k] == amix.var[3] + psf.var[1]))
+    for k in range(cmix.K):
+        assert(np.allclose(cmix.ivar[k], np.linalg.inv(cmix.var[k])))
+    # FFT of the rendered mixture matches the analytic transform
+    H,W = 64, 64
+    img = cmix.evaluate_grid(0, W, 0, H, 0., 0.).patch
+    w = np.fft.rfftfreq(W)
+    v = np.fft.fftfreq(H)
+    F = cmix.getFourierTransform(w, v, use_mp_fourier=False)
+    assert(np.abs(F - np.fft.rfft2(img)).max() < 1e-3)
+    # in-place changes to a PSF's mixture refresh the inverses
+    gpsf = GaussianMixturePSF(psf.amp, psf.mean, psf.var)
+    gpsf.getMixtureOfGaussians().ivar
+    p = gpsf.getParams()
+    p[-3] *= 2.
+    gpsf.setParams(p)
+    mog = gpsf.getMixtureOfGaussians()
+    assert(np.allclose(mog.ivar[1], np.linalg.inv(mog.var[1])))
+
+if __name__ == '__main__':
+    test_mixture_vectorized()
@@ -0,0 +1,359 @@
+import unittest
+
+import numpy as np
+
+from tractor import *
+from tractor.engine import CscBuilder
+
+def make_tractor(nimages=2, H=30, W=40):
+    psf = NCircularGaussianPSF([1.5], [1.0])
+    tims = []
+    for i in range(nimages):
+        tims.append(Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 4.,
+                          psf=psf, wcs=NullWCS(), sky=ConstantSky(0.),
+                          photocal=LinearPhotoCal(1.)))
+    srcs = [PointSource(PixPos(10., 12.), Flux(100.)),
+            PointSource(PixPos(28., 17.), Flux(200.))]
+    tractor = Tractor(tims, srcs)
+    np.random.seed(42)
+    for tim in tims:
+        mod = tractor.getModelImage(tim)
+        tim.data = mod + np.random.normal(size=mod.shape) * 0.5
+    tractor.freezeParam('images')
+    p = np.array(tractor.getParams())
+    tractor.setParams(p + np.array([0.1, -0.1, 5., -0.2, 0.1, -5.]))
+    return tractor
+
+class OptimizeTest(unittest.TestCase):
+
+    def test_csc_builder(self):
+        B = CscBuilder(10, 4, nnz=2)
+        B.append(0, [1, 3], [1., 2.])
+        B.append(0, [7], [3.])
+        B.append(2, [0, 9], [4., 5.])
+        rows,vals = B.getColumn(2)
+        vals *= 2.
+        B.append(3, [4, 5], [6., 7.])
+        B.setColumn(3, [5], [8.])
+        A = B.getMatrix().toarray()
+        D = np.zeros((10,4))
+        D[[1,3,7],0] = [1.,2.,3.]
+        D[[0,9],2] = [8.,10.]
+        D[5,3] = 8.
+        self.assertTrue(np.all(A == D))
+        self.assertEqual(list(B.getNnzPerColumn()), [3, 0, 2, 1])
+
+    def test_update_direction(self):
+        tractor = make_tractor()
+        allderivs = tractor.getDerivs()
+        A = tractor.getUpdateDirection(allderivs, get_A_matrix=True,
+                                       scale_columns=False)
+        self.assertEqual(A.shape[1], tractor.numberOfParams())
+        X = tractor.getUpdateDirection(allderivs)
+        self.assertEqual(len(X), tractor.numberOfParams())
+        lnp0 = tractor.getLogProb()
+        dlnp,X,alpha = tractor.optimize()
+        self.assertGreater(dlnp, 0.)
+        self.assertGreater(tractor.getLogProb(), lnp0)
+
+    def test_matrix_free(self):
+        tractor = make_tractor()
+        tractor.catalog[0].pos.addGaussianPrior('x', 10., 0.1)
+        X0,V0 = tractor.getUpdateDirection(tractor.getDerivs(), variance=True)
+        X1,V1 = tractor.getUpdateDirection(tractor.getDerivs(), variance=True,
+                                           matrix_free=True, matvec_threads=2)
+        self.assertTrue(np.allclose(X0, X1, rtol=1e-4))
+        self.assertTrue(np.allclose(V0, V1, rtol=1e-2))
+        X2 = tractor.getUpdateDirection(tractor.getDerivs(), matrix_free=True,
+                                        use_lsmr=True)
+        self.assertTrue(np.allclose(X0, X2, rtol=1e-2))
+        # the thread pool is shared, not leaked per Jacobian
+        import threading
+        nthreads = threading.active_count()
+        for i in range(3):
+            tractor.getUpdateDirection(tractor.getDerivs(), matrix_free=True,
+                                       matvec_threads=2)
+        self.assertEqual(threading.active_count(), nthreads)
+        # a derivative patch that lies off the image clips to nothing
+        allderivs = tractor.getDerivs()
+        allderivs[0].append((Patch(-100, 0, np.ones((5,5))),
+                             tractor.getImage(0)))
+        X3 = tractor.getUpdateDirection(allderivs)
+        self.assertTrue(np.allclose(X0, X3))
+        allderivs = tractor.getDerivs()
+        allderivs[0].append((Patch(-100, 0, np.ones((5,5))),
+                             tractor.getImage(0)))
+        X4 = tractor.getUpdateDirection(allderivs, matrix_free=True)
+        self.assertTrue(np.allclose(X0, X4, rtol=1e-4))
+
+    def test_normal_equations(self):
+        tractor = make_tractor()
+        A = tractor.getUpdateDirection(tractor.getDerivs(), get_A_matrix=True,
+                                       scale_columns=False).toarray()
+        C = np.linalg.inv(np.dot(A.T, A))
+        X0 = tractor.getUpdateDirection(tractor.getDerivs())
+        for dense in [True, False]:
+            if not dense:
+                tractor.normal_dense_max = 0
+            X1,cov = tractor.getUpdateDirection(
+                tractor.getDerivs(), scale_columns=False,
+                use_normal_equations=True, covariance=True)
+            self.assertTrue(np.allclose(X0, X1, rtol=1e-4))
+            self.assertTrue(np.allclose(C, cov))
+        # a derivative patch that lies off the image clips to nothing
+        allderivs = tractor.getDerivs()
+        allderivs[0].append((Patch(-100, 0, np.ones((5,5))),
+                             tractor.getImage(0)))
+        X2 = tractor.getUpdateDirection(allderivs, scale_columns=False,
+                                        use_normal_equations=True)
+        self.assertTrue(np.allclose(X0, X2, rtol=1e-4))
+        # a duplicated source makes the (sparse) system singular
+        tractor.catalog.append(tractor.catalog[0].copy())
+        X0 = tractor.getUpdateDirection(tractor.getDerivs(),
+                                        scale_columns=False)
+        X1 = tractor.getUpdateDirection(tractor.getDerivs(),
+                                        scale_columns=False,
+                                        use_normal_equations=True)
+        self.assertTrue(np.allclose(X0, X1, rtol=1e-4))
+
+    def test_blocks(self):
+        tractor = make_tractor()
+        X0 = tractor.getUpdateDirection(tractor.getDerivs())
+        X1,blocks = tractor.getUpdateDirection(tractor.getDerivs(),
+                                               blocks=True)
+        # the two sources do not overlap
+        self.assertEqual(list(blocks), [0, 0, 0, 1, 1, 1])
+        self.assertTrue(np.allclose(X0, X1, rtol=1e-4))
+        lnp0 = tractor.getLogProb()
+        dlnp,X,alpha = tractor.optimize(blocks=True)
+        self.assertEqual(len(alpha), tractor.numberOfParams())
+        self.assertGreater(dlnp, 0.)
+        self.assertTrue(np.allclose(tractor.getLogProb(), lnp0 + dlnp))
+        # with no derivatives to label the pixels, the blocks see only
+        # the prior, so the block search fails and falls back to a
+        # single step size -- still returned per parameter.
+        tractor = make_tractor()
+        tractor.catalog[0].pos.addGaussianPrior('x', 25., 10.)
+        n = tractor.numberOfParams()
+        X = np.zeros(n)
+        X[0] = 5.
+        dlnp,alpha = tractor.tryBlockUpdates(X, [0, 0, 0, 1, 1, 1],
+                                             [[] for i in range(n)])
+        self.assertEqual(len(alpha), n)
+
+    def test_incremental(self):
+        tractor = make_tractor()
+        tractor.enable_incremental()
+        def check():
+            mod = tractor.getModelImage(0)
+            tractor.incremental = False
+            self.assertTrue(np.allclose(mod, tractor.getModelImage(0),
+                                        atol=1e-5))
+            tractor.incremental = True
+        check()
+        v0 = tractor.catalog[0].getVersion()
+        v1 = tractor.catalog[1].getVersion()
+        p = np.array(tractor.getParams())
+        p[3] += 0.1
+        tractor.setParams(p)
+        self.assertEqual(tractor.catalog[0].getVersion(), v0)
+        self.assertNotEqual(tractor.catalog[1].getVersion(), v1)
+        check()
+        tractor.catalog[0].pos.x = 11.
+        check()
+        tractor.addSource(PointSource(PixPos(20., 20.), Flux(30.)))
+        check()
+        tractor.removeSource(tractor.catalog[0])
+        check()
+        tractor.images[0].sky.setParams([1.])
+        check()
+
+    def test_roi_likelihood(self):
+        tractor = make_tractor(H=100, W=120)
+        tractor.catalog.freezeParam(0)
+        lnl0 = tractor.getLogLikelihood()
+        tractor.enable_roi_likelihood()
+        self.assertTrue(np.allclose(lnl0, tractor.getLogLikelihood()))
+        p = np.array(tractor.getParams())
+        # the last step moves the source outside the cached ROI
+        for dx in [0.3, 5., 30.]:
+            tractor.setParams(p + np.array([dx, 0., 0.]))
+            lnl = tractor.getLogLikelihood()
+            tractor.roi_likelihood = False
+            self.assertTrue(np.allclose(lnl, tractor.getLogLikelihood()))
+            tractor.roi_likelihood = True
+        # changing a frozen source invalidates the cache
+        tractor.catalog[0].pos.x = 50.
+        lnl = tractor.getLogLikelihood()
+        tractor.roi_likelihood = False
+        self.assertTrue(np.allclose(lnl, tractor.getLogLikelihood()))
+
+    def test_parallel_linesearch(self):
+        from astrometry.util.multiproc import multiproc
+        tractor = make_tractor()
+        X = tractor.getUpdateDirection(tractor.getDerivs())
+        dlnp0,alpha0 = tractor.tryUpdates(X)
+        p0 = tractor.getParams()
+        tractor = make_tractor()
+        tractor.mp = multiproc(2)
+        dlnp1,alpha1 = tractor.tryUpdates(X, parallel=True)
+        self.assertEqual(alpha0, alpha1)
+        self.assertTrue(np.allclose(dlnp0, dlnp1))
+        self.assertTrue(np.allclose(p0, tractor.getParams()))
+        # a search that stops part-way through a worker's run
+        alphas = [1., 8., 0.5, 0.25, 4., 0.125]
+        tractor = make_tractor()
+        dlnp0,alpha0 = tractor.tryUpdates(X, alphas=alphas)
+        tractor = make_tractor()
+        tractor.mp = multiproc(2)
+        dlnp1,alpha1 = tractor.tryUpdates(X, alphas=alphas, parallel=True)
+        self.assertEqual(alpha0, alpha1)
+        self.assertTrue(np.allclose(dlnp0, dlnp1))
+        # without a pool, the search is serial
+        tractor = make_tractor()
+        dlnp2,alpha2 = tractor.tryUpdates(X, parallel=True)
+        self.assertEqual(alpha0, alpha2)
+        self.assertTrue(np.allclose(dlnp0, dlnp2))
+
+    def test_optimize_loop(self):
+        tractor = make_tractor()
+        for i in range(20):
+            dlnp,X,alpha = tractor.optimize()
+            if dlnp < 1e-3:
+                break
+        lnp1 = tractor.getLogProb()
+        tractor = make_tractor()
+        lnp0 = tractor.getLogProb()
+        R = tractor.optimize_loop(dchisq=1e-3)
+        self.assertEqual(R['reason'], 'dlnp')
+        self.assertEqual(len(R['timings']), R['steps'])
+        self.assertTrue(np.allclose(R['dlnp'], tractor.getLogProb() - lnp0))
+        self.assertTrue(np.allclose(tractor.getLogProb(), lnp1, atol=1e-2))
+        R = tractor.optimize_loop(steps=2, dlnp_rel=1e-3)
+        self.assertLessEqual(R['steps'], 2)
+
+    def test_linear_fluxes(self):
+        tractor = make_tractor()
+        names = tractor.getParamNames()
+        tractor.solveLinearFluxes()
+        self.assertEqual(tractor.getParamNames(), names)
+        # the fluxes are now optimal for the current positions
+        for src in tractor.catalog:
+            src.freezeParam('pos')
+        dlnp,X,alpha = tractor.optimize()
+        self.assertLess(dlnp, 1e-3)
+        for src in tractor.catalog:
+            src.thawParam('pos')
+        lnp0 = tractor.getLogProb()
+        dlnp,X,alpha = tractor.optimize(linear_fluxes=True)
+        self.assertEqual(tractor.getParamNames(), names)
+        self.assertGreater(dlnp, 0.)
+        self.assertTrue(np.allclose(tractor.getLogProb(), lnp0 + dlnp))
+
+    def test_linear_fluxes_nonlinear_photocal(self):
+        # Not linear: falls back to an ordinary step
+        trs = [make_tractor() for i in range(2)]
+        for tractor in trs:
+            for tim in tractor.images:
+                tim.photocal = NullPhotoCal()
+        p0 = trs[0].getParams()
+        self.assertFalse(trs[0].solveLinearFluxes())
+        self.assertEqual(trs[0].getParams(), p0)
+        r0 = trs[0].optimize(linear_fluxes=True)
+        r1 = trs[1].optimize()
+        self.assertGreater(r0[0], 0.)
+        self.assertTrue(np.allclose(r0[0], r1[0]))
+        self.assertTrue(np.allclose(trs[0].getParams(), trs[1].getParams()))
+
+    def test_gradient(self):
+        tractor = make_tractor()
+        tractor.catalog[0].pos.addGaussianPrior('x', 10., 0.1)
+        for src in tractor.catalog:
+            src.pos.setStepSizes([1e-4, 1e-4])
+        lnp,g = tractor.getLogProbGradient()
+        self.assertTrue(np.allclose(lnp, tractor.getLogProb()))
+        p0 = np.array(tractor.getParams())
+        steps = np.array([1e-3, 1e-3, 0.1] * 2)
+        gn = np.zeros(len(p0))
+        for i,step in enumerate(steps):
+            dp = np.zeros(len(p0))
+            dp[i] = step
+            tractor.setParams(p0 + dp)
+            lnp1 = tractor.getLogProb()
+            tractor.setParams(p0 - dp)
+            lnp2 = tractor.getLogProb()
+            gn[i] = (lnp1 - lnp2) / (2. * step)
+        tractor.setParams(p0)
+        self.assertTrue(np.allclose(g, gn, rtol=1e-2))
+        lnp0 = tractor.getLogProb()
+        tractor.optimize_lbfgsb()
+        self.assertGreater(tractor.getLogProb(), lnp0)
+
+    def test_shared_param_map(self):
+        tractor = make_tractor()
+        tractor.thawParam('images')
+        tractor.images.freezeParamsRecursive('photocal', 'wcs')
+        # both images share one PSF object
+        I,n = tractor.getSharedParamMap()
+        self.assertEqual(len(I), tractor.numberOfParams())
+        self.assertEqual(n, len(I) - 2)
+        self.assertEqual(list(I[:2]), list(I[3:5]))
+        v = tractor.getVersion()
+        I2,n2 = tractor.getSharedParamMap()
+        self.assertTrue(I2 is I)
+        # computing the cached map does not touch any parameters
+        self.assertEqual(tractor.getVersion(), v)
+        tractor.freezeParam('images')
+        I,n = tractor.getSharedParamMap()
+        self.assertEqual(list(I), range(6))
+
+    def test_hashkey_memo(self):
+        tractor = make_tractor()
+        tim = tractor.images[0]
+        src = tractor.catalog[0]
+        k = src.pos.hashkey()
+        self.assertTrue(src.pos.hashkey() is k)
+        k = src.hashkey()
+        src.pos.x += 1.
+        self.assertNotEqual(src.hashkey(), k)
+        self.assertEqual(src.hashkey(), src.copy().hashkey())
+        # changes through the direct setters are noticed too
+        k = src.hashkey()
+        src.pos._setThing(1, src.pos.y + 1.)
+        self.assertNotEqual(src.hashkey(), k)
+        psf = GaussianMixturePSF(np.array([1.]), np.zeros((1,2)),
+                                 np.array([np.eye(2)]))
+        k = psf.hashkey()
+        psf.mog.var[0] *= 2.
+        self.assertNotEqual(psf.hashkey(), k)
+        tim.psf = PixelizedPSF(np.ones((5,5)))
+        k = tim.hashkey()
+        self.assertEqual(tim.hashkey(), k)
+        tim.psf.img = np.ones((5,5))
+        self.assertEqual(tim.hashkey(), k)
+        tim.psf.img = np.ones((7,7))
+        self.assertNotEqual(tim.hashkey(), k)
+        k = tim.hashkey()
+        tim.sky.setParams([1.])
+        self.assertNotEqual(tim.hashkey(), k)
+
+    def test_cache_budget(self):
+        from tractor.cache import Cache, get_cache_stats
+        from tractor.patch import Patch
+        C = Cache(maxsize=None, maxbytes=3 * (Cache.entry_bytes + 800),
+                  name='test-budget')
+        for i in range(4):
+            C.put(i, (0., Patch(0, 0, np.zeros((10,10)))))
+        self.assertEqual(len(C), 3)
+        self.assertEqual(C.get(0, None), None)
+        self.assertTrue(C.get(3, None) is not None)
+        # a large entry pushes out several small ones
+        C.put('big', Patch(0, 0, np.zeros((10,20))))
+        self.assertEqual(len(C), 2)
+        d = [d for d in get_cache_stats() if d['name'] == 'test-budget'][0]
+        self.assertEqual((d['hits'], d['misses'], d['evictions']), (1, 1, 3))
+        self.assertEqual(d['bytes'], 2 * Cache.entry_bytes + 2400)
+        self.assertLessEqual(d['bytes'], d['maxbytes'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import numpy as np
+
+from tractor import *
+from tractor.psfex import VaryingGaussianPSF
+
+class StampPsf(VaryingGaussianPSF):
+    # (at module level so that it can be pickled)
+    def instantiateAt(self, x, y):
+        r = np.arange(-10, 11)
+        s = 1.5 + x / 200. + y / 300.
+        return np.exp(-0.5 * (r[:,np.newaxis]**2 + r[np.newaxis,:]**2) / s**2)
+
+def test_stamp_bank():
+    psf = GaussianMixturePSF(np.array([0.8, 0.2]), np.zeros((2,2)),
+                             np.array([[[2., 0.1], [0.1, 2.5]],
+                                       [[6., 0.], [0., 6.]]]))
+    psf.radius = 10
+    def render(p):
+        m = np.zeros((40,40))
+        p.addTo(m)
+        return m
+    pts = [(20.3, 19.8), (15.5, 22.25), (18., 18.)]
+    exact = [render(psf.getPointSourcePatch(x, y)) for x,y in pts]
+    for interp in [True, False]:
+        psf.setStampBank(8, interp=interp)
+        err = psf.getStampBankError()
+        assert(err < 0.05)
+        for (x,y),m in zip(pts, exact):
+            p = psf.getPointSourcePatch(x, y)
+            assert(p.shape == (21,21))
+            assert(np.abs(render(p) - m).max() <= 1.01 * err * m.max())
+    # the stamps follow changes to the PSF parameters
+    psf.setStampBank(8)
+    psf.getPointSourcePatch(*pts[0])
+    p = psf.getParams()
+    p[-3] *= 2.
+    psf.setParams(p)
+    m = render(psf.getPointSourcePatch(*pts[0]))
+    err = psf.getStampBankError()
+    psf.setStampBank(None)
+    m2 = render(psf.getPointSourcePatch(*pts[0]))
+    assert(np.abs(m - m2).max() <= 1.01 * err * m2.max())
+
+def test_varying_psf_batch():
+    class LinearPsf(VaryingGaussianPSF):
+        def _fitParamGrid(self):
+            XX = np.linspace(0, self.W, self.nx)
+            YY = np.linspace(0, self.H, self.ny)
+            pp = np.array([[[0.7, 0.3, 0., 0., 0., 0.,
+                             1. + x / 40., 1. + y / 30., 0.1, 4., 4., 0.]
+                            for x in XX] for y in YY])
+            self.fitSavedData(pp, XX, YY)
+    H,W = 30,40
+    tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                psf=LinearPsf(W, H, K=2), wcs=NullWCS(),
+                sky=ConstantSky(0.), photocal=LinearPhotoCal(1.))
+    tractor = Tractor([tim], [PointSource(PixPos(10.1, 12.2), Flux(100.)),
+                              PointSource(PixPos(28.3, 17.4), Flux(200.))])
+    xs = np.array([3.3, 17.2, 35.9])
+    ys = np.array([5.1, 22.6, 12.4])
+    P = tim.psf.psfParamsAt(xs, ys)
+    assert(P.shape == (3, 12))
+    for x,y,p in zip(xs, ys, P):
+        assert(np.allclose(p, tim.psf.psfParamsAt(x, y)))
+    mod0 = np.zeros(tim.shape)
+    for src in tractor.catalog:
+        src.getModelPatch(tim).addTo(mod0)
+    tim.psf.prefetched = {}
+    mod1 = tractor.getModelImage(tim, sky=False)
+    assert(len(tim.psf.prefetched) == len(tractor.catalog))
+    assert(np.allclose(mod0, mod1))
+
+def test_varying_psf_parallel_fit():
+    from astrometry.util.multiproc import multiproc
+    psfs = [StampPsf(100, 100, nx=4, ny=4, K=1) for i in range(2)]
+    psfs[0]._fitParamGrid()
+    psfs[1]._fitParamGrid(mp=multiproc(2))
+    for x,y in [(10., 20.), (70., 45.)]:
+        p0,p1 = [psf.getPointSourcePatch(x, y).patch for psf in psfs]
+        assert(np.allclose(p0, p1, atol=1e-6 * p0.max()))
+
+def test_varying_ellipse_psf_fit():
+    psf = StampPsf(100, 100, nx=4, ny=4, K=2,
+                   psfClass=GaussianMixtureEllipsePSF)
+    psf._fitParamGrid()
+    for x,y in [(10., 20.), (70., 45.)]:
+        fit = psf.psfAt(x, y)
+        assert(isinstance(fit, GaussianMixtureEllipsePSF))
+        p = psf.getPointSourcePatch(x, y)
+        r = np.arange(p.x0, p.x0 + p.shape[1]) - x
+        s = 1.5 + x / 200. + y / 300.
+        g = np.exp(-0.5 * (r[np.newaxis,:]**2 + r[:,np.newaxis]**2) / s**2)
+        # (the ellipse fits do not normalize the stamps)
+        g /= g.sum()
+        assert(np.abs(p.patch / p.patch.sum() - g).max() < 0.01 * g.max())
+
+if __name__ == '__main__':
+    test_stamp_bank()
+    test_varying_psf_batch()
+    test_varying_psf_parallel_fit()
+    test_varying_ellipse_psf_fit()
@@ -0,0 +1,36 @@
+import numpy as np
+
+from tractor import *
+from tractor.splinesky import SplineSky
+
+def test_spline_sky_derivs():
+    H,W = 50,60
+    XX,YY = np.linspace(0, W, 5), np.linspace(0, H, 4)
+    np.random.seed(3)
+    truth = SplineSky(XX, YY, np.random.normal(size=(4,5)))
+    sky = SplineSky(XX, YY, np.zeros((4,5)))
+    data = np.zeros((H,W))
+    truth.addTo(data)
+    assert(np.allclose(data, truth.spl(np.arange(W), np.arange(H)).T))
+    tim = Image(data=data, invvar=np.ones((H,W)),
+                psf=NCircularGaussianPSF([1.], [1.]), wcs=NullWCS(),
+                sky=sky, photocal=NullPhotoCal())
+    tractor = Tractor([tim], [])
+    tim.freezeAllBut('sky')
+    derivs = sky.getParamDerivatives(tractor, tim, [])
+    assert(len(derivs) == sky.numberOfParams())
+    assert(not any(d is None or d is False for d in derivs))
+    # clipping the returned patches does not change later calls
+    ext = [d.getExtent() for d in derivs]
+    for d in derivs:
+        d.clipTo(10, 10)
+    derivs = sky.getParamDerivatives(tractor, tim, [])
+    assert([d.getExtent() for d in derivs] == ext)
+    # linear in the coefficients: one step gets there
+    tractor.optimize()
+    assert(np.allclose(sky.getParams(), truth.getParams(), atol=1e-6))
+    mod = tractor.getModelImage(0)
+    assert(np.allclose(mod, data, atol=1e-6))
+
+if __name__ == '__main__':
+    test_spline_sky_derivs()
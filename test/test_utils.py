@@ -28,3 +28,47 @@ print 't3:', t3
 print 't3 params:', t3.getParams()
 assert(len(t3.getParams()) == 2)
 
+
+# MultiParams compiled parameter layouts
+m = MultiParams(t1, ScalarParam(7.), NpArrayParams(np.arange(6.).reshape(2,3)))
+print 'm params:', m.getParams()
+assert(m.getParams() == [42., 3.14, 7., 0., 1., 2., 3., 4., 5.])
+v = m.getVersion()
+m.setParams(m.getParams())
+assert(m.getVersion() == v)
+m.setParams(np.arange(9.))
+assert(m.getParams() == range(9))
+assert(m.getVersion() != v)
+assert(m.subs[2].a[1,2] == 8.)
+t1.thawParam('b')
+m.subs[2].freezeParam(0)
+assert(m.numberOfParams() == 9)
+print 'm params:', m.getParams()
+assert(m.getParams() == [0., 17., 1., 2., 4., 5., 6., 7., 8.])
+# freezing part of one tree leaves other trees' layouts alone
+m2 = MultiParams(ScalarParam(1.), ScalarParam(2.))
+lay = m2._getLayout()
+t1.freezeParam('a')
+assert(m.numberOfParams() == 8)
+assert(m2._getLayout() is lay)
+# after editing a liquid list directly, the layouts must be told
+t1.liquid[0] = True
+t1.invalidateParamLayouts()
+assert(m.numberOfParams() == 9)
+# ... while a change in the number of parameters of an opaque leaf is
+# detected without help
+
+class GrowingParams(BaseParams):
+	def __init__(self):
+		self.vals = [1.]
+	def getParams(self):
+		return list(self.vals)
+	def setParams(self, p):
+		self.vals = list(p)
+
+g = GrowingParams()
+m3 = MultiParams(ScalarParam(0.), g)
+assert(m3.numberOfParams() == 2)
+g.vals.append(2.)
+assert(m3.numberOfParams() == 3)
+assert(m3.getParams() == [0., 1., 2.])
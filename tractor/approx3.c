@@ -10,6 +10,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                               PyObject* ob_xderiv,
                               PyObject* ob_yderiv,
                               PyObject* ob_mask,
+                              PyObject* ob_dmean,
+                              PyObject* ob_dvar,
+                              PyObject* ob_dresult,
                               int xc, int yc,
                               int minradius,
                               int* sx0, int* sx1, int* sy0, int* sy1) {
@@ -22,6 +25,12 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
     // ob_xderiv: if not NULL, result array for x derivative
     // ob_yderiv: if not NULL, result array for y derivative
     //
+    // ob_dresult: if not None, result array, shape (P, y1-y0, x1-x0),
+    // for the derivatives with respect to P parameters, given by
+    // ob_dmean, shape (K, P, 2): derivatives of the component means,
+    // and ob_dvar, shape (K, P, 2, 2): derivatives of the component
+    // covariances.
+    //
     // xc, yc: "center" pixel from which to begin evaluation.  If
     // outside x0,x1,y0,y1, the largest boundary value will be chosen
     // as the start point.
@@ -45,6 +54,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
     int rtn = -1;
     PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL;
     PyObject *np_xderiv=NULL, *np_yderiv=NULL, *np_mask=NULL;
+    PyObject *np_dmean=NULL, *np_dvar=NULL, *np_dresult=NULL;
+    double *dmean=NULL, *dvar=NULL, *dresult=NULL;
+    int P = 0;
     double tpd;
     int W,H;
     int R;
@@ -74,11 +86,45 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
     if (np_mask)
         mask   = PyArray_DATA(np_mask);
 
+    if (ob_dresult != Py_None) {
+        PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
+        int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+        Py_INCREF(dtype);
+        Py_INCREF(dtype);
+        np_dmean = PyArray_FromAny(ob_dmean, dtype, 3, 3, req, NULL);
+        np_dvar = PyArray_FromAny(ob_dvar, dtype, 4, 4, req, NULL);
+        np_dresult = PyArray_FromAny(ob_dresult, dtype, 3, 3,
+                                     req | NPY_WRITEABLE | NPY_UPDATEIFCOPY,
+                                     NULL);
+        if (!np_dmean || !np_dvar || !np_dresult) {
+            ERR("dmean, dvar or dresult wasn't the type expected");
+            goto bailout;
+        }
+        P = (int)PyArray_DIM(np_dresult, 0);
+        if ((PyArray_DIM(np_dresult, 1) != H) ||
+            (PyArray_DIM(np_dresult, 2) != W) ||
+            (PyArray_DIM(np_dmean, 0) != K) ||
+            (PyArray_DIM(np_dmean, 1) != P) ||
+            (PyArray_DIM(np_dmean, 2) != D) ||
+            (PyArray_DIM(np_dvar, 0) != K) ||
+            (PyArray_DIM(np_dvar, 1) != P) ||
+            (PyArray_DIM(np_dvar, 2) != D) ||
+            (PyArray_DIM(np_dvar, 3) != D)) {
+            ERR("dmean, dvar or dresult has the wrong shape");
+            goto bailout;
+        }
+        dmean   = PyArray_DATA(np_dmean);
+        dvar    = PyArray_DATA(np_dvar);
+        dresult = PyArray_DATA(np_dresult);
+    }
+
     {
         double II[3*K];
         double VV[3*K];
         double scales[K];
         double maxD[K];
+        // symmetrized covariance derivatives: xx, xy, yy.
+        double DV[3*K*P + 1];
 
         uint8_t aw[4*W];
         uint8_t ah[4*H];
@@ -132,6 +178,14 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                 maxD[k] = -100.;
             }
         }
+        if (dresult) {
+            int i;
+            for (i=0; i<K*P; i++) {
+                DV[3*i + 0] =  dvar[4*i + 0];
+                DV[3*i + 1] = (dvar[4*i + 1] + dvar[4*i + 2])*0.5;
+                DV[3*i + 2] =  dvar[4*i + 3];
+            }
+        }
 
         // is the given starting pixel xc,yc outside the box the be evaluated?
         if ((xc < x0) || (yc < y0) || (xc >= x1) || (yc >= y1)) {
@@ -202,7 +256,8 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
             pxd = xderiv + off;
         if (yderiv)
             pyd = yderiv + off;
-        result[off] = eval_all_dxy(K, scales, II, mean, xc-fx, yc-fy, pxd, pyd, maxD);
+        result[off] = eval_all_dxy(K, scales, II, mean, xc-fx, yc-fy, pxd, pyd, maxD,
+                                   P, dmean, DV, (dresult ? dresult+off : NULL), W*H);
 
         *sx0 = xc-x0;
         *sx1 = *sx0;
@@ -298,7 +353,8 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                     xx = x0 + i;
                     r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
                                      (pxd ? pxd+i : NULL), (pyd ? pyd+i : NULL),
-                                     maxD);
+                                     maxD, P, dmean, DV,
+                                     (dresult ? dresult+off+i : NULL), W*H);
 
                     //result[(yy - y0)*W + (xx - x0)] = r;
                     rrow[i] = r;
@@ -350,7 +406,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                     anyrow = 1;
                     xx = x0 + i;
                     r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
-                                     (pxd?pxd+i:NULL), (pyd?pyd+i:NULL), maxD);
+                                     (pxd?pxd+i:NULL), (pyd?pyd+i:NULL), maxD,
+                                     P, dmean, DV,
+                                     (dresult ? dresult+off+i : NULL), W*H);
                     //result[(yy - y0)*W + (xx - x0)] = r;
                     rrow[i] = r;
                     //printf("bottom[xx=%i] = %g\n", xx, r);
@@ -396,7 +454,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                     off = (yy - y0)*W + (xx - x0);
                     r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
                                      (xderiv ? xderiv+off : NULL),
-                                     (yderiv ? yderiv+off : NULL), maxD);
+                                     (yderiv ? yderiv+off : NULL), maxD,
+                                     P, dmean, DV,
+                                     (dresult ? dresult+off : NULL), W*H);
                     result[off] = r;
                     //printf("left[yy=%i] = %g\n", xx, r);
                     //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
@@ -428,7 +488,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                     off = (yy - y0)*W + (xx - x0);
                     r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
                                      (xderiv ? xderiv+off : NULL),
-                                     (yderiv ? yderiv+off : NULL), maxD);
+                                     (yderiv ? yderiv+off : NULL), maxD,
+                                     P, dmean, DV,
+                                     (dresult ? dresult+off : NULL), W*H);
                     result[off] = r;
                     //printf("right[yy=%i] = %g\n", yy, r);
                     //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
@@ -461,6 +523,9 @@ bailout:
     Py_XDECREF(np_xderiv);
     Py_XDECREF(np_yderiv);
     Py_XDECREF(np_mask);
+    Py_XDECREF(np_dmean);
+    Py_XDECREF(np_dvar);
+    Py_XDECREF(np_dresult);
 
     //printf("N exp calls: %i\n", n_exp - nexp0);
 
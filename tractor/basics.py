@@ -510,6 +510,7 @@ class WcslibWcs(BaseParams, ducks.ImageCalibration):
         '''
         self.x0 = x0
         self.y0 = y0
+        self._bumpVersion()
 
     def positionToPixel(self, pos, src=None):
         ok,x,y = self.wcs.radec2pixelxy(pos.ra, pos.dec)
@@ -571,6 +572,7 @@ class ConstantFitsWcs(ParamList, ducks.ImageCalibration):
         '''
         self.x0 = x0
         self.y0 = y0
+        self._bumpVersion()
 
     def positionToPixel(self, pos, src=None):
         '''
@@ -1004,7 +1006,122 @@ class PointSource(MultiParams):
                 derivs.append(df)
         return derivs
 
-class PixelizedPSF(BaseParams, ducks.ImageCalibration):
+class StampBank(object):
+    '''
+    Point-source stamps precomputed at an (N+1) x (N+1) grid of
+    subpixel phases dx,dy = -0.5, -0.5 + 1/N, ..., 0.5.
+
+    Stamps are produced by a *render(dx, dy)* function, passed to each
+    call (so that the bank holds only arrays and can be pickled),
+    that must return arrays of the same shape for all phases.  They
+    are computed when first needed or, if not *lazy*, all at once on
+    first use.  Lookups return the stamp of the nearest phase or, if
+    *interp*, a bilinear interpolation between the four surrounding
+    phases.
+    '''
+    def __init__(self, N=8, interp=True, lazy=True):
+        assert(N >= 1)
+        self.N = N
+        self.interp = interp
+        self.lazy = lazy
+        self.stamps = {}
+        self.error = None
+
+    def _getPhase(self, i, j, render):
+        try:
+            return self.stamps[(i,j)]
+        except KeyError:
+            pass
+        if not self.lazy and len(self.stamps) == 0:
+            N = self.N
+            for jj in range(N+1):
+                for ii in range(N+1):
+                    self.stamps[(ii,jj)] = render(ii / float(N) - 0.5,
+                                                  jj / float(N) - 0.5)
+            return self.stamps[(i,j)]
+        s = self.stamps[(i,j)] = render(i / float(self.N) - 0.5,
+                                        j / float(self.N) - 0.5)
+        return s
+
+    def getStamp(self, dx, dy, render):
+        '''
+        Returns a new array: the stamp for subpixel offset *dx*,*dy*,
+        each in [-0.5, 0.5].
+        '''
+        N = self.N
+        fx = min(max((dx + 0.5) * N, 0.), N)
+        fy = min(max((dy + 0.5) * N, 0.), N)
+        if not self.interp:
+            return self._getPhase(int(np.round(fx)), int(np.round(fy)),
+                                  render).copy()
+        i = min(int(fx), N-1)
+        j = min(int(fy), N-1)
+        ax = fx - i
+        ay = fy - j
+        s = (1.-ax) * (1.-ay) * self._getPhase(i, j, render)
+        if ax > 0:
+            s += ax * (1.-ay) * self._getPhase(i+1, j, render)
+        if ay > 0:
+            s += (1.-ax) * ay * self._getPhase(i, j+1, render)
+            if ax > 0:
+                s += ax * ay * self._getPhase(i+1, j+1, render)
+        return s
+
+    def getError(self, render):
+        '''
+        Returns the largest error of the looked-up stamps, relative to
+        the peak, measured at the centers of the phase cells along the
+        diagonal (where the nearest-phase and bilinear errors are
+        largest).
+        '''
+        if self.error is None:
+            err = 0.
+            for i in range(self.N):
+                d = (i + 0.5) / self.N - 0.5
+                exact = render(d, d)
+                err = max(err, (np.abs(self.getStamp(d, d, render) - exact).max()
+                                / np.abs(exact).max()))
+            self.error = err
+        return self.error
+
+class StampBankMixin(object):
+    '''
+    Adds an optional StampBank to a PSF class; the class's
+    getPointSourcePatch() uses _getBankedStamp() when
+    self.stampbank is set.  Banks are discarded when the PSF's
+    parameters change.
+    '''
+    stampbank = None
+
+    def setStampBank(self, N=8, interp=True, lazy=True):
+        '''
+        Enables (or, with *N=None*, disables) rendering point sources
+        from a bank of stamps precomputed at N x N subpixel phases;
+        see StampBank.
+        '''
+        if N is None:
+            self.stampbank = None
+        else:
+            self.stampbank = (N, interp, lazy)
+        self._stampbanks = {}
+
+    def _getBank(self, key):
+        banks = self.__dict__.setdefault('_stampbanks', {})
+        v = self.getVersion()
+        if banks.get('version') != v:
+            banks.clear()
+            banks['version'] = v
+        try:
+            return banks[key]
+        except KeyError:
+            N,interp,lazy = self.stampbank
+            bank = banks[key] = StampBank(N, interp=interp, lazy=lazy)
+            return bank
+
+    def _getBankedStamp(self, key, dx, dy, render):
+        return self._getBank(key).getStamp(dx, dy, render)
+
+class PixelizedPSF(StampBankMixin, BaseParams, ducks.ImageCalibration):
     '''
     A PSF model based on an image postage stamp, which will be
     sinc-shifted to subpixel positions.
@@ -1025,7 +1142,23 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         return 'PixelizedPSF'
 
     def hashkey(self):
-        return ('PixelizedPSF', tuple(self.img.ravel()))
+        return ('PixelizedPSF',) + self._getDigest()
+
+    def getVersion(self):
+        # Replacing the postage stamp counts as a change.
+        return (self._version,) + self._getDigest()
+
+    def _getDigest(self):
+        # Content digest of the postage stamp, computed once per
+        # stamp array (in-place changes to self.img are not noticed).
+        img = self.img
+        d = self.__dict__.get('_digest')
+        if d is None or d[0] is not img:
+            import hashlib
+            a = np.ascontiguousarray(img)
+            d = (img, (a.shape, a.dtype.str, hashlib.sha1(a.data).hexdigest()))
+            self._digest = d
+        return d[1]
 
     def copy(self):
         return PixelizedPSF(self.img.copy())
@@ -1035,7 +1168,6 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         return np.hypot(H,W)/2.
 
     def getPointSourcePatch(self, px, py, minval=0., **kwargs):
-        from scipy.ndimage.filters import correlate1d
         H,W = self.img.shape
         ix = int(np.round(px))
         iy = int(np.round(py))
@@ -1043,6 +1175,21 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         dy = py - iy
         x0 = ix - W/2
         y0 = iy - H/2
+        if self.stampbank is not None:
+            shifted = self._getBankedStamp(None, dx, dy, self._getShifted)
+        else:
+            shifted = self._getShifted(dx, dy)
+        return Patch(x0, y0, shifted)
+
+    def getStampBankError(self):
+        '''
+        Returns the interpolation error of the stamp bank (see
+        setStampBank()), relative to the peak.
+        '''
+        return self._getBank(None).getError(self._getShifted)
+
+    def _getShifted(self, dx, dy):
+        from scipy.ndimage.filters import correlate1d
         L = self.Lorder
         Lx = lanczos_filter(L, np.arange(-L, L+1) + dx)
         Ly = lanczos_filter(L, np.arange(-L, L+1) + dy)
@@ -1055,7 +1202,7 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         #shifted = np.maximum(shifted, 0.)
 
         shifted /= shifted.sum()
-        return Patch(x0, y0, shifted)
+        return shifted
 
     def getFourierTransformSize(self, radius):
         ## FIXME -- power-of-2 MINUS one to keep things odd...?
@@ -1088,11 +1235,14 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         self.fftcache[sz] = rtn
         return rtn
     
-class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
+class GaussianMixturePSF(StampBankMixin, ParamList, ducks.ImageCalibration):
     '''
     A PSF model that is a mixture of general 2-D Gaussians
     (characterized by amplitude, mean, covariance)
     '''
+    # (the values live in self.mog, which can be modified directly)
+    _versionedHashkey = False
+
     def __init__(self, *args):
         '''
         GaussianMixturePSF(amp, mean, var)
@@ -1182,6 +1332,7 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
     def shiftBy(self, dx, dy):
         self.mog.mean[:,0] += dx
         self.mog.mean[:,1] += dy
+        self._bumpVersion()
     
     def computeRadius(self):
         import numpy.linalg
@@ -1202,9 +1353,22 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
                             derivs=False, minradius=None, **kwargs):
         '''
         extent = [x0,x1,y0,y1], clip to [x0,x1), [y0,y1).
+
+        With a stamp bank (see setStampBank()), and no *extent*,
+        *derivs* or *minradius*, the patch is looked up from the bank:
+        a (2R+1)-pixel square, R = *radius* or self.radius, not
+        trimmed at *minval*.
         '''
         if minval is None:
             minval = 0.
+        if (self.stampbank is not None and extent is None and not derivs
+            and minradius is None and (radius or self.radius) is not None):
+            R = int(np.ceil(radius or self.radius))
+            ix = int(np.round(px))
+            iy = int(np.round(py))
+            stamp = self._getBankedStamp(R, px - ix, py - iy,
+                                         self._getStampRenderer(R))
+            return Patch(ix - R, iy - R, stamp)
         if minval > 0. or minradius is not None:
             if radius is not None:
                 rr = radius
@@ -1255,6 +1419,20 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
         y0,y1 = int(floor(py-r)), int(ceil(py+r)) + 1
         return self.mog.evaluate_grid(x0, x1, y0, y1, px, py)
 
+    def getStampBankError(self, radius=None):
+        '''
+        Returns the interpolation error of the stamp bank (see
+        setStampBank()) for stamps of the given *radius* (default
+        self.radius), relative to the peak.
+        '''
+        R = int(np.ceil(radius or self.radius))
+        return self._getBank(R).getError(self._getStampRenderer(R))
+
+    def _getStampRenderer(self, R):
+        def render(dx, dy):
+            return self.mog.evaluate_grid(-R, R+1, -R, R+1, dx, dy).patch
+        return render
+
     def __str__(self):
         return (
             'GaussianMixturePSF: amps=' + str(tuple(self.mog.amp.ravel())) +
@@ -1280,6 +1458,7 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
         self.mog.var[:,0,0] = pp[::3]
         self.mog.var[:,1,1] = pp[1::3]
         self.mog.var[:,0,1] = self.mog.var[:,1,0] = pp[2::3]
+        self.mog.update()
     def _setThing(self, i, p):
         K = self.mog.K
         if i < K:
@@ -1297,10 +1476,12 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
         if k in [0,1]:
             old = self.mog.var[j,k,k]
             self.mog.var[j,k,k] = p
+            self.mog.update()
             return old
         old = self.mog.var[j,0,1]
         self.mog.var[j,0,1] = p
         self.mog.var[j,1,0] = p
+        self.mog.update()
         return old
 
     @staticmethod
@@ -1366,6 +1547,57 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
         tpsf = GaussianMixturePSF(w, mu, var)
         return tpsf
 
+    @staticmethod
+    def fromStamps(stamps, N=3, P0=None, xy0=None, alpha=0.,
+                   emsteps=1000, tol=1e-9, warmstart=True):
+        '''
+        Fits a stack of same-sized stamps (eg, a PSF model sampled on
+        a grid of positions), as fromStamp() does for one, in a single
+        call to the EM code.
+
+        optional P0 = (w,mu,var): initial parameter guess, for the
+        first stamp if *warmstart* (each later fit then starts from
+        the previous solution), else for each stamp.
+
+        Each fit stops after *emsteps* iterations, or once no
+        parameter changes by more than *tol* in an iteration.
+
+        Returns (psfs, iters, converged): a list of GaussianMixturePSF
+        and arrays of the number of EM iterations run and whether
+        each fit converged.
+        '''
+        from emfit import em_fit_2d_batch
+        from fitpsf import em_init_params
+        if P0 is not None:
+            w,mu,var = P0
+        else:
+            w,mu,var = em_init_params(N, None, None, None)
+        stamps = np.array(stamps, dtype=float)
+        S,H,W = stamps.shape
+
+        if xy0 is None:
+            xm, ym = -(W/2), -(H/2)
+        else:
+            xm, ym = xy0
+
+        stamps /= np.sum(stamps, axis=(1,2))[:,np.newaxis,np.newaxis]
+        stamps = np.maximum(stamps, 0)
+
+        K = len(w)
+        ww  = np.empty((S,K))
+        mus = np.empty((S,K,2))
+        vs  = np.empty((S,K,2,2))
+        ww [:] = w
+        mus[:] = mu
+        vs [:] = var
+        iters = np.zeros(S, np.intc)
+        converged = np.zeros(S, np.intc)
+        r = em_fit_2d_batch(stamps, xm, ym, ww, mus, vs, alpha, emsteps,
+                            tol, warmstart, iters, converged)
+        assert(r == 0)
+        psfs = [GaussianMixturePSF(ww[i], mus[i], vs[i]) for i in range(S)]
+        return psfs, iters, converged.astype(bool)
+
 
 class GaussianMixtureEllipsePSF(GaussianMixturePSF):
     '''
@@ -1446,6 +1678,7 @@ class GaussianMixtureEllipsePSF(GaussianMixturePSF):
             e.setAllParams(pp[:3])
             pp = pp[3:]
             self.mog.var[i,:,:] = self.ellipseToVariance(e)
+        self.mog.update()
     def _setThing(self, i, p):
         ## hack
         things = self._getThings()
@@ -1634,6 +1867,8 @@ class ParamsWrapper(BaseParams):
         self.real = real
     def hashkey(self):
         return self.real.hashkey()
+    def getVersion(self):
+        return self.real.getVersion()
     def getLogPrior(self):
         return self.real.getLogPrior()
     def getLogPriorDerivatives(self):
@@ -6,8 +6,35 @@ except:
 	from ordereddict import OrderedDict
 
 
+import weakref
+
+import numpy as np
+
 #from refcnt import refcnt
 
+# All live Cache objects, for get_cache_stats()
+_registry = weakref.WeakSet()
+
+def get_cache_stats():
+	'''
+	Returns a list of Cache.getStats() dicts, one for each live Cache
+	object, sorted by name.
+	'''
+	return sorted([c.getStats() for c in list(_registry)],
+				  key=lambda d: d['name'])
+
+def print_cache_stats():
+	'''
+	Prints a one-line summary for each live Cache object.
+	'''
+	for d in get_cache_stats():
+		print ('%s: %i items, %.1f MB (max %s), %i hits, %i misses ' +
+			   '(hit rate %.2f), %i evictions') % (
+			d['name'], d['items'], d['bytes'] / 1e6,
+			('%.1f MB' % (d['maxbytes'] / 1e6)
+			 if d['maxbytes'] is not None else 'none'),
+			d['hits'], d['misses'], d['hitrate'], d['evictions'])
+
 '''
 LRU cache.
 This code is based on: http://code.activestate.com/recipes/498245-lru-and-lfu-cache-decorators/
@@ -17,10 +44,29 @@ License: Python Software Foundation (PSF) license.
 class Cache(object):
 	class Entry(object):
 		pass
-	def __init__(self, maxsize=1000, sizeattr='size'):
+	# Bytes charged per entry on top of the value's arrays.
+	entry_bytes = 64
+
+	def __init__(self, maxsize=1000, sizeattr='size', maxbytes=None,
+				 name='Cache'):
+		'''
+		maxsize: maximum number of entries (None for no limit)
+		maxbytes: maximum total size of the entries, in bytes (None
+		  for no limit).
+
+		Least-recently-used entries are evicted to stay within both
+		limits.  The size of an entry is estimated by _nbytes().
+		'''
 		self.clear()
 		self.maxsize = maxsize
+		self.maxbytes = maxbytes
 		self.sizeattr = sizeattr
+		self.name = name
+		_registry.add(self)
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		_registry.add(self)
 
 	def __del__(self):
 		# OrderedDict objects seem to be prone to leaving garbage around...
@@ -44,7 +90,40 @@ class Cache(object):
 			# 	print 'real', refcnt(vv)
 		self.hits = 0
 		self.misses = 0
-		
+		self.evictions = 0
+		self.nbytes = 0
+
+	def _nbytes(self, val, depth=2):
+		'''
+		Estimates the memory used by a cached value: numpy arrays
+		count their bytes; objects with a *sizeattr* attribute (eg,
+		Patch) count that many pixels; tuples and lists count their
+		elements; other objects count the arrays among their
+		attributes.
+		'''
+		if val is None:
+			return 0
+		if isinstance(val, np.ndarray):
+			return val.nbytes
+		if isinstance(val, (tuple, list)):
+			return sum([self._nbytes(v, depth) for v in val])
+		sz = getattr(val, self.sizeattr, None)
+		if sz is not None:
+			try:
+				pix = getattr(val, 'patch', None)
+				return int(sz) * getattr(pix, 'itemsize', 8)
+			except:
+				pass
+		if depth > 0 and hasattr(val, '__dict__'):
+			return sum([self._nbytes(v, depth-1)
+						for v in val.__dict__.values()])
+		return 0
+
+	def _evict(self):
+		k,e = self.dict.popitem(0)
+		self.evictions += 1
+		self.nbytes -= e.nbytes
+
 	def __setitem__(self, key, val):
 		sz = 0
 		if hasattr(val, self.sizeattr):
@@ -55,11 +134,19 @@ class Cache(object):
 		e = Cache.Entry()
 		e.val = val
 		e.size = sz
+		e.nbytes = self.entry_bytes + self._nbytes(val)
 		e.hits = 0
-		# purge LRU item
-		if len(self.dict) >= self.maxsize:
-			self.dict.popitem(0)
+		old = self.dict.pop(key, None)
+		if old is not None:
+			self.nbytes -= old.nbytes
+		# purge LRU items
+		while len(self.dict) and (
+			(self.maxsize is not None and len(self.dict) >= self.maxsize) or
+			(self.maxbytes is not None and
+			 self.nbytes + e.nbytes > self.maxbytes)):
+			self._evict()
 		self.dict[key] = e
+		self.nbytes += e.nbytes
 
 	def __getitem__(self, key):
 		# pop
@@ -89,6 +176,18 @@ class Cache(object):
 			return self.__getitem__(key)
 		except:
 			return default
+	def getStats(self):
+		'''
+		Returns a dict of statistics: name, items, bytes, maxbytes,
+		maxsize, hits, misses, hitrate, evictions.
+		'''
+		n = self.hits + self.misses
+		return dict(name=self.name, items=len(self), bytes=self.nbytes,
+					maxbytes=self.maxbytes, maxsize=self.maxsize,
+					hits=self.hits, misses=self.misses,
+					hitrate=(float(self.hits) / n if n else 0.),
+					evictions=self.evictions)
+
 	def about(self):
 		print 'Cache has', len(self), 'items:'
 		for k,v in self.dict.items():
@@ -96,7 +195,7 @@ class Cache(object):
 				continue
 			print '  size', v.size, 'hits', v.hits
 	def __str__(self):
-		s =  'Cache: %i items, total of %i hits, %i misses' % (len(self), self.hits, self.misses)
+		s =  '%s: %i items (%i bytes), total of %i hits, %i misses, %i evictions' % (self.name, len(self), self.nbytes, self.hits, self.misses, self.evictions)
 		nnone = 0
 		hits = 0
 		size = 0
@@ -136,6 +235,7 @@ class Cache(object):
 	def printStats(self):
 		print 'Cache has', len(self), 'items'
 		print 'Total of', self.hits, 'cache hits and', self.misses, 'misses'
+		print 'Total of', self.evictions, 'evictions;', self.nbytes, 'bytes in use'
 		nnone = 0
 		hits = 0
 		size = 0
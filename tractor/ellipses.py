@@ -143,6 +143,48 @@ class EllipseE(ParamList):
         T = np.dot(np.linalg.inv(G), cd)
         return T
 
+    def getBasisCovarianceDerivatives(self):
+        '''
+        Returns the derivatives of G G^T, where G = getRaDecBasis(),
+        with respect to each of the parameters (re, e1, e2; frozen or
+        not), as a list of 2x2 matrices.
+        '''
+        return EllipseE._basisCovarianceDerivatives(self.re, self.e1, self.e2)
+
+    @staticmethod
+    def _basisCovarianceDerivatives(re, e1, e2, maxab=1000.):
+        # G G^T = r^2 (a I + b N), where N = [[c, -s], [-s, -c]] for
+        # (c, s) = (e1, e2) / e, and a, b = (q^2 + 1) / 2, (q^2 - 1) / 2
+        # for q = 1/ab.
+        e = np.hypot(e1, e2)
+        r = re / 3600.
+        E = np.array([[e1, -e2], [-e2, -e1]])
+        N1 = np.array([[1., 0.], [0., -1.]])
+        N2 = np.array([[0., -1.], [-1., 0.]])
+        I = np.eye(2)
+        if e >= 1. or (1.+e)/(1.-e) > maxab:
+            # ab is clamped at maxab; only the angle matters.
+            q = 1. / maxab
+            a = 0.5 * (q**2 + 1.)
+            b = 0.5 * (q**2 - 1.)
+            X = a * I + b * E / e
+            d1 = b * (N1 / e - E * e1 / e**3)
+            d2 = b * (N2 / e - E * e2 / e**3)
+        else:
+            # here b / e = beta is smooth at e = 0; a is not, so we
+            # use the symmetric derivative there.
+            a = (1. + e**2) / (1. + e)**2
+            beta = -2. / (1. + e)**2
+            X = a * I + beta * E
+            d1 = beta * N1
+            d2 = beta * N2
+            if e > 0.:
+                da = 2. * (e - 1.) / (1. + e)**3
+                dbeta = 4. / (1. + e)**3
+                d1 = d1 + (da * I + dbeta * E) * e1 / e
+                d2 = d2 + (da * I + dbeta * E) * e2 / e
+        return [2. * r / 3600. * X, r**2 * d1, r**2 * d2]
+
 class EllipseESoft(EllipseE):
     '''
     This is an alternate implementation of the ellipse describing a
@@ -231,6 +273,43 @@ class EllipseESoft(EllipseE):
     # unlike the superclass.
     def isLegal(self):
         return True
+
+    def getBasisCovarianceDerivatives(self):
+        '''
+        Returns the derivatives of G G^T, where G = getRaDecBasis(),
+        with respect to each of the parameters (logre, ee1, ee2;
+        frozen or not), as a list of 2x2 matrices.
+        '''
+        ee = np.hypot(self.ee1, self.ee2)
+        e = self.e
+        if ee > 0.:
+            e1 = e * self.ee1 / ee
+            e2 = e * self.ee2 / ee
+        else:
+            e1 = e2 = 0.
+        re = self.re
+        dre,de1,de2 = EllipseE._basisCovarianceDerivatives(re, e1, e2)
+        if abs(self.logre) > 100:
+            dlogre = np.zeros((2,2))
+        else:
+            dlogre = re * dre
+        # e_i = g(ee) ee_i, with g = e / ee
+        if ee > 0.:
+            g = e / ee
+            dg = (np.exp(-ee) * ee - e) / ee**2
+        else:
+            g = 1.
+            dg = 0.
+        dee = []
+        for j,eej in enumerate([self.ee1, self.ee2]):
+            d = np.zeros((2,2))
+            for i,(eei,dei) in enumerate([(self.ee1, de1), (self.ee2, de2)]):
+                J = dg * eei * eej / ee if ee > 0. else 0.
+                if i == j:
+                    J += g
+                d = d + J * dei
+            dee.append(d)
+        return [dlogre] + dee
     
 if __name__ == '__main__':
     ps = PlotSequence('ell')
@@ -6,6 +6,7 @@
 #include <numpy/arrayobject.h>
 #include <math.h>
 #include <assert.h>
+#include <string.h>
     %}
 
 %init %{
@@ -24,6 +25,10 @@
 #define ERR(x, ...)                             \
     printf(x, ## __VA_ARGS__)
 
+#ifndef MAX
+#define MAX(a,b) (((a) > (b)) ? (a) : (b))
+#endif
+
 // ASSUME "amp", "mean", and "var" have been initialized.
 
 // _reg: Inverse-Wishart prior on variance (with hard-coded
@@ -243,104 +248,49 @@ static int em_fit_1d_samples(PyObject* np_x,
 
 
 
-// _reg: Inverse-Wishart prior on variance (with hard-coded
-// variance prior I), with strength alpha.
-static int em_fit_2d_reg(PyObject* np_img, int x0, int y0,
-                         PyObject* np_amp,
-                         PyObject* np_mean,
-                         PyObject* np_var,
-                         double alpha,
-                         int steps) {
-    npy_intp i, N, K, k;
+// Runs up to "steps" EM iterations fitting the K-component mixture
+// (amp, mean, var; updated in place) to the NY x NX image "img", whose
+// pixel (0,0) is at x0,y0.  If tol > 0, stops after an iteration in
+// which no element of amp, mean or var changed by more than tol.
+// Sets *p_iters to the number of iterations run and *p_converged to
+// whether the tolerance was met.  Returns 0 on success, -1 if a
+// component's variance became singular.
+static int em_fit_2d_core(const double* img, npy_intp NX, npy_intp NY,
+                          int x0, int y0, npy_intp K,
+                          double* amp, double* mean, double* var,
+                          double alpha, int steps, double tol,
+                          int* p_iters, int* p_converged) {
+    npy_intp i, N, k;
     npy_intp ix, iy;
-    npy_intp NX, NY;
     const npy_intp D = 2;
     double* Z = NULL;
-    double* scale = NULL, *ivar = NULL;
+    double* scale = NULL, *ivar = NULL, *prev = NULL;
     int step;
     double tpd;
     int result;
 
-    PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
-    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
-    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
-
-    double* amp;
-    double* mean;
-    double* var;
-    double* img;
-
     tpd = pow(2.*M_PI, D);
 
-    Py_INCREF(dtype);
-    np_img = PyArray_FromAny(np_img, dtype, 2, 2, req, NULL);
-    if (!np_img) {
-        ERR("img wasn't the type expected");
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_amp = PyArray_FromAny(np_amp, dtype, 1, 1, reqout, NULL);
-    if (!np_amp) {
-        ERR("amp wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_mean = PyArray_FromAny(np_mean, dtype, 2, 2, reqout, NULL);
-    if (!np_mean) {
-        ERR("mean wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(np_amp);
-        Py_DECREF(dtype);
-        return -1;
-    }
-    Py_INCREF(dtype);
-    np_var = PyArray_FromAny(np_var, dtype, 3, 3, reqout, NULL);
-    if (!np_var) {
-        ERR("var wasn't the type expected");
-        Py_DECREF(np_img);
-        Py_DECREF(np_amp);
-        Py_DECREF(np_mean);
-        Py_DECREF(dtype);
-        return -1;
-    }
-
-    K = PyArray_DIM(np_amp, 0);
-    // printf("K=%i\n", K);
-    if ((PyArray_DIM(np_mean, 0) != K) ||
-        (PyArray_DIM(np_mean, 1) != D)) {
-        ERR("np_mean must be K x D");
-        return -1;
-    }
-    if ((PyArray_DIM(np_var, 0) != K) ||
-        (PyArray_DIM(np_var, 1) != D) ||
-        (PyArray_DIM(np_var, 2) != D)) {
-        ERR("np_var must be K x D x D");
-        return -1;
-    }
-    NY = PyArray_DIM(np_img, 0);
-    NX = PyArray_DIM(np_img, 1);
-
-    amp  = PyArray_DATA(np_amp);
-    mean = PyArray_DATA(np_mean);
-    var  = PyArray_DATA(np_var);
-    img  = PyArray_DATA(np_img);
-
     N = NX*NY;
     Z = malloc(K * N * sizeof(double));
     assert(Z);
     scale = malloc(K * sizeof(double));
     ivar = malloc(K * D * D * sizeof(double));
-    assert(scale && ivar);
+    prev = malloc(K * (1 + D + D*D) * sizeof(double));
+    assert(scale && ivar && prev);
 
     // printf("NX=%i, NY=%i; N=%i\n", NX, NY, N);
 
+    *p_converged = 0;
     for (step=0; step<steps; step++) {
         double x,y;
         double wsum[K];
         double qsum = 0.0;
+        double maxchange;
+
+        memcpy(prev, amp, K * sizeof(double));
+        memcpy(prev + K, mean, K * D * sizeof(double));
+        memcpy(prev + K*(1+D), var, K * D * D * sizeof(double));
 
         /*              {
          int d;
@@ -377,6 +327,7 @@ static int em_fit_2d_reg(PyObject* np_img, int x0, int y0,
                 printf("det = %g\n", det);
                 ERR("Got non-positive determinant\n");
                 result = -1;
+                *p_iters = step;
                 goto cleanup;
             }
             I[0] =  V[3] / det;
@@ -485,13 +436,114 @@ static int em_fit_2d_reg(PyObject* np_img, int x0, int y0,
         // printf("M amp...\n");
         for (k=0; k<K; k++)
             amp[k] = wsum[k];
+
+        if (tol > 0) {
+            maxchange = 0;
+            for (k=0; k<K; k++)
+                maxchange = MAX(maxchange, fabs(amp[k] - prev[k]));
+            for (k=0; k<K*D; k++)
+                maxchange = MAX(maxchange, fabs(mean[k] - prev[K + k]));
+            for (k=0; k<K*D*D; k++)
+                maxchange = MAX(maxchange, fabs(var[k] - prev[K*(1+D) + k]));
+            if (maxchange <= tol) {
+                *p_converged = 1;
+                step++;
+                break;
+            }
+        }
     }
+    *p_iters = step;
     result = 0;
-        
+
  cleanup:
     free(Z);
     free(scale);
     free(ivar);
+    free(prev);
+    return result;
+}
+
+// _reg: Inverse-Wishart prior on variance (with hard-coded
+// variance prior I), with strength alpha.
+static int em_fit_2d_reg(PyObject* np_img, int x0, int y0,
+                         PyObject* np_amp,
+                         PyObject* np_mean,
+                         PyObject* np_var,
+                         double alpha,
+                         int steps) {
+    npy_intp K;
+    npy_intp NX, NY;
+    const npy_intp D = 2;
+    int result;
+    int iters, converged;
+
+    PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
+
+    double* amp;
+    double* mean;
+    double* var;
+    double* img;
+
+    Py_INCREF(dtype);
+    np_img = PyArray_FromAny(np_img, dtype, 2, 2, req, NULL);
+    if (!np_img) {
+        ERR("img wasn't the type expected");
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_amp = PyArray_FromAny(np_amp, dtype, 1, 1, reqout, NULL);
+    if (!np_amp) {
+        ERR("amp wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_mean = PyArray_FromAny(np_mean, dtype, 2, 2, reqout, NULL);
+    if (!np_mean) {
+        ERR("mean wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(np_amp);
+        Py_DECREF(dtype);
+        return -1;
+    }
+    Py_INCREF(dtype);
+    np_var = PyArray_FromAny(np_var, dtype, 3, 3, reqout, NULL);
+    if (!np_var) {
+        ERR("var wasn't the type expected");
+        Py_DECREF(np_img);
+        Py_DECREF(np_amp);
+        Py_DECREF(np_mean);
+        Py_DECREF(dtype);
+        return -1;
+    }
+
+    K = PyArray_DIM(np_amp, 0);
+    // printf("K=%i\n", K);
+    if ((PyArray_DIM(np_mean, 0) != K) ||
+        (PyArray_DIM(np_mean, 1) != D)) {
+        ERR("np_mean must be K x D");
+        return -1;
+    }
+    if ((PyArray_DIM(np_var, 0) != K) ||
+        (PyArray_DIM(np_var, 1) != D) ||
+        (PyArray_DIM(np_var, 2) != D)) {
+        ERR("np_var must be K x D x D");
+        return -1;
+    }
+    NY = PyArray_DIM(np_img, 0);
+    NX = PyArray_DIM(np_img, 1);
+
+    amp  = PyArray_DATA(np_amp);
+    mean = PyArray_DATA(np_mean);
+    var  = PyArray_DATA(np_var);
+    img  = PyArray_DATA(np_img);
+
+    result = em_fit_2d_core(img, NX, NY, x0, y0, K, amp, mean, var,
+                            alpha, steps, 0., &iters, &converged);
 
     Py_DECREF(np_img);
     Py_DECREF(np_amp);
@@ -502,6 +554,104 @@ static int em_fit_2d_reg(PyObject* np_img, int x0, int y0,
     return result;
 }
 
+// Fits a stack of S images, "np_imgs" (S x NY x NX, pixel (0,0) of
+// each at x0,y0), each with a K-component mixture: "np_amp" (S x K),
+// "np_mean" (S x K x 2), "np_var" (S x K x 2 x 2), updated in place.
+// If "warmstart", each fit after the first starts from the solution
+// of the previous image instead of from its given initial values.
+// See em_fit_2d_core for "steps" and "tol"; the number of iterations
+// and whether each fit converged are written to the int arrays
+// "np_iters" and "np_converged" (length S).  Returns 0 on success, or
+// -1 if any fit failed (its iteration count is then negative).
+static int em_fit_2d_batch(PyObject* np_imgs, int x0, int y0,
+                           PyObject* np_amp,
+                           PyObject* np_mean,
+                           PyObject* np_var,
+                           double alpha,
+                           int steps,
+                           double tol,
+                           int warmstart,
+                           PyObject* np_iters,
+                           PyObject* np_converged) {
+    npy_intp s, S, K, NX, NY;
+    const npy_intp D = 2;
+    int result = 0;
+    PyObject *a_imgs, *a_amp, *a_mean, *a_var, *a_iters, *a_conv;
+    double *imgs, *amp, *mean, *var;
+    int *iters, *conv;
+
+    PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
+    PyArray_Descr* itype = PyArray_DescrFromType(NPY_INT);
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
+
+    // PyArray_FromAny steals a reference to the dtype
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(itype);
+    Py_INCREF(itype);
+    a_imgs  = PyArray_FromAny(np_imgs, dtype, 3, 3, req, NULL);
+    a_amp   = PyArray_FromAny(np_amp,  dtype, 2, 2, reqout, NULL);
+    a_mean  = PyArray_FromAny(np_mean, dtype, 3, 3, reqout, NULL);
+    a_var   = PyArray_FromAny(np_var,  dtype, 4, 4, reqout, NULL);
+    a_iters = PyArray_FromAny(np_iters, itype, 1, 1, reqout, NULL);
+    a_conv  = PyArray_FromAny(np_converged, itype, 1, 1, reqout, NULL);
+    if (!a_imgs || !a_amp || !a_mean || !a_var || !a_iters || !a_conv) {
+        ERR("em_fit_2d_batch: arrays weren't the types expected\n");
+        result = -1;
+        goto cleanup;
+    }
+    S  = PyArray_DIM(a_imgs, 0);
+    NY = PyArray_DIM(a_imgs, 1);
+    NX = PyArray_DIM(a_imgs, 2);
+    K  = PyArray_DIM(a_amp, 1);
+    if ((PyArray_DIM(a_amp, 0) != S) ||
+        (PyArray_DIM(a_mean, 0) != S) || (PyArray_DIM(a_mean, 1) != K) ||
+        (PyArray_DIM(a_mean, 2) != D) ||
+        (PyArray_DIM(a_var, 0) != S) || (PyArray_DIM(a_var, 1) != K) ||
+        (PyArray_DIM(a_var, 2) != D) || (PyArray_DIM(a_var, 3) != D) ||
+        (PyArray_DIM(a_iters, 0) != S) || (PyArray_DIM(a_conv, 0) != S)) {
+        ERR("em_fit_2d_batch: array shapes must be (S,NY,NX), (S,K), (S,K,2), (S,K,2,2), (S), (S)\n");
+        result = -1;
+        goto cleanup;
+    }
+    imgs  = PyArray_DATA(a_imgs);
+    amp   = PyArray_DATA(a_amp);
+    mean  = PyArray_DATA(a_mean);
+    var   = PyArray_DATA(a_var);
+    iters = PyArray_DATA(a_iters);
+    conv  = PyArray_DATA(a_conv);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (s=0; s<S; s++) {
+        if (warmstart && s > 0) {
+            memcpy(amp  + s*K, amp  + (s-1)*K, K * sizeof(double));
+            memcpy(mean + s*K*D, mean + (s-1)*K*D, K * D * sizeof(double));
+            memcpy(var  + s*K*D*D, var + (s-1)*K*D*D, K*D*D * sizeof(double));
+        }
+        if (em_fit_2d_core(imgs + s*NX*NY, NX, NY, x0, y0, K,
+                           amp + s*K, mean + s*K*D, var + s*K*D*D,
+                           alpha, steps, tol, iters + s, conv + s)) {
+            iters[s] = -1 - iters[s];
+            result = -1;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+ cleanup:
+    Py_XDECREF(a_imgs);
+    Py_XDECREF(a_amp);
+    Py_XDECREF(a_mean);
+    Py_XDECREF(a_var);
+    Py_XDECREF(a_iters);
+    Py_XDECREF(a_conv);
+    Py_DECREF(dtype);
+    Py_DECREF(itype);
+    return result;
+}
+
 //%apply double *OUTPUT { double *p_skyamp };
 static int em_fit_2d_reg2(PyObject* np_img, int x0, int y0,
                           PyObject* np_amp,
@@ -328,6 +328,23 @@ def getimagederivs(X):
     (imj, img, tractor, srcs) = X
     ## FIXME -- avoid shipping all images...
     return img.getParamDerivatives(tractor, srcs)
+
+def getlogprobsteps(X):
+    # A run of consecutive line-search steps (see Tractor.tryUpdates),
+    # stopping early by the serial rule applied to this run alone:
+    # earlier runs can only raise the best log-prob, so this never
+    # stops before the serial search would.
+    (tr, pBest, steps) = X
+    lnps = []
+    for p in steps:
+        tr.setParams(p)
+        lnp = tr.getLogProb()
+        lnps.append(lnp)
+        if not np.isfinite(lnp) or lnp < (pBest - 1.):
+            break
+        pBest = max(pBest, lnp)
+    return lnps
+
 def getmodelimagefunc2(X):
     (tr, im) = X
     #print 'getmodelimagefunc2(): im', im, 'pid', os.getpid()
@@ -340,10 +357,392 @@ def getmodelimagefunc2(X):
         traceback.print_exc()
         raise
 
+def lsqrblock(X):
+    (A, b, damp, variance, use_lsmr) = X
+    from scipy.sparse.linalg import lsqr, lsmr
+    if use_lsmr and not variance:
+        R = lsmr(A, b, damp=damp)
+        return R[0], None
+    R = lsqr(A, b, damp=damp, calc_var=variance)
+    if variance:
+        return R[0], R[9]
+    return R[0], None
+
 class OptResult():
     # quack
     pass
 
+class CscBuilder(object):
+    '''
+    Builds a sparse matrix in compressed-sparse-column (CSC) format
+    one column at a time, writing straight into the *indptr*,
+    *indices* and *data* arrays that scipy.sparse.csc_matrix wants.
+
+    This avoids building (row, column, value) triplets that then have
+    to be expanded, concatenated and re-sorted by scipy.
+
+    Columns must be filled in increasing order; entries can be
+    appended to the current column in several chunks (eg, one per
+    derivative Patch).
+    '''
+    def __init__(self, nrows, ncols, nnz=1024, dtype=np.float64):
+        self.nrows = nrows
+        self.ncols = ncols
+        if nrows < 2**31:
+            itype = np.int32
+        else:
+            itype = np.int64
+        self.indptr = np.zeros(ncols + 1, np.int64)
+        self.indices = np.empty(max(nnz, 1), itype)
+        self.data = np.empty(max(nnz, 1), dtype)
+        self.nnz = 0
+        # column currently being filled
+        self.col = 0
+
+    def _startColumn(self, col):
+        assert(col >= self.col)
+        assert(col < self.ncols)
+        if col > self.col:
+            # close the current column and any empty ones in between.
+            self.indptr[self.col + 1 : col + 1] = self.nnz
+            self.col = col
+
+    def _reserve(self, n):
+        need = self.nnz + n
+        if need <= len(self.data):
+            return
+        newsize = max(need, 2 * len(self.data))
+        for name in ['indices', 'data']:
+            old = getattr(self, name)
+            new = np.empty(newsize, old.dtype)
+            new[:self.nnz] = old[:self.nnz]
+            setattr(self, name, new)
+
+    def append(self, col, rows, vals):
+        '''
+        Appends the given row indices and values to column *col*.
+        '''
+        self._startColumn(col)
+        n = len(rows)
+        assert(len(vals) == n)
+        self._reserve(n)
+        self.indices[self.nnz : self.nnz + n] = rows
+        self.data   [self.nnz : self.nnz + n] = vals
+        self.nnz += n
+
+    def getColumn(self, col):
+        '''
+        Returns (rows, vals) views of the column currently being
+        filled; *vals* can be modified in place.
+        '''
+        self._startColumn(col)
+        i0 = self.indptr[col]
+        return self.indices[i0 : self.nnz], self.data[i0 : self.nnz]
+
+    def setColumn(self, col, rows, vals):
+        '''
+        Replaces the contents of the column currently being filled.
+        '''
+        self._startColumn(col)
+        self.nnz = self.indptr[col]
+        self.append(col, rows, vals)
+
+    def getNnzPerColumn(self):
+        if self.ncols > 0:
+            self._startColumn(self.ncols - 1)
+        indptr = self.indptr.copy()
+        indptr[-1] = self.nnz
+        return np.diff(indptr)
+
+    def getMatrix(self):
+        '''
+        Returns the scipy.sparse.csc_matrix.
+        '''
+        from scipy.sparse import csc_matrix
+        if self.ncols > 0:
+            self._startColumn(self.ncols - 1)
+        self.indptr[-1] = self.nnz
+        return csc_matrix((self.data[:self.nnz], self.indices[:self.nnz],
+                           self.indptr), shape=(self.nrows, self.ncols))
+
+# Thread pools for PatchJacobian, by number of threads; they are kept
+# for the life of the process rather than created per Jacobian.
+_thread_pools = {}
+
+def get_thread_pool(threads):
+    pool = _thread_pools.get(threads)
+    if pool is None:
+        from multiprocessing.pool import ThreadPool
+        pool = _thread_pools[threads] = ThreadPool(threads)
+    return pool
+
+class PatchJacobian(object):
+    '''
+    A matrix-free version of the derivatives matrix that
+    Tractor.getUpdateDirection hands to LSQR: it holds the
+    (clipped, inverse-error-weighted) derivative Patches themselves
+    and implements the matrix-vector products patch-by-patch, so the
+    peak memory is about that of the derivative patches.
+
+    Rows are the pixels of the images (at the row offsets given in
+    *imgoffs*), followed by any prior rows; columns are the
+    parameters.  The per-image work of the products can be run in a
+    (shared, see get_thread_pool()) pool of *threads*.
+    '''
+    def __init__(self, imgoffs, nrows, ncols, threads=None):
+        self.imgoffs = imgoffs
+        self.nrows = nrows
+        self.npixrows = nrows
+        self.ncols = ncols
+        self.nparams = ncols
+        # img -> [ (column, slice, weighted patch), ... ]
+        self.terms = dict([(img, []) for img in imgoffs.keys()])
+        self.nnz = 0
+        self.nonempty = np.zeros(ncols, bool)
+        # sparse matrix block of prior rows, appended below the pixels
+        self.priors = None
+        # shared-parameter map
+        self.parammap = None
+        self.pool = None
+        if threads is not None and threads > 1:
+            self.pool = get_thread_pool(threads)
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    def _map(self, func, args):
+        if self.pool is None:
+            return map(func, args)
+        return self.pool.map(func, args)
+
+    def addColumn(self, col, derivs, factor=1e-10):
+        '''
+        Adds the derivative (Patch, Image) pairs for parameter *col*.
+        Elements smaller than *factor* times the largest element in
+        the column are set to zero.
+
+        Returns the column's L2 norm, or None if the column is empty.
+        '''
+        terms = []
+        for deriv,img in derivs:
+            (H,W) = img.shape
+            deriv.clipTo(W, H)
+            if deriv.patch is None:
+                continue
+            slc = deriv.getSlice(img)
+            wp = deriv.patch.astype(np.float64) * img.getInvError()[slc]
+            # (clipping a patch that lies off the image leaves it empty)
+            if wp.size == 0:
+                continue
+            terms.append((img, slc, wp))
+        if len(terms) == 0:
+            return None
+        mx = max([np.max(np.abs(wp)) for img,slc,wp in terms])
+        if mx == 0:
+            return None
+        sumsq = 0.
+        for img,slc,wp in terms:
+            wp[np.abs(wp) <= factor * mx] = 0.
+            sumsq += np.sum(wp**2)
+            self.nnz += np.count_nonzero(wp)
+            self.terms[img].append((col, slc, wp))
+        self.nonempty[col] = True
+        return np.sqrt(sumsq)
+
+    def scaleColumns(self, colscales):
+        for terms in self.terms.values():
+            for col,slc,wp in terms:
+                wp /= colscales[col]
+
+    def setPriors(self, P):
+        self.priors = P
+        self.nrows = self.npixrows + P.shape[0]
+
+    def setParamMap(self, parammap, nshared):
+        self.parammap = parammap
+        self.ncols = nshared
+
+    def _matvec_image(self, X):
+        (img, x, out) = X
+        for col,slc,wp in self.terms[img]:
+            xc = x[col]
+            if xc == 0:
+                continue
+            out[slc] += xc * wp
+
+    def _rmatvec_image(self, X):
+        (img, y) = X
+        r = np.zeros(self.nparams)
+        for col,slc,wp in self.terms[img]:
+            r[col] += np.sum(wp * y[slc])
+        return r
+
+    def _image_rows(self, v, img):
+        row0 = self.imgoffs[img]
+        (H,W) = img.shape
+        return v[row0 : row0 + H*W].reshape((H,W))
+
+    def matvec(self, x):
+        x = np.ravel(x)
+        if self.parammap is not None:
+            x = x[self.parammap]
+        y = np.zeros(self.nrows)
+        # each image writes into its own rows of "y".
+        self._map(self._matvec_image,
+                  [(img, x, self._image_rows(y, img)) for img in self.terms])
+        if self.priors is not None:
+            y[self.npixrows:] = self.priors.dot(x)
+        return y
+
+    def rmatvec(self, y):
+        y = np.ravel(y)
+        rs = self._map(self._rmatvec_image,
+                       [(img, self._image_rows(y, img)) for img in self.terms])
+        r = np.zeros(self.nparams)
+        for ri in rs:
+            r += ri
+        if self.priors is not None:
+            r += self.priors.T.dot(y[self.npixrows:])
+        if self.parammap is not None:
+            r = np.bincount(self.parammap, weights=r, minlength=self.ncols)
+        return r
+
+    def _imageMatrix(self, img):
+        '''
+        Returns the rows of the Jacobian for the pixels of *img*, as a
+        scipy.sparse.csc_matrix with the columns in parameter (not
+        shared-parameter) order.
+        '''
+        from scipy.sparse import csc_matrix
+        (H,W) = img.shape
+        AI,AJ,AV = [],[],[]
+        for col,(yslc,xslc),wp in self.terms[img]:
+            yy,xx = np.nonzero(wp)
+            AI.append((yy + yslc.start) * W + (xx + xslc.start))
+            AJ.append(np.zeros(len(yy), int) + col)
+            AV.append(wp[yy,xx])
+        if len(AV):
+            AI,AJ,AV = [np.hstack(a) for a in (AI,AJ,AV)]
+        return csc_matrix((AV, (AI, AJ)), shape=(H*W, self.nparams))
+
+    def getNormalEquations(self, b, sparse=False):
+        '''
+        Computes (A^T A, A^T b), accumulating them image by image: the
+        non-zero derivative pixels of one image are gathered into a
+        sparse matrix A_i, and A_i^T A_i and A_i^T b_i are added in.
+        So the extra memory is that of one image's non-zero
+        derivative pixels (in COO and CSC form) plus A^T A itself.
+
+        A^T A is returned as a dense array, or as a
+        scipy.sparse.csc_matrix if *sparse* is True.
+        '''
+        from scipy.sparse import csr_matrix
+        N = self.nparams
+        ATA = csr_matrix((N,N))
+        ATb = np.zeros(N)
+        for img in self.terms:
+            A = self._imageMatrix(img)
+            AT = A.T.tocsr()
+            ATA = ATA + AT.dot(A)
+            ATb += AT.dot(self._image_rows(b, img).ravel())
+            del A, AT
+        if self.priors is not None:
+            P = self.priors
+            ATA = ATA + P.T.dot(P)
+            ATb += P.T.dot(b[self.npixrows:])
+        if self.parammap is not None:
+            from scipy.sparse import csc_matrix
+            S = csc_matrix((np.ones(N), (np.arange(N), self.parammap)),
+                           shape=(N, self.ncols))
+            ATA = S.T.dot(ATA).dot(S)
+            ATb = np.bincount(self.parammap, weights=ATb, minlength=self.ncols)
+        if sparse:
+            ATA = ATA.tocsc()
+        else:
+            ATA = ATA.toarray()
+        return ATA, ATb
+
+    def getLinearOperator(self):
+        from scipy.sparse.linalg import LinearOperator
+        return LinearOperator(self.shape, matvec=self.matvec,
+                              rmatvec=self.rmatvec, dtype=np.float64)
+
+class ModelImageBuffer(object):
+    '''
+    The persistent model image of one Image, kept up to date by
+    Tractor.getModelImage() in incremental mode.  It records the
+    model Patch and parameter version of each source that has been
+    added into the model.
+    '''
+    def __init__(self, img, minsb):
+        self.img = img
+        self.version = img.getVersion()
+        self.minsb = minsb
+        # accumulate in double precision so that repeated
+        # subtract-and-add updates don't drift.
+        self.mod = np.zeros(img.getModelShape(), np.float64)
+        img.sky.addTo(self.mod)
+        # id(src) -> (src, version, patch)
+        self.srcs = {}
+
+    def isValid(self, img, minsb):
+        return (self.img is img and self.minsb == minsb and
+                self.version == img.getVersion())
+
+class RoiChi(object):
+    '''
+    Cached state for Tractor.getLogLikelihood() in ROI mode, for one
+    Image: the region of interest (the union of the thawed sources'
+    patch footprints, grown by a margin), the frozen-source model,
+    data and inverse-error within it, and the chi-squared of all the
+    pixels outside it.
+    '''
+    def __init__(self, tractor, img, thawed, frozen, margin):
+        H,W = img.shape
+        mask = np.zeros((H,W), bool)
+        for src in thawed:
+            patch = tractor.getModelPatch(img, src)
+            if patch is None or patch.patch is None:
+                continue
+            (ph,pw) = patch.shape
+            mask[max(0, patch.y0 - margin) : max(0, patch.y0 + ph + margin),
+                 max(0, patch.x0 - margin) : max(0, patch.x0 + pw + margin)
+                 ] = True
+        mod = tractor.getModelImage(img, srcs=frozen)
+        chi = (img.getImage() - mod) * img.getInvError()
+        self.chisq = (chi[~mask].astype(float)**2).sum()
+        # pixel index within the ROI, or -1
+        pix = np.flatnonzero(mask)
+        self.index = np.empty((H,W), np.int32)
+        self.index.fill(-1)
+        self.index.flat[pix] = np.arange(len(pix))
+        self.mod = mod.flat[pix]
+        self.data = img.getImage().flat[pix]
+        self.inverr = img.getInvError().flat[pix]
+
+    def addPatch(self, patch, mod):
+        '''
+        Adds model *patch* into the ROI pixels *mod*; returns False if
+        the patch has non-zero pixels outside the ROI.
+        '''
+        if patch is None or patch.patch is None:
+            return True
+        (H,W) = self.index.shape
+        (ph,pw) = patch.shape
+        x0,y0 = patch.x0, patch.y0
+        xlo,xhi = max(x0, 0), min(x0 + pw, W)
+        ylo,yhi = max(y0, 0), min(y0 + ph, H)
+        if xlo >= xhi or ylo >= yhi:
+            return True
+        p = patch.patch[ylo-y0 : yhi-y0, xlo-x0 : xhi-x0]
+        I = self.index[ylo:yhi, xlo:xhi]
+        inroi = (I >= 0)
+        if not np.all(inroi) and np.any(p[~inroi] != 0):
+            return False
+        mod[I[inroi]] += p[inroi]
+        return True
+
 class Tractor(MultiParams):
     """
     Heavy farm machinery.
@@ -377,15 +776,39 @@ class Tractor(MultiParams):
     def disable_cache(self):
         self.cache = None
 
+    def enable_incremental(self, incremental=True):
+        '''
+        Keep a persistent model image for each Image.  When the model
+        image is requested, only the sources whose parameters have
+        changed (according to their getVersion() stamps) since the
+        last request are re-rendered: their old patches are
+        subtracted and the new ones added, rather than re-rendering
+        the whole catalog.  Adding or removing sources is handled;
+        any change to an Image's own parameters (or to its
+        *modelMinval*) re-renders that whole image.
+
+        Changes that bypass the Params interface (eg, editing a
+        PixelizedPSF's pixels in place) are not noticed; call
+        clearCache() after making them.
+        '''
+        self.incremental = incremental
+        self.modelbuffers = {}
+
     def _setup(self, mp=None, cache=None, pickleCache=False):
         if mp is None:
             mp = multiproc()
         self.mp = mp
         self.modtype = np.float32
         if cache is None:
-            cache = Cache()
+            cache = Cache(maxsize=None, maxbytes=256*1024*1024,
+                          name='Tractor')
         self.cache = cache
         self.pickleCache = pickleCache
+        self.incremental = False
+        self.modelbuffers = {}
+        self.roi_likelihood = False
+        self.roichis = None
+        self.sharedparams = None
 
     def __str__(self):
         s = '%s with %i sources and %i images' % (self.getName(), len(self.catalog), len(self.images))
@@ -528,8 +951,52 @@ class Tractor(MultiParams):
             sigmas.append(sigma)
         return np.array(sigmas)
 
-    def optimize_lbfgsb(self, hessian_terms=10, plotfn=None):
+    def getLogProbGradient(self, priors=True):
+        '''
+        Returns the log-prob and its gradient with respect to the
+        thawed parameters.  The gradient is computed analytically as
+        J^T chi -- from the derivatives (getDerivs()) and chi images
+        -- plus, if *priors*, the gradient of the log-prior (from
+        getLogPriorDerivatives()).
 
+        Returns (log-prob, gradient).
+        '''
+        lnp = 0.
+        if priors:
+            lnp = self.getLogPrior()
+        allderivs = self.getDerivs()
+        wchis = {}
+        for img,chi in zip(self.images, self.getChiImages()):
+            lnp -= 0.5 * (chi.astype(float)**2).sum()
+            # d(chi)/d(model) = -inverr
+            wchis[id(img)] = chi * img.getInvError()
+        g = np.zeros(len(allderivs))
+        for i,param in enumerate(allderivs):
+            for deriv,img in param:
+                H,W = img.shape
+                if deriv.patch is None or not deriv.clipTo(W, H):
+                    continue
+                g[i] += np.sum(deriv.patch * wchis[id(img)][deriv.getSlice(img)])
+        if priors:
+            X = self.getLogPriorDerivatives()
+            if X is not None:
+                # Prior rows, as in getUpdateDirection(): A = vals, b = pb,
+                # and the gradient is A^T b.
+                rA,cA,vA,pb = X
+                if len(rA):
+                    pb = np.hstack(pb)
+                    for ri,ci,vi in zip(rA, cA, vA):
+                        g[ci] += np.sum(vi * pb[ri])
+        return lnp, g
+
+    def optimize_lbfgsb(self, hessian_terms=10, plotfn=None, gradient=True):
+        '''
+        Optimizes the thawed parameters with scipy's L-BFGS-B.  If
+        *gradient* is True, the analytic gradient
+        (getLogProbGradient()) is used; otherwise scipy approximates
+        it by finite differences, at the cost of one log-prob
+        evaluation per parameter per iteration.
+        '''
         XX = []
         OO = []
         def objective(x, tractor, stepsizes, lnp0):
@@ -540,6 +1007,16 @@ class Tractor(MultiParams):
                 OO.append(res)
             return res
 
+        def objective_grad(x, tractor, stepsizes, lnp0):
+            tractor.setParams(x * stepsizes)
+            lnp,g = tractor.getLogProbGradient()
+            res = lnp0 - lnp
+            logverb('LBFGSB objective:', res)
+            if plotfn:
+                XX.append(x.copy())
+                OO.append(res)
+            return res, -g * stepsizes
+
         from scipy.optimize import fmin_l_bfgs_b
 
         stepsizes = np.array(self.getStepSizes())
@@ -549,10 +1026,11 @@ class Tractor(MultiParams):
         print 'Active parameters:', len(p0)
 
         print 'Calling L-BFGS-B ...'
-        X = fmin_l_bfgs_b(objective, p0 / stepsizes, fprime=None,
+        X = fmin_l_bfgs_b(objective_grad if gradient else objective,
+                          p0 / stepsizes, fprime=None,
                           args=(self, stepsizes, lnp0),
-                          approx_grad=True, bounds=None, m=hessian_terms,
-                          epsilon=1e-8, iprint=0)
+                          approx_grad=not gradient, bounds=None,
+                          m=hessian_terms, epsilon=1e-8, iprint=0)
         p1,lnp1,d = X
         print d
         print 'lnp0:', lnp0
@@ -1065,7 +1543,8 @@ class Tractor(MultiParams):
                 x0 = roi[1].start
             else:
                 x0 = y0 = 0
-            for si,src in enumerate(srcs):
+            minvals = []
+            for src in srcs:
                 counts = sum([pcal.brightnessToCounts(b) for b in src.getBrightnesses()])
                 if counts <= 0:
                     mv = 1e-3
@@ -1073,6 +1552,11 @@ class Tractor(MultiParams):
                     # we will scale the PSF by counts and we want that
                     # scaled min val to be less than minsb
                     mv = minsb / counts
+                minvals.append(mv)
+            self._prefetchPsf(img, srcs)
+            self._prefetchUnitFluxModelPatches(img, srcs, minvals)
+
+            for si,(src,mv) in enumerate(zip(srcs, minvals)):
                 ums = src.getUnitFluxModelPatches(img, minval=mv)
 
                 isvalid = False
@@ -1114,6 +1598,25 @@ class Tractor(MultiParams):
             umodels.append(umods)
         return umodels, umodtosource, umodsforsource
 
+    def _prefetchUnitFluxModelPatches(self, img, srcs, minvals):
+        '''
+        Lets source classes that can render many sources at once (eg,
+        ProfileGalaxy with a pixelized PSF) do so before the
+        per-source getUnitFluxModelPatches() calls, via their
+        (static) prefetchUnitFluxModelPatches(img, srcs, minvals)
+        method.
+        '''
+        groups = {}
+        for src,mv in zip(srcs, minvals):
+            fn = getattr(src, 'prefetchUnitFluxModelPatches', None)
+            if fn is None:
+                continue
+            s,m = groups.setdefault(fn, ([],[]))
+            s.append(src)
+            m.append(mv)
+        for fn,(s,m) in groups.items():
+            fn(img, s, m)
+
     def _getims(self, fluxes, imgs, umodels, mod0, scales, sky, minFlux, rois):
         ims = []
         for i,(img,umods,m0,scale
@@ -1540,12 +2043,37 @@ class Tractor(MultiParams):
 
 
     def optimize(self, alphas=None, damp=0, priors=True, scale_columns=True,
-                 shared_params=True, variance=False, just_variance=False):
+                 shared_params=True, variance=False, just_variance=False,
+                 blocks=False, parallel_linesearch=False, linear_fluxes=False,
+                 **kwargs):
         '''
         Performs *one step* of linearized least-squares + line search.
         
         Returns (delta-logprob, parameter update X, alpha stepsize)
 
+        Extra keyword arguments (eg, *matrix_free*, *use_lsmr*) are
+        passed to getUpdateDirection().
+
+        If blocks=True, the parameters are split into independent
+        blocks (groups of parameters whose derivatives do not share
+        any pixels), which are solved separately (in parallel, via
+        the multiprocessing pool) and line-searched separately (see
+        tryBlockUpdates()).  In this case *alpha* is an array of the
+        step sizes taken for each parameter.
+
+        If parallel_linesearch=True, the line-search steps are
+        evaluated in parallel (see tryUpdates()).
+
+        If linear_fluxes=True, the step is split, variable-projection
+        style: first the brightnesses of the thawed sources are solved
+        exactly by linear least squares (see solveLinearFluxes()),
+        then the remaining (nonlinear) parameters take a linearized
+        least-squares step with the brightnesses held fixed.  X is
+        then the total change in the parameters, and alpha the step
+        size of the nonlinear update.  If the brightnesses are not
+        linear in the image counts (eg, non-LinearPhotoCal images or
+        Mags brightnesses), an ordinary step is taken instead.
+
         If variance=True,
 
         Returns (delta-logprob, parameter update X, alpha stepsize, variance)
@@ -1559,6 +2087,14 @@ class Tractor(MultiParams):
         same length as the number of images, giving the ROI in which
         the chi value (and derivatives) will be evaluated.
         '''
+        if linear_fluxes:
+            assert(not variance)
+            return self._optimizeLinearFluxes(
+                alphas=alphas, damp=damp, priors=priors,
+                scale_columns=scale_columns, shared_params=shared_params,
+                blocks=blocks, parallel_linesearch=parallel_linesearch,
+                **kwargs)
+
         logverb(self.getName()+': Finding derivs...')
         t0 = Time()
         allderivs = self.getDerivs()
@@ -1573,13 +2109,19 @@ class Tractor(MultiParams):
         X = self.getUpdateDirection(allderivs, damp=damp, priors=priors,
                                     scale_columns=scale_columns,
                                     shared_params=shared_params,
-                                    variance=variance)
+                                    variance=variance, blocks=blocks,
+                                    **kwargs)
         if variance:
             if len(X) == 0:
                 return 0, X, 0, None
-            X,var = X
+            if blocks:
+                X,var,paramblocks = X
+            else:
+                X,var = X
             if just_variance:
                 return var
+        elif blocks and len(X):
+            X,paramblocks = X
         #print Time() - t0
         topt = Time()-t0
         #print 'X:', X
@@ -1588,7 +2130,12 @@ class Tractor(MultiParams):
         logverb('X: len', len(X), '; non-zero entries:', np.count_nonzero(X))
         logverb('Finding optimal step size...')
         t0 = Time()
-        (dlogprob, alpha) = self.tryUpdates(X, alphas=alphas)
+        if blocks:
+            (dlogprob, alpha) = self.tryBlockUpdates(X, paramblocks, allderivs,
+                                                     alphas=alphas)
+        else:
+            (dlogprob, alpha) = self.tryUpdates(X, alphas=alphas,
+                                                parallel=parallel_linesearch)
         tstep = Time() - t0
         logverb('Finished opt2.')
         logverb('  alpha =',alpha)
@@ -1599,6 +2146,210 @@ class Tractor(MultiParams):
             return dlogprob, X, alpha, var
         return dlogprob, X, alpha
 
+    def _getThawedBrightnessNames(self, src):
+        return [nm for nm in src.namedparams.keys()
+                if nm.startswith('brightness') and src.isParamThawed(nm)]
+
+    def _getFreezeState(self):
+        return (list(self.liquid), list(self.catalog.liquid),
+                [(src, list(src.liquid)) for src in self.catalog])
+
+    def _setFreezeState(self, state):
+        (self.liquid, self.catalog.liquid, srcs) = state
+        self.invalidateParamLayouts()
+        self.catalog.invalidateParamLayouts()
+        for src,liquid in srcs:
+            src.liquid = liquid
+            src.invalidateParamLayouts()
+
+    def _canSolveLinearFluxes(self):
+        '''
+        Returns True if solveLinearFluxes() applies: all images have
+        LinearPhotoCal calibrations, and the thawed brightnesses are
+        Flux or Fluxes, so the counts are linear in the parameters.
+        '''
+        from basics import LinearPhotoCal, Flux, Fluxes
+        for img in self.getImages():
+            if not isinstance(img.getPhotoCal(), LinearPhotoCal):
+                return False
+        for src in self.catalog.getThawedSources():
+            if not len(self._getThawedBrightnessNames(src)):
+                continue
+            for b in src.getBrightnesses():
+                if not isinstance(b, (Flux, Fluxes)):
+                    return False
+        return True
+
+    def solveLinearFluxes(self, minsb=0., **kwargs):
+        '''
+        Solves for the (linear) brightness parameters of the thawed
+        sources by linear least squares against their unit-flux
+        model patches, holding all other parameters -- including Image
+        parameters -- fixed.  This uses optimize_forced_photometry()
+        (and hence ignores priors); extra keyword arguments are passed
+        to it.
+
+        Returns False (and changes nothing) if the brightnesses are
+        not linear in the image counts (see _canSolveLinearFluxes()),
+        else True.
+        '''
+        if not self._canSolveLinearFluxes():
+            return False
+        state = self._getFreezeState()
+        try:
+            self.freezeParam('images')
+            for i,src in list(self.catalog._enumerateActiveSubs()):
+                names = self._getThawedBrightnessNames(src)
+                if len(names):
+                    src.freezeAllBut(*names)
+                else:
+                    self.catalog.freezeParam(i)
+            if self.catalog.numberOfParams() == 0:
+                return True
+            self.optimize_forced_photometry(minsb=minsb, wantims=False,
+                                            shared_params=False, **kwargs)
+        finally:
+            self._setFreezeState(state)
+        return True
+
+    def _optimizeLinearFluxes(self, **kwargs):
+        if not self._canSolveLinearFluxes():
+            logverb('Brightnesses are not linear; taking an ordinary step')
+            return self.optimize(**kwargs)
+        p0 = np.array(self.getParams())
+        lnp0 = self.getLogProb()
+        t0 = Time()
+        self.solveLinearFluxes()
+        lnp1 = self.getLogProb()
+        logverb('Linear fluxes: delta-logprob', lnp1 - lnp0, 'took', Time()-t0)
+        if not lnp1 >= lnp0:
+            # (eg, priors on the fluxes)
+            logmsg('Linear flux solve made log-prob worse; reverting')
+            self.setParams(p0)
+            lnp1 = lnp0
+
+        state = self._getFreezeState()
+        try:
+            for src in self.catalog.getThawedSources():
+                src.freezeParams(*self._getThawedBrightnessNames(src))
+            dlnp,X,alpha = self.optimize(**kwargs)
+        finally:
+            self._setFreezeState(state)
+        X = np.array(self.getParams()) - p0
+        return lnp1 - lnp0 + dlnp, X, alpha
+
+    def optimize_loop(self, dchisq=0., steps=50, damp=0., alphas=None,
+                      dlnp_rel=0., xtol=0., max_time=None,
+                      lm=True, lm_damp0=1e-3, lm_factor=10., lm_retries=3,
+                      priors=True, **kwargs):
+        '''
+        Runs optimization steps (linearized least-squares + line
+        search, as in optimize()) until convergence.
+
+        The LSQR *damp* is adapted Levenberg-Marquardt style (if
+        *lm*): it is divided by *lm_factor* after a step where the
+        full update was accepted (set to zero below *lm_damp0*), and
+        multiplied by *lm_factor* (or set to *lm_damp0* if zero) when
+        only a shortened step was accepted.  When no step improves the
+        log-prob, the update is re-solved with more damping, re-using
+        the derivatives and chi images, up to *lm_retries* times in a
+        row.
+
+        The chi images computed for the derivative step are also used
+        for the log-prob at the start of the line search.
+
+        Stops when:
+          - the improvement in log-prob is less than *dchisq*, or less
+            than *dlnp_rel* times |log-prob|;
+          - no parameter moved by more than *xtol* times its step size
+            (see getStepSizes());
+          - *steps* iterations have been taken;
+          - more than *max_time* seconds (wall-clock) have passed.
+
+        Extra keyword arguments are passed to getUpdateDirection().
+
+        Returns a dict with:
+          - steps: number of iterations run
+          - dlnp: total change in log-prob
+          - damp: final damping
+          - reason: why it stopped ("dlnp", "xtol", "nostep", "steps",
+            "time", "noparams")
+          - timings: a list with a dict per iteration of (wall-clock
+            seconds) "derivs", "solve" and "step", plus "dlnp",
+            "alpha" and "damp".
+        '''
+        T0 = time.time()
+        timings = []
+        dlnptotal = 0.
+        allderivs = None
+        nfail = 0
+        reason = 'steps'
+        for step in range(steps):
+            timing = dict(derivs=0., solve=0., step=0.)
+            t0 = time.time()
+            if allderivs is None:
+                allderivs = self.getDerivs()
+                chis = self.getChiImages()
+                lnprior = self.getLogPrior()
+                lnp0 = lnprior - 0.5 * sum([(chi.astype(float)**2).sum()
+                                            for chi in chis])
+            t1 = time.time()
+            timing.update(derivs=t1-t0)
+            X = self.getUpdateDirection(allderivs, damp=damp, priors=priors,
+                                        chiImages=chis, **kwargs)
+            t2 = time.time()
+            timing.update(solve=t2-t1)
+            if len(X) == 0:
+                reason = 'noparams'
+                timings.append(timing)
+                break
+            dlnp,alpha = self.tryUpdates(X, alphas=alphas, pBefore=lnp0)
+            t3 = time.time()
+            timing.update(step=t3-t2, dlnp=dlnp, alpha=alpha, damp=damp)
+            timings.append(timing)
+            logverb('optimize_loop step %i: dlnp %g, alpha %g, damp %g; '
+                    'derivs %.3f, solve %.3f, step %.3f s' %
+                    (step, dlnp, alpha, damp, t1-t0, t2-t1, t3-t2))
+            dlnptotal += dlnp
+
+            if dlnp > 0:
+                # took a step: need new derivatives next time
+                allderivs = None
+                nfail = 0
+            else:
+                nfail += 1
+            if max_time is not None and time.time() - T0 > max_time:
+                reason = 'time'
+                break
+            if lm:
+                if dlnp > 0 and alpha >= 1.:
+                    damp /= lm_factor
+                    if damp < lm_damp0:
+                        damp = 0.
+                elif damp == 0:
+                    damp = lm_damp0
+                else:
+                    damp *= lm_factor
+                if dlnp <= 0:
+                    if nfail > lm_retries:
+                        reason = 'nostep'
+                        break
+                    # re-solve with more damping
+                    continue
+
+            if dlnp <= dchisq or dlnp < dlnp_rel * np.abs(lnp0 + dlnp):
+                reason = 'dlnp'
+                break
+            if xtol > 0:
+                ss = np.array(self.getStepSizes())
+                if np.all(np.abs(alpha * np.array(X)) <= xtol * ss):
+                    reason = 'xtol'
+                    break
+        logmsg('optimize_loop: %i steps, delta-logprob %g, stopped on %s'
+               % (len(timings), dlnptotal, reason))
+        return dict(steps=len(timings), dlnp=dlnptotal, damp=damp,
+                    reason=reason, timings=timings)
+
     def getParameterScales(self):
         print self.getName()+': Finding derivs...'
         allderivs = self.getDerivs()
@@ -1606,21 +2357,64 @@ class Tractor(MultiParams):
         s = self.getUpdateDirection(allderivs, scales_only=True)
         return s
 
-    def tryUpdates(self, X, alphas=None):
+    def tryUpdates(self, X, alphas=None, parallel=False, pBefore=None):
+        '''
+        Line search along update direction *X*: tries step sizes
+        *alphas* in order, stopping when the log-prob becomes
+        non-finite or drops by more than 1 below the best so far.
+
+        If *parallel* is True and this Tractor has a multiprocessing
+        pool, the *alphas* are split into one run of consecutive steps
+        per worker and evaluated via the pool, so the Tractor is
+        pickled once per worker rather than once per alpha.  Each
+        worker stops its run early (see getlogprobsteps()), and the
+        serial stopping rule is then replayed over the results, so the
+        chosen step is identical to the serial search.  (Threads are
+        not offered: model rendering mostly holds the GIL, and shares
+        the galaxy and PSF caches.)
+
+        *pBefore*, if given, is the current log-prob (saving one
+        evaluation).
+
+        Returns (delta-logprob, alpha).
+        '''
         if alphas is None:
             # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
             alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
 
-        pBefore = self.getLogProb()
+        if pBefore is None:
+            pBefore = self.getLogProb()
         logverb('  log-prob before:', pBefore)
         pBest = pBefore
         alphaBest = None
         p0 = self.getParams()
-        for alpha in alphas:
+        steps = [[p + alpha * d for p,d in zip(p0, X)] for alpha in alphas]
+        lnps = None
+        if parallel and self.is_multiproc():
+            t0 = Time()
+            nruns = (getattr(self.mp.pool, '_processes', None) or
+                     len(alphas))
+            runs = [I for I in np.array_split(np.arange(len(alphas)), nruns)
+                    if len(I)]
+            # steps after the point where a run stopped stay None; the
+            # serial rule below stops before reaching them.
+            lnps = [None] * len(alphas)
+            for I,run in zip(runs, self._map(getlogprobsteps,
+                                             [(self, pBefore,
+                                               [steps[i] for i in I])
+                                              for I in runs])):
+                for i,lnp in zip(I, run):
+                    lnps[i] = lnp
+            logverb('  Evaluated', len(alphas), 'steps in parallel:',
+                    Time()-t0)
+
+        for i,alpha in enumerate(alphas):
             logverb('  Stepping with alpha =', alpha)
-            pa = [p + alpha * d for p,d in zip(p0, X)]
-            self.setParams(pa)
-            pAfter = self.getLogProb()
+            if lnps is None:
+                self.setParams(steps[i])
+                pAfter = self.getLogProb()
+            else:
+                pAfter = lnps[i]
             logverb('  Log-prob after:', pAfter)
             logverb('  delta log-prob:', pAfter - pBefore)
 
@@ -1634,7 +2428,7 @@ class Tractor(MultiParams):
             if pAfter > pBest:
                 alphaBest = alpha
                 pBest = pAfter
-        
+
         if alphaBest is None or alphaBest == 0:
             print "Warning: optimization is borking"
             print "Parameter direction =",X
@@ -1650,6 +2444,112 @@ class Tractor(MultiParams):
         self.setParams(pa)
         return pBest - pBefore, alphaBest
 
+    def _getBlockLogPriors(self, paramblocks, nblocks):
+        # Log-priors of the thawed images and sources, summed per block
+        # (each Image or Source is assigned to the block of its first
+        # parameter).
+        lnp = np.zeros(nblocks)
+        subs = []
+        if not self.isParamFrozen('images'):
+            subs.extend(self.images._getActiveSubs())
+        if not self.isParamFrozen('catalog'):
+            subs.extend(self.catalog._getActiveSubs())
+        i0 = 0
+        for sub in subs:
+            n = sub.numberOfParams()
+            if n == 0:
+                continue
+            k = paramblocks[i0]
+            if k >= 0:
+                lnp[k] += sub.getLogPrior()
+            i0 += n
+        return lnp
+
+    def tryBlockUpdates(self, X, paramblocks, allderivs, alphas=None):
+        '''
+        Line search for an update direction *X* whose parameters fall
+        into independent blocks (*paramblocks*: the block number of
+        each parameter, -1 for none) that do not share any pixels, as
+        computed by getUpdateDirection(blocks=True).
+
+        All blocks are stepped together, but the log-prob is split
+        into per-block pieces (chi-squared summed over the pixels
+        touched by the block's derivatives *allderivs*, plus the
+        priors of its sources), so each block gets its own step size
+        alpha and the same early-termination rule as tryUpdates().
+
+        Returns (delta-logprob, alpha), where alpha is an array of the
+        step size taken for each parameter (also when falling back to
+        a single step size).
+        '''
+        if alphas is None:
+            # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
+            alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
+
+        paramblocks = np.asarray(paramblocks)
+        nblocks = max(paramblocks.max() + 1, 0)
+        X = np.asarray(X)
+        p0 = np.array(self.getParams())
+        pBefore = self.getLogProb()
+
+        # Label each pixel with the block whose derivatives touch it.
+        labels = {}
+        for k,param in zip(paramblocks, allderivs):
+            if k < 0:
+                continue
+            for deriv,img in param:
+                if deriv.patch is None:
+                    continue
+                if not img in labels:
+                    labels[img] = np.zeros(img.shape, int) - 1
+                L = labels[img][deriv.getSlice(img)]
+                L[deriv.patch != 0] = k
+
+        def blocklnps():
+            lnp = self._getBlockLogPriors(paramblocks, nblocks)
+            for img,chi in zip(self.images, self.getChiImages()):
+                L = labels.get(img, None)
+                if L is None:
+                    continue
+                lnp -= 0.5 * np.bincount(L.ravel() + 1,
+                                         weights=(chi.astype(float)**2).ravel(),
+                                         minlength=nblocks+1)[1:]
+            return lnp
+
+        lnpBefore = blocklnps()
+        lnpBest = lnpBefore.copy()
+        alphaBest = np.zeros(nblocks)
+        active = np.ones(nblocks, bool)
+        for alpha in alphas:
+            # blocks that have stopped stay at their starting values
+            step = alpha * active[paramblocks] * (paramblocks >= 0)
+            self.setParams(p0 + step * X)
+            lnp = blocklnps()
+            logverb('  Stepping with alpha =', alpha, ':',
+                    np.count_nonzero(active), 'active blocks')
+            bad = np.logical_not(np.isfinite(lnp)) + (lnp < (lnpBest - 1.))
+            better = active * (lnp > lnpBest) * np.logical_not(bad)
+            alphaBest[better] = alpha
+            lnpBest[better] = lnp[better]
+            active[bad] = False
+            if not np.any(active):
+                break
+
+        alpha = alphaBest[paramblocks] * (paramblocks >= 0)
+        self.setParams(p0 + alpha * X)
+        pAfter = self.getLogProb()
+        logmsg('  Block line search: %i blocks, %i took steps;' %
+               (nblocks, np.count_nonzero(alphaBest)),
+               'delta-logprob', pAfter - pBefore)
+        if not (pAfter >= pBefore):
+            # Pixels outside the derivative patches changed after all?
+            logmsg('  Block line search failed; falling back to a single alpha')
+            self.setParams(p0)
+            dlnp,alpha = self.tryUpdates(X, alphas=alphas)
+            alpha = np.zeros(len(p0)) + alpha
+            return dlnp, alpha
+        return pAfter - pBefore, alpha
+
 
     def getDerivs(self):
         '''
@@ -1826,14 +2726,75 @@ class Tractor(MultiParams):
         assert(len(allderivs) == self.numberOfParams())
         return allderivs
 
+    def getSharedParamMap(self):
+        '''
+        Finds parameters that are shared -- that appear more than once
+        in the thawed parameter vector, eg, a PSF object used by
+        several Images.
+
+        Returns (paramindexmap, nunique): the index, among the unique
+        parameters, of each thawed parameter; and the number of
+        unique parameters.
+
+        The map is cached, and only recomputed when the freeze/thaw
+        state or the structure of the Params changes (see
+        ParamLayout).
+        '''
+        layout = self._getLayout()
+        if self.sharedparams is not None and self.sharedparams[0] is layout:
+            return self.sharedparams[1:]
+        p0 = self.getParams()
+        self.setParams(np.arange(len(p0)))
+        p1 = self.getParams()
+        self.setParams(p0)
+        U,I = np.unique(p1, return_inverse=True)
+        logverb(len(p0), 'params;', len(U), 'unique')
+        self.sharedparams = (layout, I, len(U))
+        return I, len(U)
+
     def getUpdateDirection(self, allderivs, damp=0., priors=True,
                            scale_columns=True, scales_only=False,
                            chiImages=None, variance=False,
                            shared_params=True,
                            use_tsnnls=False,
                            use_ceres=False,
-                           get_A_matrix=False):
-
+                           get_A_matrix=False,
+                           matrix_free=False,
+                           use_lsmr=False,
+                           matvec_threads=None,
+                           use_normal_equations=False,
+                           covariance=False,
+                           blocks=False):
+        '''
+        Computes the linearized least-squares update of the thawed
+        parameters, given the derivatives *allderivs* (as returned by
+        getDerivs()).
+
+        If *matrix_free* is True, the sparse derivatives matrix is
+        not built; instead the solver works directly on the
+        derivative Patches (see PatchJacobian), using up to
+        *matvec_threads* threads for the matrix-vector products.
+
+        If *use_lsmr* is True, scipy's LSMR is used instead of LSQR
+        (except when *variance* is requested, which needs LSQR).
+
+        If *use_normal_equations* is True, A^T A and A^T b are formed
+        directly from the derivative Patches and solved by (damped)
+        Cholesky decomposition -- dense if there are at most
+        *Tractor.normal_dense_max* parameters, sparse otherwise.  This
+        is much faster than LSQR for small numbers of parameters.
+        With *covariance* = True, the full parameter covariance
+        matrix is also returned: (X, cov), or (X, var, cov) if
+        *variance* is also set.
+
+        If *blocks* is True, the columns of the (sparse) derivatives
+        matrix are split into connected components -- blocks of
+        parameters that share no pixels, and hence no rows of A --
+        and each block is solved separately with LSQR, in parallel
+        via the multiprocessing pool.  The block number of each
+        parameter (-1 if it has no derivatives) is appended to the
+        return value: X, paramblocks (or X, var, paramblocks).
+        '''
         # allderivs: [
         #    (param0:)  [  (deriv, img), (deriv, img), ... ],
         #    (param1:)  [],
@@ -1861,21 +2822,10 @@ class Tractor(MultiParams):
 
         if shared_params:
             # Find shared parameters
-            p0 = self.getParams()
-            self.setParams(np.arange(len(p0)))
-            p1 = self.getParams()
-            self.setParams(p0)
-            U,I = np.unique(p1, return_inverse=True)
-            logverb(len(p0), 'params;', len(U), 'unique')
-            paramindexmap = I
+            paramindexmap,nunique = self.getSharedParamMap()
             #print 'paramindexmap:', paramindexmap
             #print 'p1:', p1
             
-        # Build the sparse matrix of derivatives:
-        sprows = []
-        spcols = []
-        spvals = []
-
         # Keep track of row offsets for each image.
         imgoffs = {}
         nextrow = 0
@@ -1891,88 +2841,93 @@ class Tractor(MultiParams):
         Ncols = len(allderivs)
 
         # FIXME -- shared_params should share colscales!
-        
         colscales = np.ones(len(allderivs))
-        for col, param in enumerate(allderivs):
-            RR = []
-            VV = []
-            WW = []
-            for (deriv, img) in param:
-                inverrs = img.getInvError()
-                (H,W) = img.shape
-                row0 = imgoffs[img]
-                deriv.clipTo(W, H)
-                pix = deriv.getPixelIndices(img)
-                if len(pix) == 0:
-                    #print 'This param does not influence this image!'
-                    continue
 
-                assert(np.all(pix < img.numberOfPixels()))
-                # (grab non-zero indices)
-                dimg = deriv.getImage()
-                nz = np.flatnonzero(dimg)
-                #print '  source', j, 'derivative', p, 'has', len(nz), 'non-zero entries'
-                if len(nz) == 0:
+        # Build the sparse matrix of derivatives, writing the CSC
+        # arrays directly as we clip each derivative patch.
+        t0 = Time()
+        if use_normal_equations:
+            matrix_free = True
+        else:
+            # only the normal-equations solver computes covariances
+            assert(not covariance)
+        if blocks:
+            # block decomposition needs the explicit CSC matrix
+            assert(not matrix_free)
+            assert(not use_tsnnls)
+        if matrix_free:
+            assert(not use_tsnnls)
+            A = PatchJacobian(imgoffs, Nrows, Ncols, threads=matvec_threads)
+            for col, param in enumerate(allderivs):
+                scale = A.addColumn(col, param)
+                if scale is not None:
+                    colscales[col] = scale
+            if scales_only:
+                return colscales
+            if scale_columns:
+                A.scaleColumns(colscales)
+            logverb('  Patch Jacobian setup:', Time()-t0)
+        else:
+            Abuild = CscBuilder(Nrows, Ncols)
+
+            for col, param in enumerate(allderivs):
+                for (deriv, img) in param:
+                    inverrs = img.getInvError()
+                    (H,W) = img.shape
+                    row0 = imgoffs[img]
+                    deriv.clipTo(W, H)
+                    pix = deriv.getPixelIndices(img)
+                    if len(pix) == 0:
+                        #print 'This param does not influence this image!'
+                        continue
+
+                    assert(np.all(pix < img.numberOfPixels()))
+                    # (grab non-zero indices)
+                    dimg = deriv.getImage()
+                    nz = np.flatnonzero(dimg)
+                    #print '  source', j, 'derivative', p, 'has', len(nz), 'non-zero entries'
+                    if len(nz) == 0:
+                        continue
+                    rows = row0 + pix[nz]
+                    #print 'Adding derivative', deriv.getName(), 'for image', img.name
+                    vals = dimg.flat[nz]
+                    w = inverrs[deriv.getSlice(img)].flat[nz]
+                    assert(vals.shape == w.shape)
+                    Abuild.append(col, rows, vals * w)
+
+                # massage, re-scale, and clean up matrix elements
+                rows,vals = Abuild.getColumn(col)
+                if len(vals) == 0:
                     continue
-                rows = row0 + pix[nz]
-                #print 'Adding derivative', deriv.getName(), 'for image', img.name
-                vals = dimg.flat[nz]
-                w = inverrs[deriv.getSlice(img)].flat[nz]
-                assert(vals.shape == w.shape)
-                if not scales_only:
-                    RR.append(rows)
-                    VV.append(vals)
-                    WW.append(w)
-
-            # massage, re-scale, and clean up matrix elements
-            if len(VV) == 0:
-                continue
-            rows = np.hstack(RR)
-            VV = np.hstack(VV)
-            WW = np.hstack(WW)
-            #vals = np.hstack(VV) * np.hstack(WW)
-            #print 'VV absmin:', np.min(np.abs(VV))
-            #print 'WW absmin:', np.min(np.abs(WW))
-            #print 'VV type', VV.dtype
-            #print 'WW type', WW.dtype
-            vals = VV * WW
-            #print 'vals absmin:', np.min(np.abs(vals))
-            #print 'vals absmax:', np.max(np.abs(vals))
-            #print 'vals type', vals.dtype
-
-            # shouldn't be necessary since we check len(nz)>0 above
-            #if len(vals) == 0:
-            #   continue
-            mx = np.max(np.abs(vals))
-            if mx == 0:
-                logmsg('mx == 0:', len(np.flatnonzero(VV)), 'of', len(VV), 'non-zero derivatives,',
-                       len(np.flatnonzero(WW)), 'of', len(WW), 'non-zero weights;',
-                       len(np.flatnonzero(vals)), 'non-zero products')
-                continue
-            # MAGIC number: near-zero matrix elements -> 0
-            # 'mx' is the max value in this column.
-            FACTOR = 1.e-10
-            I = (np.abs(vals) > (FACTOR * mx))
-            rows = rows[I]
-            vals = vals[I]
-            scale = np.sqrt(np.dot(vals, vals))
-            colscales[col] = scale
-            #logverb('Column', col, 'scale:', scale)
+                mx = np.max(np.abs(vals))
+                if mx == 0:
+                    logmsg('mx == 0:', len(vals), 'non-zero derivatives,',
+                           'all with zero weight')
+                    Abuild.setColumn(col, [], [])
+                    continue
+                # MAGIC number: near-zero matrix elements -> 0
+                # 'mx' is the max value in this column.
+                FACTOR = 1.e-10
+                I = (np.abs(vals) > (FACTOR * mx))
+                if not np.all(I):
+                    Abuild.setColumn(col, rows[I], vals[I])
+                    rows,vals = Abuild.getColumn(col)
+                scale = np.sqrt(np.dot(vals, vals))
+                colscales[col] = scale
+                #logverb('Column', col, 'scale:', scale)
+                if scale_columns and not scales_only:
+                    vals /= scale
+
             if scales_only:
-                continue
+                return colscales
 
-            sprows.append(rows)
-            spcols.append(col)
-            #c = np.empty_like(rows)
-            #c[:] = col
-            #spcols.append(c)
-            if scale_columns:
-                spvals.append(vals / scale)
-            else:
-                spvals.append(vals)
-                
-        if scales_only:
-            return colscales
+            A = Abuild.getMatrix()
+            nnzcol = Abuild.getNnzPerColumn()
+            del Abuild
+            logverb('  Sparse matrix assembly:', Time()-t0)
+            if len(nnzcol):
+                logverb('  Non-zero elements per column: min %i, median %i, max %i' %
+                        (nnzcol.min(), np.median(nnzcol), nnzcol.max()))
 
         b = None
         if priors:
@@ -1984,43 +2939,44 @@ class Tractor(MultiParams):
             # not convinced it's worth the effort right now.
             X = self.getLogPriorDerivatives()
             if X is not None:
+                from scipy.sparse import csc_matrix, vstack
                 rA,cA,vA,pb = X
 
-                sprows.extend([ri + Nrows for ri in rA])
-                spcols.extend(cA)
-                spvals.extend([vi / colscales[ci] for vi,ci in zip(vA,cA)])
                 oldnrows = Nrows
                 nr = listmax(rA, -1) + 1
                 Nrows += nr
                 logverb('Nrows was %i, added %i rows of priors => %i' % (oldnrows, nr, Nrows))
-                # if len(cA) == 0:
-                #     Ncols = 0
-                # else:
-                #     Ncols = 1 + max(cA)
+                if len(rA):
+                    prows = np.hstack(rA)
+                    pcols = np.hstack([np.zeros(len(ri), int) + ci
+                                       for ri,ci in zip(rA, cA)])
+                    pvals = np.hstack([vi / colscales[ci]
+                                       for vi,ci in zip(vA,cA)])
+                    P = csc_matrix((pvals, (prows, pcols)), shape=(nr, Ncols))
+                    if matrix_free:
+                        A.setPriors(P)
+                    else:
+                        A = vstack((A, P), format='csc')
 
                 b = np.zeros(Nrows)
                 b[oldnrows:] = np.hstack(pb)
 
-        if len(spcols) == 0:
-            logverb("len(spcols) == 0")
+        if A.nnz == 0 and (not matrix_free or A.priors is None):
+            logverb("No non-zero derivatives")
             return []
 
-        # 'spcols' has one integer per 'sprows' block.
-        # below we hstack the rows, but before doing that, remember how
-        # many rows are in each chunk.
-        spcols = np.array(spcols)
-        nrowspercol = np.array([len(x) for x in sprows])
-        
         if shared_params:
-            # Apply shared parameter map
-            #print 'Before applying shared parameter map:'
-            #print 'spcols:', len(spcols), 'elements'
-            #print '  ', len(set(spcols)), 'unique'
-            spcols = paramindexmap[spcols]
-            #print 'After:'
-            #print 'spcols:', len(spcols), 'elements'
-            #print '  ', len(set(spcols)), 'unique'
-            Ncols = np.max(spcols) + 1
+            # Apply shared parameter map: sum the columns of shared
+            # parameters.
+            from scipy.sparse import csc_matrix
+            Ncols = nunique
+            if matrix_free:
+                A.setParamMap(paramindexmap, Ncols)
+            elif Ncols < A.shape[1]:
+                S = csc_matrix((np.ones(len(paramindexmap)),
+                                (np.arange(len(paramindexmap)), paramindexmap)),
+                               shape=(A.shape[1], Ncols))
+                A = A.dot(S).tocsc()
             logverb('Set Ncols=', Ncols)
 
         # b = chi
@@ -2059,6 +3015,17 @@ class Tractor(MultiParams):
 
         use_lsqr = True
 
+        if use_normal_equations:
+            use_lsqr = False
+            t0 = Time()
+            X,cov = self._solveNormalEquations(A, b, damp,
+                                               variance or covariance)
+            logmsg('Normal equations: %i cols, %i elements: %s' %
+                   (Ncols, A.nnz, Time()-t0))
+            del A
+            if variance:
+                var = np.diag(cov).copy()
+
         if use_ceres:
             # Solver::Options::linear_solver_type to SPARSE_NORMAL_CHOLESKY 
             pass
@@ -2066,123 +3033,85 @@ class Tractor(MultiParams):
         if use_tsnnls:
             use_lsqr = False
             from tsnnls import tsnnls_lsqr
-            #logmsg('TSNNLS: %i cols (%i unique), %i elements' %
-            #       (Ncols, len(ucols), len(spvals)))
-            print 'spcols:', spcols.shape, spcols.dtype
-            #print 'spvals:', spvals.shape, spvals.dtype
-            print 'spvals:', len(spvals), 'chunks'
-            print '  total', sum(len(x) for x in spvals), 'elements'
-            print 'b:', b.shape, b.dtype
-            #print 'sprows:', sprows.shape, sprows.dtype
-            print 'sprows:', len(sprows), 'chunks'
-            print '  total', sum(len(x) for x in sprows), 'elements'
-
-            ucols,colI = np.unique(spcols, return_inverse=True)
-            J = np.argsort(colI)
-
-            sorted_cols = colI[J]
-            nel = [len(sprows[j]) for j in J]
-            sorted_rows = np.hstack([sprows[j].astype(np.int32) for j in J])
-            sorted_vals = np.hstack([spvals[j] for j in J])
-            #Nelements = sum(len(x) for x in spvals)
-            Nelements = sum(nel)
-            
-            colinds = np.zeros(len(ucols)+1, np.int32)
-            for c,n in zip(sorted_cols, nel):
-                colinds[c+1] += n
-            colinds = np.cumsum(colinds).astype(np.int32)
+
+            # Drop empty columns; the CSC column pointers are exactly
+            # what tsnnls wants.
+            ncol = np.diff(A.indptr)
+            ucols = np.flatnonzero(ncol)
+            colinds = np.append(A.indptr[ucols], A.indptr[-1]).astype(np.int32)
+            sorted_vals = A.data
+            Nelements = A.nnz
             assert(colinds[-1] == Nelements)
-            #colinds = colinds[:-1]
-            
-            # print 'sorted_cols:', sorted_cols
-            # print 'column inds:', colinds
-            # print 'sorted_rows:', sorted_rows
-            # print 'sorted_vals:', sorted_vals
             print 'colinds:', colinds.shape, colinds.dtype
-            print 'rows:', sorted_rows.shape, sorted_rows.dtype
             print 'vals:', sorted_vals.shape, sorted_vals.dtype
 
             # compress b and rows?
-            urows,K = np.unique(sorted_rows, return_inverse=True)
+            urows,K = np.unique(A.indices, return_inverse=True)
             bcomp = b[urows]
             rowcomp = K.astype(np.int32)
 
-            # print 'Compressed rows:', rowcomp
-            # print 'Compressed b:', bcomp
-            # for c,(i0,i1) in enumerate(zip(colinds, colinds[1:])):
-            #     print 'Column', c, 'goes from', i0, 'to', i1
-            #     print 'rows:', rowcomp[i0:i1]
-            #     print 'vals:', sorted_vals[i0:i1]
-            
             nrcomp = len(urows)
             
-            #tsnnls_lsqr(colinds, sorted_rows, sorted_vals,
-            #            b, Nrows, Nelements)
-
             X = tsnnls_lsqr(colinds, rowcomp, sorted_vals,
                             bcomp, nrcomp, Nelements)
             print 'Got TSNNLS result:', X
 
             # Undo the column mappings
             X2 = np.zeros(len(allderivs))
-            #X2[colI] = X
             X2[ucols] = X
             X = X2
             del X2
             
         if use_lsqr:
-            from scipy.sparse import csr_matrix, csc_matrix
-            from scipy.sparse.linalg import lsqr
+            from scipy.sparse.linalg import lsqr, lsmr
 
-            spvals = np.hstack(spvals)
-            assert(np.all(np.isfinite(spvals)))
-    
-            sprows = np.hstack(sprows) # hogg's lovin' hstack *again* here
-            assert(len(sprows) == len(spvals))
-                
-            # For LSQR, expand 'spcols' to be the same length as 'sprows'.
-            cc = np.empty(len(sprows))
-            i = 0
-            for c,n in zip(spcols, nrowspercol):
-                cc[i : i+n] = c
-                i += n
-            spcols = cc
-            assert(i == len(sprows))
-            assert(len(sprows) == len(spcols))
-
-            logverb('  Number of sparse matrix elements:', len(sprows))
-            urows = np.unique(sprows)
-            ucols = np.unique(spcols)
-            logverb('  Unique rows (pixels):', len(urows))
-            logverb('  Unique columns (params):', len(ucols))
-            if len(urows) == 0 or len(ucols) == 0:
-                return []
-            logverb('  Max row:', urows[-1])
-            logverb('  Max column:', ucols[-1])
-            logverb('  Sparsity factor (possible elements / filled elements):', float(len(urows) * len(ucols)) / float(len(sprows)))
+            if matrix_free:
+                J = A
+                A = J.getLinearOperator()
+                nonempty = np.count_nonzero(J.nonempty)
+                logverb('  Number of non-zero derivative pixels:', J.nnz)
+            else:
+                assert(np.all(np.isfinite(A.data)))
+                nonempty = np.count_nonzero(np.diff(A.indptr))
+                logverb('  Number of sparse matrix elements:', A.nnz)
+            if isverbose() and not matrix_free:
+                urows = np.unique(A.indices)
+                ucols = np.flatnonzero(np.diff(A.indptr))
+                logverb('  Unique rows (pixels):', len(urows))
+                logverb('  Unique columns (params):', len(ucols))
+                logverb('  Max row:', urows[-1])
+                logverb('  Max column:', ucols[-1])
+                logverb('  Sparsity factor (possible elements / filled elements):', float(len(urows) * len(ucols)) / float(A.nnz))
             
             # FIXME -- does it make LSQR faster if we remap the row and column
             # indices so that no rows/cols are empty?
     
-            # FIXME -- we could probably construct the CSC matrix ourselves!
-    
-            # Build sparse matrix
-            #A = csc_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
-            A = csr_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
-
             if get_A_matrix:
                 return A
 
+            if blocks:
+                X,var,paramblocks = self._solveBlocks(A, b, damp, variance,
+                                                      use_lsmr)
+                use_lsqr = False
+                del A
+                del b
+
+        if use_lsqr:
             lsqropts = dict(show=isverbose(), damp=damp)
             if variance:
                 lsqropts.update(calc_var=True)
+                if use_lsmr:
+                    logmsg('LSMR cannot compute variances; using LSQR')
+                    use_lsmr = False
     
             # lsqr can trigger floating-point errors
             #np.seterr(all='warn')
             
             # Run lsqr()
-            logmsg('LSQR: %i cols (%i unique), %i elements' %
-                   (Ncols, len(ucols), len(spvals)-1))
+            logmsg('%s: %i cols (%i non-empty), %i elements%s' %
+                   ('LSMR' if use_lsmr else 'LSQR', Ncols, nonempty,
+                    J.nnz if matrix_free else A.nnz,
+                    ' (matrix-free)' if matrix_free else ''))
     
             # print 'A matrix:'
             # print A.todense()
@@ -2191,11 +3120,17 @@ class Tractor(MultiParams):
             # print b
             
             t0 = time.clock()
-            (X, istop, niters, r1norm, r2norm, anorm, acond,
-             arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
+            if use_lsmr:
+                (X, istop, niters, r1norm, arnorm, anorm, acond,
+                 xnorm) = lsmr(A, b, **lsqropts)
+            else:
+                (X, istop, niters, r1norm, r2norm, anorm, acond,
+                 arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
             t1 = time.clock()
-            logmsg('  %.1f seconds' % (t1-t0))
+            logmsg('  %.1f seconds, %i iterations' % (t1-t0, niters))
 
+            if matrix_free:
+                del J
             del A
             del b
     
@@ -2221,6 +3156,8 @@ class Tractor(MultiParams):
             logverb('shared_params: before, X len', len(X), 'with', np.count_nonzero(X), 'non-zero entries')
             logverb('paramindexmap: len', len(paramindexmap), 'range', paramindexmap.min(), paramindexmap.max())
             X = X[paramindexmap]
+            if blocks:
+                paramblocks = paramblocks[paramindexmap]
             logverb('shared_params: after, X len', len(X), 'with', np.count_nonzero(X), 'non-zero entries')
 
         if scale_columns:
@@ -2237,9 +3174,146 @@ class Tractor(MultiParams):
             
             if scale_columns:
                 var /= colscales**2
-            return X,var
 
-        return X
+        rtn = [X]
+        if variance:
+            rtn.append(var)
+        if covariance:
+            if shared_params:
+                cov = cov[np.ix_(paramindexmap, paramindexmap)]
+            if scale_columns:
+                cov /= np.outer(colscales, colscales)
+            rtn.append(cov)
+        if blocks:
+            rtn.append(paramblocks)
+        if len(rtn) == 1:
+            return X
+        return tuple(rtn)
+
+    def _solveBlocks(self, A, b, damp, variance, use_lsmr):
+        '''
+        Solves the least-squares problem A x = b for sparse CSC matrix
+        *A* by splitting the columns into independent blocks
+        (connected components of the column-overlap graph A^T A) and
+        running LSQR (or LSMR) on each block via the multiprocessing
+        pool.
+
+        Returns (X, var, blocks), where *blocks* holds the block
+        number of each column (-1 for empty columns), and *var* is
+        None unless *variance* is set.
+        '''
+        from scipy.sparse import csc_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        t0 = Time()
+        (nrows,ncols) = A.shape
+        # Sparsity pattern; columns that share a pixel are connected.
+        P = csc_matrix((np.ones(A.nnz), A.indices, A.indptr), shape=A.shape)
+        nb,labels = connected_components(P.T.dot(P), directed=False)
+        # Empty columns are isolated vertices; label them -1 and
+        # renumber the rest contiguously.
+        empty = (np.diff(A.indptr) == 0)
+        labels[empty] = -1
+        u,labels[~empty] = np.unique(labels[~empty], return_inverse=True)
+        nb = len(u)
+
+        I = np.argsort(labels, kind='mergesort')
+        splits = np.searchsorted(labels[I], np.arange(nb + 1))
+        args = []
+        blockcols = []
+        for k in range(nb):
+            cols = I[splits[k]:splits[k+1]]
+            Ak = A[:,cols]
+            rows = np.unique(Ak.indices)
+            args.append((Ak[rows,:], b[rows], damp, variance, use_lsmr))
+            blockcols.append(cols)
+        sizes = [len(c) for c in blockcols]
+        logmsg('Block solve: %i blocks of %i..%i columns (%i non-empty total)'
+               % (nb, min(sizes + [0]), max(sizes + [0]), sum(sizes)))
+
+        X = np.zeros(ncols)
+        var = None
+        if variance:
+            var = np.zeros(ncols)
+        for cols,(x,v) in zip(blockcols, self._map(lsqrblock, args)):
+            X[cols] = x
+            if variance:
+                var[cols] = v
+        logmsg('  %s' % (Time()-t0))
+        return X, var, labels
+
+    # Dense normal equations are used for up to this many parameters.
+    normal_dense_max = 1000
+
+    def _solveNormalEquations(self, J, b, damp, wantcov):
+        '''
+        Solves the (damped) normal equations
+          (A^T A + damp^2 I) x = A^T b
+        for the PatchJacobian *J*.  Dense systems are solved by
+        Cholesky decomposition.  scipy has no sparse Cholesky, so
+        sparse systems are factored by SuperLU in symmetric mode
+        (symmetric fill-reducing ordering, diagonal pivots), which for
+        these positive-definite matrices is an LDL^T decomposition.
+        If that factorization is singular, LSQR is used instead.
+
+        Returns (x, covariance), where covariance is None unless
+        *wantcov* is set.
+        '''
+        import scipy.linalg
+
+        N = J.ncols
+        sparse = (N > self.normal_dense_max)
+        ATA,ATb = J.getNormalEquations(b, sparse=sparse)
+        if sparse:
+            diag = ATA.diagonal()
+        else:
+            diag = np.diag(ATA)
+        # Parameters with no derivatives get zero update, as in LSQR.
+        I = np.flatnonzero(diag > 0)
+        X = np.zeros(N)
+        cov = None
+        if wantcov:
+            cov = np.zeros((N,N))
+        if len(I) == 0:
+            return X, cov
+        d2 = damp**2
+
+        if sparse:
+            from scipy.sparse import identity
+            from scipy.sparse.linalg import splu, lsqr
+            M = ATA[I,:][:,I] + d2 * identity(len(I), format='csc')
+            try:
+                lu = splu(M.tocsc(), permc_spec='MMD_AT_PLUS_A',
+                          diag_pivot_thresh=0.,
+                          options=dict(SymmetricMode=True))
+            except RuntimeError:
+                # Degenerate parameters: fall back to LSQR.
+                logmsg('Normal equations are singular; using LSQR')
+                X = lsqr(J.getLinearOperator(), b, damp=damp,
+                         show=isverbose())[0]
+                if wantcov:
+                    cov[np.ix_(I,I)] = np.linalg.pinv(M.toarray())
+                return X, cov
+            X[I] = lu.solve(ATb[I])
+            if wantcov:
+                cov[np.ix_(I,I)] = lu.solve(np.eye(len(I)))
+            return X, cov
+
+        M = ATA[np.ix_(I,I)]
+        M[np.diag_indices(len(I))] += d2
+        try:
+            C = scipy.linalg.cho_factor(M)
+            X[I] = scipy.linalg.cho_solve(C, ATb[I])
+            if wantcov:
+                cov[np.ix_(I,I)] = scipy.linalg.cho_solve(C, np.eye(len(I)))
+        except scipy.linalg.LinAlgError:
+            # Degenerate parameters: fall back to the pseudo-inverse.
+            logmsg('Normal equations are singular; using pseudo-inverse')
+            Minv = np.linalg.pinv(M)
+            X[I] = np.dot(Minv, ATb[I])
+            if wantcov:
+                cov[np.ix_(I,I)] = Minv
+        return X, cov
 
     # def changeInvvar(self, Q2=None):
     #     '''
@@ -2287,11 +3361,14 @@ class Tractor(MultiParams):
         '''
         if _isint(img):
             img = self.getImage(img)
+        if self.incremental and srcs is None and sky:
+            return self._getIncrementalModelImage(img, minsb)
         mod = np.zeros(img.getModelShape(), self.modtype)
         if sky:
             img.sky.addTo(mod)
         if srcs is None:
             srcs = self.catalog
+        self._prefetchPsf(img, srcs)
         for src in srcs:
             patch = self.getModelPatch(img, src, minsb=minsb)
             if patch is None:
@@ -2299,6 +3376,112 @@ class Tractor(MultiParams):
             patch.addTo(mod)
         return mod
 
+    def _prefetchPsf(self, img, srcs):
+        '''
+        For spatially-varying PSFs with a prefetchPsfParams(xs, ys)
+        method (eg, VaryingGaussianPSF), evaluates the PSF at the
+        positions of all *srcs* in *img* in one call.
+        '''
+        fn = getattr(img.getPsf(), 'prefetchPsfParams', None)
+        if fn is None:
+            return
+        wcs = img.getWcs()
+        xs,ys = [],[]
+        for src in srcs:
+            if not hasattr(src, 'getPosition'):
+                continue
+            xy = wcs.positionToPixel(src.getPosition(), src)
+            if xy is None:
+                continue
+            xs.append(xy[0])
+            ys.append(xy[1])
+        if len(xs):
+            fn(xs, ys)
+
+    def enable_roi_likelihood(self, roi_likelihood=True, margin=8):
+        '''
+        Speeds up getLogLikelihood() when only a few sources are
+        thawed: the model of the frozen sources, and the chi-squared
+        of the pixels outside the thawed sources' patch footprints
+        (grown by *margin* pixels), are computed once, and after that
+        only the pixels within the footprints are re-evaluated.
+
+        The cached values are recomputed when the set of thawed
+        sources, the frozen sources' parameters, or any Image
+        parameters change, or when a thawed source's model spills
+        outside the footprints.  (If Image parameters are thawed, the
+        full likelihood is computed.)
+        '''
+        self.roi_likelihood = roi_likelihood
+        self.roi_margin = margin
+        self.roichis = None
+
+    def _getRoiLogLikelihood(self):
+        thawed = list(self.catalog.getThawedSources())
+        frozen = list(self.catalog.getFrozenSources())
+        key = (self.images.getVersion(), [id(s) for s in thawed],
+               [(id(s), s.getVersion()) for s in frozen])
+        if self.roichis is not None and self.roichis[0] == key:
+            chisq = self._getRoiChisq(thawed)
+            if chisq is not None:
+                return -0.5 * chisq
+            logverb('ROI likelihood: model spilled outside the ROI')
+        t0 = Time()
+        self.roichis = (key, [RoiChi(self, img, thawed, frozen, self.roi_margin)
+                              for img in self.images])
+        logverb('ROI likelihood: caching frozen chi-squared:', Time()-t0)
+        chisq = self._getRoiChisq(thawed)
+        # The ROI was built from these very patches.
+        assert(chisq is not None)
+        return -0.5 * chisq
+
+    def _getRoiChisq(self, thawed):
+        chisq = 0.
+        for img,roi in zip(self.images, self.roichis[1]):
+            mod = roi.mod.copy()
+            for src in thawed:
+                if not roi.addPatch(self.getModelPatch(img, src), mod):
+                    return None
+            chi = (roi.data - mod) * roi.inverr
+            chisq += roi.chisq + (chi.astype(float)**2).sum()
+        return chisq
+
+    def _getIncrementalModelImage(self, img, minsb):
+        if minsb is None:
+            minsb = img.modelMinval
+        buf = self.modelbuffers.get(id(img), None)
+        if buf is None or not buf.isValid(img, minsb):
+            buf = ModelImageBuffer(img, minsb)
+            self.modelbuffers[id(img)] = buf
+        mod = buf.mod
+        old = buf.srcs
+        srcs = {}
+        nnew = 0
+        for src in self.catalog:
+            key = id(src)
+            version = src.getVersion()
+            entry = old.pop(key, None)
+            if entry is not None:
+                (s, v, patch) = entry
+                if s is src and v == version:
+                    srcs[key] = entry
+                    continue
+                if patch is not None:
+                    patch.addTo(mod, scale=-1.)
+            patch = self.getModelPatch(img, src, minsb=minsb)
+            if patch is not None:
+                patch.addTo(mod)
+            srcs[key] = (src, version, patch)
+            nnew += 1
+        # Sources that have been removed from the catalog.
+        for (s, v, patch) in old.values():
+            if patch is not None:
+                patch.addTo(mod, scale=-1.)
+        buf.srcs = srcs
+        logverb('Incremental model: re-rendered %i of %i sources, removed %i'
+                % (nnew, len(srcs), len(old)))
+        return mod.astype(self.modtype)
+
     def getOverlappingSources(self, img, srcs=None, minsb=0.):
         from scipy.ndimage.morphology import binary_dilation
         from scipy.ndimage.measurements import label
@@ -2381,7 +3564,8 @@ class Tractor(MultiParams):
         return srcgroups, L, mod
 
     def getModelImages(self):
-        if self.is_multiproc():
+        # (In incremental mode, the model buffers live in this process.)
+        if self.is_multiproc() and not self.incremental:
             # avoid shipping my images...
             allimages = self.getImages()
             self.images = Images()
@@ -2396,6 +3580,7 @@ class Tractor(MultiParams):
 
     def clearCache(self):
         self.cache.clear() # = Cache()
+        self.modelbuffers = {}
 
     def getChiImages(self):
         mods = self.getModelImages()
@@ -2438,6 +3623,10 @@ class Tractor(MultiParams):
         return count
 
     def getLogLikelihood(self):
+        if (self.roi_likelihood and
+            (self.isParamFrozen('images') or
+             self.images.numberOfParams() == 0)):
+            return self._getRoiLogLikelihood()
         chisq = 0.
         for i,chi in enumerate(self.getChiImages()):
             chisq += (chi.astype(float) ** 2).sum()
@@ -19,18 +19,202 @@ from .engine import *
 from .utils import *
 from .cache import *
 
-_galcache = Cache(maxsize=10000)
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+_galcache = Cache(maxsize=None, maxbytes=256*1024*1024, name='galaxy')
 def get_galaxy_cache():
     return _galcache
 
-def set_galaxy_cache_size(N):
+def set_galaxy_cache_size(N=None, maxbytes=256*1024*1024):
+    '''
+    Replaces the galaxy patch cache with one holding at most *N*
+    entries and *maxbytes* bytes (either may be None for no limit).
+    '''
     global _galcache
-    _galcache = Cache(maxsize=N)
+    _galcache = Cache(maxsize=N, maxbytes=maxbytes, name='galaxy')
 
 def disable_galaxy_cache():
     global _galcache
     _galcache = None
 
+# Settings for the shift-invariant unit-flux patch cache; see
+# set_galaxy_cache_phase().
+_galphase = None
+
+def set_galaxy_cache_phase(grid=None, cell=16, shift='linear'):
+    '''
+    Enables (or, with *grid=None*, disables) shift-invariant caching
+    of ProfileGalaxy unit-flux patches.
+
+    Patches are cached keyed on the shape, PSF, WCS and the subpixel
+    phase of the galaxy position, quantized to multiples of *grid*
+    pixels.  A patch cached for a position in the same *cell* x
+    *cell* pixel block (over which the WCS and PSF are assumed
+    constant) is re-used by moving its Patch x0,y0 by the integer
+    offset; the residual shift, at most *grid*/2 pixels in x and y,
+    is applied with a first-order gradient correction
+    (*shift='linear'*; the error is second order in the residual) or
+    with an FFT phase ramp (*shift='fft'*).
+    '''
+    global _galphase
+    if grid is None:
+        _galphase = None
+        return
+    assert(grid > 0. and grid <= 1.)
+    assert(shift in ['linear', 'fft'])
+    _galphase = (float(grid), int(cell), shift)
+
+# Settings and statistics for pruning of PSF-convolved galaxy
+# mixtures; see set_galaxy_mixture_pruning().
+_galprune = None
+_galprune_stats = dict(renders=0, components_in=0, components_out=0,
+                       fluxerr_total=0., fluxerr_max=0.)
+
+def set_galaxy_mixture_pruning(tol=None, merge=True):
+    '''
+    Enables (or, with *tol=None*, disables) pruning of the
+    PSF-convolved mixture of Gaussians before a ProfileGalaxy is
+    rendered; see MixtureOfGaussians.prune().  Components whose flux
+    above the rendering *minval* is below *tol* (as a fraction of the
+    unit flux) are dropped, and, if *merge*, similar components are
+    moment-merged.  The flux discarded is recorded; see
+    get_galaxy_mixture_pruning_stats().
+
+    Clears the galaxy patch cache, since cached patches were rendered
+    with the previous setting.
+    '''
+    global _galprune
+    if tol is None:
+        _galprune = None
+    else:
+        assert(tol >= 0.)
+        _galprune = (float(tol), merge)
+    if _galcache is not None:
+        _galcache.clear()
+    for k in _galprune_stats.keys():
+        _galprune_stats[k] = 0
+
+def get_galaxy_mixture_pruning_stats():
+    '''
+    Returns a dict of the number of pruned renders, the total number
+    of components before and after pruning, and the total and maximum
+    flux error introduced.
+    '''
+    return _galprune_stats.copy()
+
+# Tolerance for multi-resolution rendering; see set_galaxy_multires().
+_galmultires = None
+
+def set_galaxy_multires(tol=None):
+    '''
+    Enables (or, with *tol=None*, disables) multi-resolution rendering
+    of ProfileGalaxy mixtures: broad components are evaluated on a
+    coarser grid, chosen so that interpolating them back to the pixel
+    grid is accurate to *tol* times their peak, and interpolated up;
+    see mixture_profiles.mixture_to_patch().  Clears the galaxy patch
+    cache.
+    '''
+    global _galmultires
+    if tol is not None:
+        assert(tol > 0.)
+        tol = float(tol)
+    _galmultires = tol
+    if _galcache is not None:
+        _galcache.clear()
+
+def _prune_mixture(mix, minval):
+    tol,merge = _galprune
+    pmix,fluxerr = mix.prune(minval=(minval or 0.), tol=tol, merge=merge)
+    st = _galprune_stats
+    st['renders'] += 1
+    st['components_in'] += mix.K
+    st['components_out'] += pmix.K
+    st['fluxerr_total'] += abs(fluxerr)
+    st['fluxerr_max'] = max(st['fluxerr_max'], abs(fluxerr))
+    return pmix
+
+# Threads used by scipy.fft (when available) for the FFTs of galaxies
+# rendered with pixelized PSFs, and the number of galaxies transformed
+# in one stacked FFT by ProfileGalaxy.prefetchUnitFluxModelPatches().
+_galfftworkers = 1
+_galfftbatch = 256
+
+def set_galaxy_fft_threads(workers=1, batch=256):
+    '''
+    Sets the number of threads for galaxy FFTs (used only if
+    scipy.fft is available), and the maximum number of galaxies per
+    stacked inverse FFT.
+    '''
+    global _galfftworkers, _galfftbatch
+    _galfftworkers = workers
+    _galfftbatch = batch
+
+# rfft2 frequency grids, keyed by transform shape
+_fftfreqs = {}
+
+def _fft_freqs(shape):
+    '''
+    Returns the (w,v) rfft2 frequency grids for an array of the given
+    (H,W) *shape*.
+    '''
+    try:
+        return _fftfreqs[shape]
+    except KeyError:
+        pass
+    H,W = shape
+    wv = (np.fft.rfftfreq(W), np.fft.fftfreq(H))
+    _fftfreqs[shape] = wv
+    return wv
+
+def _irfft2(F, shape):
+    '''
+    Inverse real FFT over the last two axes of *F*, which may be a
+    stack of transforms.
+    '''
+    if scipy_fft is not None:
+        return scipy_fft.irfft2(F, s=shape, workers=_galfftworkers)
+    return np.fft.irfft2(F, s=shape)
+
+def _fourier_patch(G, ix0, iy0, x0, x1, y0, y1):
+    '''
+    Returns a Patch of the rendered galaxy *G*, with its pixel (0,0)
+    at *ix0*,*iy0*, clipped to [x0,x1), [y0,y1).
+    '''
+    # Clip down to suggested "halfsize"
+    if x0 > ix0:
+        G = G[:,x0 - ix0:]
+        ix0 = x0
+    if y0 > iy0:
+        G = G[y0 - iy0:, :]
+        iy0 = y0
+    gh,gw = G.shape
+    if gw+ix0 > x1:
+        G = G[:,:x1-ix0]
+    if gh+iy0 > y1:
+        G = G[:y1-iy0,:]
+    return Patch(ix0, iy0, G)
+
+def _shift_patch(patch, dx, dy, shift):
+    '''
+    Returns a copy of Patch *patch* shifted by a (small) subpixel
+    offset *dx*,*dy*.
+    '''
+    G = patch.patch
+    if shift == 'fft':
+        H,W = G.shape
+        F = np.fft.rfft2(G)
+        w = np.fft.rfftfreq(W)[np.newaxis,:]
+        v = np.fft.fftfreq(H)[:,np.newaxis]
+        G = np.fft.irfft2(F * np.exp(-2j * np.pi * (w * dx + v * dy)),
+                          s=(H,W))
+    else:
+        gy,gx = np.gradient(G)
+        G = G - dx * gx - dy * gy
+    return Patch(patch.x0, patch.y0, G)
+
 class GalaxyShape(ParamList):
     '''
     A naive representation of an ellipse (describing a galaxy shape),
@@ -87,6 +271,25 @@ class GalaxyShape(ParamList):
         # (~intermediate world coords)
         return re_deg * np.array([[cp, sp*self.ab], [-sp, cp*self.ab]])
 
+    def getBasisCovarianceDerivatives(self):
+        '''
+        Returns the derivatives of G G^T, where G = getRaDecBasis(),
+        with respect to each of the parameters (re, ab, phi; frozen or
+        not), as a list of 2x2 matrices.
+        '''
+        G = self.getRaDecBasis()
+        phi = np.deg2rad(90 - self.phi)
+        re_deg = max(1./30, self.re) / 3600.
+        cp = np.cos(phi)
+        sp = np.sin(phi)
+        dG = [np.array([[cp, sp*self.ab], [-sp, cp*self.ab]]) / 3600.,
+              re_deg * np.array([[0., sp], [0., cp]]),
+              re_deg * np.array([[-sp, cp*self.ab], [-cp, -sp*self.ab]])
+              * -np.deg2rad(1.)]
+        if self.re < 1./30:
+            dG[0] = np.zeros((2,2))
+        return [np.dot(d, G.T) + np.dot(G, d.T) for d in dG]
+
 
 class Galaxy(MultiParams):
     '''
@@ -290,7 +493,12 @@ class ProfileGalaxy(object):
         if _galcache is None:
             return self._realGetUnitFluxModelPatch(img, px, py, minval,
                                                    extent=extent)
-        
+        if _galphase is not None:
+            ok,patch = self._getShiftedUnitFluxModelPatch(img, px, py, minval,
+                                                          extent)
+            if ok:
+                return patch
+
         deps = self._getUnitFluxDeps(img, px, py)
         try:
             # FIXME -- what about when the extent was specified for
@@ -319,6 +527,56 @@ class ProfileGalaxy(object):
         _galcache.put(deps, (patch,minval))
         return patch
 
+    def _getShiftedUnitFluxModelPatch(self, img, px, py, minval, extent):
+        '''
+        The shift-invariant cache (see set_galaxy_cache_phase()).
+        Returns (ok, patch); ok is False if the cached patch does not
+        cover the requested *extent*.
+        '''
+        grid,cell,shift = _galphase
+        # quantize the position; split into integer pixel and phase
+        qx = np.round(px / grid) * grid
+        qy = np.round(py / grid) * grid
+        ix = int(floor(qx))
+        iy = int(floor(qy))
+        fx = round(qx - ix, 9)
+        fy = round(qy - iy, 9)
+        deps = hash(('unitpatch-phase', self._getUnitFluxDeps(img, fx, fy),
+                     ix // cell, iy // cell))
+        try:
+            (cached,mv,rx,ry) = _galcache.get(deps)
+            if mv > minval:
+                cached = None
+        except KeyError:
+            cached = None
+        if cached is None:
+            # render the whole patch (not clipped to the image), at the
+            # quantized position.
+            rx,ry = ix,iy
+            halfsize = self._getUnitFluxPatchSize(img, rx+fx, ry+fy, minval)
+            rext = [int(floor(rx+fx-halfsize)), int(ceil(rx+fx+halfsize+1)),
+                    int(floor(ry+fy-halfsize)), int(ceil(ry+fy+halfsize+1))]
+            cached = self._realGetUnitFluxModelPatch(img, rx+fx, ry+fy,
+                                                     minval, extent=rext)
+            if cached is None or cached.patch is None:
+                return False,None
+            cached = cached.copy()
+            _galcache.put(deps, (cached,minval,rx,ry))
+
+        patch = _shift_patch(cached, px - qx, py - qy, shift)
+        patch.x0 += ix - rx
+        patch.y0 += iy - ry
+        if extent is None:
+            extent = [0, img.getWidth(), 0, img.getHeight()]
+        else:
+            (x0,x1,y0,y1) = extent
+            (cx0,cx1,cy0,cy1) = patch.getExtent()
+            if cx0 > x0 or cx1 < x1 or cy0 > y0 or cy1 < y1:
+                return False,None
+        if not patch.clipToRoi(*extent):
+            return True,None
+        return True,patch
+
     def getUnitFluxModelPatches(self, img, minval=0.):
         return [self.getUnitFluxModelPatch(img, minval=minval)]
 
@@ -331,20 +589,14 @@ class ProfileGalaxy(object):
         halfsize = self._getUnitFluxPatchSize(img, px, py, minval)
 
         if extent is None:
-            # find overlapping pixels to render
-            (outx, inx) = get_overlapping_region(
-                int(floor(px-halfsize)), int(ceil(px+halfsize+1)),
-                0, img.getWidth())
-            (outy, iny) = get_overlapping_region(
-                int(floor(py-halfsize)), int(ceil(py+halfsize+1)),
-                0, img.getHeight())
-            if inx == [] or iny == []:
+            extent = self._getPatchExtent(img, px, py, halfsize)
+            if extent is None:
                 # no overlap
                 return None
-            x0,x1 = outx.start, outx.stop
-            y0,y1 = outy.start, outy.stop
+            exact = False
         else:
-            x0,x1,y0,y1 = extent
+            exact = True
+        x0,x1,y0,y1 = extent
         psf = img.getPsf()
 
         # We have two methods of rendering profile galaxies: If the
@@ -360,48 +612,233 @@ class ProfileGalaxy(object):
             # now convolve with the PSF, analytically
             psfmix = psf.getMixtureOfGaussians(px=px, py=py)
             cmix = amix.convolve(psfmix)
+            if _galprune is not None:
+                cmix = _prune_mixture(cmix, minval)
             #print '_realGetUnitFluxModelPatch: extent', x0,x1,y0,y1
             return mp.mixture_to_patch(cmix, x0, x1, y0, y1, minval,
-                                       exactExtent=(extent is not None))
+                                       exactExtent=exact,
+                                       multires=_galmultires)
         else:
-            P,(px0,py0),(pH,pW) = psf.getFourierTransform(halfsize)
-            w = np.fft.rfftfreq(pW)
-            v = np.fft.fftfreq(pH)
-
-            dx = px - px0
-            dy = py - py0
-            # Put the integer portion of the offset into Patch x0,y0
-            ix0 = int(np.round(dx))
-            iy0 = int(np.round(dy))
-            # Put the subpixel portion into the galaxy FFT.
-            mux = dx - ix0
-            muy = dy - iy0
-
-            amix = self._getAffineProfile(img, mux, muy)
-            Fsum = amix.getFourierTransform(w, v)
-                
+            F,shape,ix0,iy0 = self._getFourierModel(img, px, py, halfsize)
             # FIXME -- could adjust the ifft shape...
-            G = np.fft.irfft2(Fsum * P, s=(pH,pW))
-            # Clip down to suggested "halfsize"
-            if x0 > ix0:
-                G = G[:,x0 - ix0:]
-                ix0 = x0
-            if y0 > iy0:
-                G = G[y0 - iy0:, :]
-                iy0 = y0
-            gh,gw = G.shape
-            if gw+ix0 > x1:
-                G = G[:,:x1-ix0]
-            if gh+iy0 > y1:
-                G = G[:y1-iy0,:]
-            return Patch(ix0, iy0, G)
+            G = _irfft2(F, shape)
+            return _fourier_patch(G, ix0, iy0, x0, x1, y0, y1)
+
+    def _getPatchExtent(self, img, px, py, halfsize):
+        '''
+        Returns the [x0,x1), [y0,y1) range of pixels in *img* within
+        *halfsize* of *px*,*py*, as (x0,x1,y0,y1), or None if there
+        are none.
+        '''
+        (outx, inx) = get_overlapping_region(
+            int(floor(px-halfsize)), int(ceil(px+halfsize+1)),
+            0, img.getWidth())
+        (outy, iny) = get_overlapping_region(
+            int(floor(py-halfsize)), int(ceil(py+halfsize+1)),
+            0, img.getHeight())
+        if inx == [] or iny == []:
+            return None
+        return (outx.start, outx.stop, outy.start, outy.stop)
+
+    def _getFourierModel(self, img, px, py, halfsize):
+        '''
+        For pixelized PSFs: returns (F, shape, ix0, iy0), the product
+        of the galaxy and PSF Fourier transforms, the shape of the
+        inverse transform, and the pixel position of its (0,0) pixel.
+        '''
+        P,(px0,py0),shape = img.getPsf().getFourierTransform(halfsize)
+        w,v = _fft_freqs(shape)
+
+        dx = px - px0
+        dy = py - py0
+        # Put the integer portion of the offset into Patch x0,y0
+        ix0 = int(np.round(dx))
+        iy0 = int(np.round(dy))
+        # Put the subpixel portion into the galaxy FFT.
+        mux = dx - ix0
+        muy = dy - iy0
+
+        amix = self._getAffineProfile(img, mux, muy)
+        Fsum = amix.getFourierTransform(w, v)
+        return Fsum * P, shape, ix0, iy0
+
+    @staticmethod
+    def prefetchUnitFluxModelPatches(img, srcs, minvals):
+        '''
+        Renders the unit-flux patches in *img* of the ProfileGalaxy
+        sources *srcs* (with the given *minvals*) that use a pixelized
+        PSF, doing one stacked inverse FFT for each group that shares
+        a transform size, and stores them in the galaxy cache, so that
+        the getUnitFluxModelPatch() calls that follow are cache hits.
+        '''
+        psf = img.getPsf()
+        if (_galcache is None or _galphase is not None or
+            hasattr(psf, 'getMixtureOfGaussians')):
+            return
+        wcs = img.getWcs()
+        groups = {}
+        for src,minval in zip(srcs, minvals):
+            (px,py) = wcs.positionToPixel(src.getPosition(), src)
+            deps = src._getUnitFluxDeps(img, px, py)
+            try:
+                (cached,mv) = _galcache.get(deps)
+                if mv <= minval:
+                    continue
+            except KeyError:
+                pass
+            halfsize = src._getUnitFluxPatchSize(img, px, py, minval)
+            extent = src._getPatchExtent(img, px, py, halfsize)
+            if extent is None:
+                _galcache.put(deps, (None, minval))
+                continue
+            F,shape,ix0,iy0 = src._getFourierModel(img, px, py, halfsize)
+            groups.setdefault(shape, []).append(
+                (deps, minval, extent, F, ix0, iy0))
+
+        for shape,items in groups.items():
+            for i in range(0, len(items), _galfftbatch):
+                batch = items[i: i + _galfftbatch]
+                G = _irfft2(np.array([b[3] for b in batch]), shape)
+                for g,(deps,minval,extent,F,ix0,iy0) in zip(G, batch):
+                    patch = _fourier_patch(g, ix0, iy0, *extent)
+                    _galcache.put(deps, (patch.copy(), minval))
                     
 
 class HoggGalaxy(ProfileGalaxy, Galaxy):
 
+    # Compute position and shape derivatives analytically, when
+    # possible; see _getAnalyticParamDerivatives().
+    analyticDerivatives = True
+
     def getName(self):
         return 'HoggGalaxy'
 
+    def getParamDerivatives(self, img):
+        derivs = None
+        if self.analyticDerivatives:
+            derivs = self._getAnalyticParamDerivatives(img)
+        if derivs is None:
+            derivs = super(HoggGalaxy, self).getParamDerivatives(img)
+        return derivs
+
+    def _getAnalyticParamDerivatives(self, img):
+        '''
+        Computes the derivatives with respect to position and shape
+        analytically, in the same pass that renders the model: the
+        derivatives of the convolved mixture's component means (from
+        the WCS) and covariances (from the shape's
+        getBasisCovarianceDerivatives() and the CD matrix) are pushed
+        through c_gauss_2d_approx3.  (The variation of the CD matrix
+        and PSF with position is ignored.)
+
+        Returns None if this is not possible (eg, pixelized PSFs), in
+        which case the finite-difference Galaxy.getParamDerivatives()
+        should be used.
+        '''
+        psf = img.getPsf()
+        if not (hasattr(psf, 'getMixtureOfGaussians') and
+                hasattr(self.shape, 'getBasisCovarianceDerivatives')):
+            return None
+        galmix = self.getProfile()
+        gv = galmix.var
+        # we need circular profile components
+        if not (np.all(gv[:,0,1] == 0) and np.all(gv[:,1,0] == 0) and
+                np.all(gv[:,0,0] == gv[:,1,1])):
+            return None
+
+        wcs = img.getWcs()
+        pos0 = self.getPosition()
+        (px0,py0) = wcs.positionToPixel(pos0, self)
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        minsb = img.modelMinval
+        if counts > 0:
+            minval = minsb / counts
+        else:
+            minval = 0.
+
+        halfsize = self._getUnitFluxPatchSize(img, px0, py0, minval)
+        (outx, inx) = get_overlapping_region(
+            int(floor(px0-halfsize)), int(ceil(px0+halfsize+1)),
+            0, img.getWidth())
+        (outy, iny) = get_overlapping_region(
+            int(floor(py0-halfsize)), int(ceil(py0+halfsize+1)),
+            0, img.getHeight())
+        if inx == [] or iny == []:
+            return [None] * self.numberOfParams()
+        x0,x1 = outx.start, outx.stop
+        y0,y1 = outy.start, outy.stop
+
+        amix = self._getAffineProfile(img, px0, py0)
+        psfmix = psf.getMixtureOfGaussians(px=px0, py=py0)
+        cmix = amix.convolve(psfmix)
+
+        # Pixel-space derivatives of the positions...
+        dpix = []
+        dopos = (not self.isParamFrozen('pos')) and counts != 0
+        if dopos:
+            psteps = pos0.getStepSizes()
+            params = pos0.getParams()
+            for i,pstep in enumerate(psteps):
+                oldval = pos0.setParam(i, params[i]+pstep)
+                (px,py) = wcs.positionToPixel(pos0, self)
+                pos0.setParam(i, oldval)
+                dpix.append(((px - px0) / pstep, (py - py0) / pstep))
+        # ... and of the profile covariance (per unit profile variance).
+        dcov = []
+        doshape = (not self.isParamFrozen('shape')) and counts != 0
+        if doshape:
+            cdi = np.linalg.inv(wcs.cdAtPixel(px0, py0))
+            dS = self.shape.getBasisCovarianceDerivatives()
+            for i in self.shape.getThawedParamIndices():
+                dcov.append(np.dot(cdi, np.dot(dS[i], cdi.T)))
+
+        # Derivatives of the convolved mixture's components; "convolve"
+        # puts the PSF components in the outer loop.
+        P = len(dpix) + len(dcov)
+        dmean = np.zeros((cmix.K, P, 2))
+        dvar = np.zeros((cmix.K, P, 2, 2))
+        for i,d in enumerate(dpix):
+            dmean[:,i,:] = d
+        v = np.tile(gv[:,0,0], psfmix.K)[:,np.newaxis,np.newaxis]
+        for i,d in enumerate(dcov):
+            dvar[:,len(dpix)+i,:,:] = v * d
+
+        R = cmix.evaluate_grid_approx3(x0, x1, y0, y1, 0., 0., minval,
+                                       dparams=(dmean, dvar))
+        if R is None:
+            return None
+        patch0,dpatches = R
+
+        derivs = []
+        if not self.isParamFrozen('pos'):
+            if counts == 0:
+                derivs.extend([None] * pos0.numberOfParams())
+            for i in range(len(dpix)):
+                dx = dpatches[i] * counts
+                dx.setName('d(%s)/d(pos%i)' % (self.dname, i))
+                derivs.append(dx)
+
+        if not self.isParamFrozen('brightness'):
+            bsteps = self.brightness.getStepSizes()
+            params = self.brightness.getParams()
+            for i,bstep in enumerate(bsteps):
+                oldval = self.brightness.setParam(i, params[i] + bstep)
+                countsi = img.getPhotoCal().brightnessToCounts(self.brightness)
+                self.brightness.setParam(i, oldval)
+                df = patch0 * ((countsi - counts) / bstep)
+                df.setName('d(%s)/d(bright%i)' % (self.dname, i))
+                derivs.append(df)
+
+        if not self.isParamFrozen('shape'):
+            gnames = self.shape.getParamNames()
+            if counts == 0:
+                derivs.extend([None] * len(gnames))
+            for i in range(len(dcov)):
+                dx = dpatches[len(dpix)+i] * counts
+                dx.setName('d(%s)/d(%s)' % (self.dname, gnames[i]))
+                derivs.append(dx)
+        return derivs
+
     def copy(self):
         return HoggGalaxy(self.pos.copy(), self.brightness.copy(),
                           self.shape.copy())
@@ -35,15 +35,25 @@ static double eval_all(int K, double* scales, double* I, double* means,
     return r;
 }
 
+// If "dres" is not NULL, also computes the derivatives of the mixture
+// with respect to P parameters, given the derivatives of the
+// component means ("dmean", K x P x 2) and of the symmetrized
+// component covariances ("dvar", K x P x 3: xx, xy, yy).  The
+// derivative with respect to parameter p is written to
+// dres[p * dstride].
 static double eval_all_dxy(int K, double* scales, double* I, double* means,
                            double x, double y, double* xderiv, double* yderiv,
-                           double* maxD) {
+                           double* maxD, int P, double* dmean, double* dvar,
+                           double* dres, int dstride) {
     double r = 0;
-    int k;
+    int k, p;
     if (xderiv)
         *xderiv = 0;
     if (yderiv)
         *yderiv = 0;
+    if (dres)
+        for (p=0; p<P; p++)
+            dres[p * dstride] = 0;
 
     for (k=0; k<K; k++) {
         double dx,dy;
@@ -68,6 +78,24 @@ static double eval_all_dxy(int K, double* scales, double* I, double* means,
             *xderiv += -G * (2. * Ik[0] * dx + Ik[1] * dy);
         if (yderiv)
             *yderiv += -G * (2. * Ik[2] * dy + Ik[1] * dx);
+        if (dres) {
+            // Undo the scaling of I to get the inverse covariance
+            double iv0 = -2. * Ik[0];
+            double iv1 = -Ik[1];
+            double iv2 = -2. * Ik[2];
+            // u = inverse covariance * (pixel - mean)
+            double u0 = iv0 * dx + iv1 * dy;
+            double u1 = iv1 * dx + iv2 * dy;
+            double* dm = dmean + 2*P*k;
+            double* dv = dvar  + 3*P*k;
+            // dG/dmean = G u
+            // dG/dvar  = G/2 (u u^T - inverse covariance)
+            for (p=0; p<P; p++)
+                dres[p * dstride] += G * (u0 * dm[2*p] + u1 * dm[2*p+1] +
+                                          0.5 * ((u0*u0 - iv0) * dv[3*p] +
+                                                 2. * (u0*u1 - iv1) * dv[3*p+1] +
+                                                 (u1*u1 - iv2) * dv[3*p+2]));
+        }
     }
     return r;
 }
@@ -997,6 +1025,9 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                               PyObject* ob_xderiv,
                               PyObject* ob_yderiv,
                               PyObject* ob_mask,
+                              PyObject* ob_dmean,
+                              PyObject* ob_dvar,
+                              PyObject* ob_dresult,
                               int xc, int yc,
                               int minradius,
                               int* p_sx0, int* p_sx1, int* p_sy0, int* p_sy1
@@ -60,18 +60,46 @@ class MixtureOfGaussians():
 
     def set_var(self, var):
         if var.size == self.K:
-            self.var = np.zeros((self.K, self.D, self.D))
-            for d in range(self.D):
-                self.var[:,d,d] = var
+            self.var = (np.ravel(var).astype(float)[:,np.newaxis,np.newaxis] *
+                        np.eye(self.D)[np.newaxis,:,:])
         else:
             self.var = np.array(var).astype(float)
 
     def symmetrize(self):
-        for i in range(self.D):
-            for j in range(i):
-                tmpij = 0.5 * (self.var[:,i,j] + self.var[:,j,i])
-                self.var[:,i,j] = tmpij
-                self.var[:,j,i] = tmpij
+        self.var[:] = 0.5 * (self.var + self.var.transpose(0,2,1))
+
+    def update(self):
+        '''
+        Discards the stored inverse variances and determinants; call
+        this after modifying *var* in place.
+        '''
+        self.__dict__.pop('ivar', None)
+        self.__dict__.pop('det', None)
+
+    def __getattr__(self, name):
+        # The inverse variances *ivar*, shape (K,D,D), and
+        # determinants *det*, shape (K,), of the components are
+        # computed on first use and stored.
+        if name not in ['ivar', 'det']:
+            raise AttributeError(name)
+        V = self.var
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.D == 2:
+                a,b,c,d = V.reshape((self.K, 4)).T
+                det = a*d - b*c
+                ivar = (np.array([d, -b, -c, a]) / det).T.reshape(V.shape)
+            elif self.D == 1:
+                det = V[:,0,0]
+                ivar = 1. / V
+            else:
+                det = np.linalg.det(V)
+                try:
+                    ivar = np.linalg.inv(V)
+                except np.linalg.LinAlgError:
+                    ivar = np.zeros_like(V) + np.nan
+        self.det = det
+        self.ivar = ivar
+        return getattr(self, name)
 
     # very harsh testing, and expensive
     def test(self):
@@ -98,6 +126,7 @@ class MixtureOfGaussians():
         assert(self.amp.shape  == (self.K,))
         assert(self.mean.shape == (self.K, self.D))
         assert(self.var.shape  == (self.K, self.D, self.D))
+        self.update()
         
     def __add__(self, other):
         assert(self.D == other.D)
@@ -121,9 +150,8 @@ class MixtureOfGaussians():
         assert(shift.shape == (self.D,))
         assert(scale.shape == (self.D, self.D))
         newmean = self.mean + shift
-        newvar = np.zeros_like(self.var)
-        for k in range(self.K):
-            newvar[k,:,:] = np.dot(scale.T, np.dot(self.var[k,:,:], scale))
+        # scale^T var[k] scale for each component
+        newvar = np.matmul(scale.T, np.matmul(self.var, scale))
         return MixtureOfGaussians(self.amp.copy(), newmean, newvar)
 
     # dstn: should this be called "correlate"?
@@ -131,52 +159,82 @@ class MixtureOfGaussians():
         assert(self.D == other.D)
         newK = self.K * other.K
         D = self.D
-        newamp = np.zeros((newK))
-        newmean = np.zeros((newK, D))
-        newvar = np.zeros((newK, D, D))
-        newk = 0
-        for k in range(other.K):
-            nextnewk = newk + self.K
-            newamp[newk:nextnewk] = self.amp * other.amp[k]
-            newmean[newk:nextnewk,:] = self.mean + other.mean[k]
-            newvar[newk:nextnewk,:,:] = self.var + other.var[k]
-            newk = nextnewk
+        # components ordered with *other*'s index varying slowest
+        newamp = (other.amp[:,np.newaxis] * self.amp[np.newaxis,:]).ravel()
+        newmean = (other.mean[:,np.newaxis,:] +
+                   self.mean[np.newaxis,:,:]).reshape((newK, D))
+        newvar = (other.var[:,np.newaxis,:,:] +
+                  self.var[np.newaxis,:,:,:]).reshape((newK, D, D))
         return MixtureOfGaussians(newamp, newmean, newvar)
 
+    def prune(self, minval=0., tol=1e-3, merge=True):
+        '''
+        Returns (mixture, fluxerr): a mixture with (usually) fewer
+        components approximating this one, and the flux (sum of
+        amplitudes) that was discarded.
+
+        Components whose flux in pixels above *minval* (the level at
+        which rendering stops) is below *tol* times the total are
+        dropped.  Then, if *merge*, the pair of components with the
+        smallest Runnalls upper bound on the discrepancy introduced by
+        replacing them by their moment-matched merger is merged,
+        while that bound is below *tol* times the total.  Merging
+        conserves flux.
+        '''
+        assert(self.D == 2)
+        amp,mean,var = self.amp, self.mean, self.var
+        total = np.sum(np.abs(amp))
+        if total == 0:
+            return self, 0.
+        det = self.det
+        # flux of each component in the pixels where it is > minval
+        above = np.maximum(0., np.abs(amp) - minval * 2.*np.pi*np.sqrt(det))
+        keep = (above >= tol * total)
+        if not np.any(keep):
+            keep[np.argmax(above)] = True
+        fluxerr = np.sum(amp[np.logical_not(keep)])
+        amp,mean,var = amp[keep], mean[keep], var[keep]
+
+        if merge and np.all(amp > 0):
+            while len(amp) > 1:
+                I,J = np.triu_indices(len(amp), 1)
+                a,m,v = _merge_moments(amp[I], mean[I], var[I],
+                                       amp[J], mean[J], var[J])
+                logdet = np.log(var[:,0,0] * var[:,1,1] -
+                                var[:,0,1] * var[:,1,0])
+                cost = 0.5 * (a * np.log(v[:,0,0] * v[:,1,1] -
+                                         v[:,0,1] * v[:,1,0])
+                              - amp[I] * logdet[I] - amp[J] * logdet[J])
+                k = np.argmin(cost)
+                if cost[k] > tol * total:
+                    break
+                i,j = I[k],J[k]
+                amp[i],mean[i],var[i] = a[k], m[k], v[k]
+                amp,mean,var = [np.delete(x, j, axis=0)
+                                for x in (amp, mean, var)]
+        if len(amp) == self.K:
+            return self, fluxerr
+        return MixtureOfGaussians(amp, mean, var), fluxerr
+
     def getFourierTransform(self, w, v, use_mp_fourier=True):
         if mp_fourier and use_mp_fourier:
             f = mp_fourier.mixture_profile_fourier_transform(
                 self.amp, self.mean, self.var, w, v)
             return f
 
-        Fsum = None
-
-        if not hasattr(self, 'ivar'):
-            self.ivar = np.zeros((self.K, self.D, self.D))
-            for k in range(self.K):
-                self.ivar[k,:,:] = np.linalg.inv(self.var[k,:,:])
-
-        for k in range(self.K):
-            #V = self.var[k,:,:]
-            #iv = np.linalg.inv(V)
-            iv = self.ivar[k,:,:]
-            mu = self.mean[k,:]
-            amp = self.amp[k]
-            a,b,d = 0.5 * iv[0,0], 0.5 * iv[0,1], 0.5 * iv[1,1]
-            det = a*d - b**2
-            F = (np.exp(-np.pi**2/det *
-                        (a * v[:,np.newaxis]**2 +
-                         d * w[np.newaxis,:]**2 -
-                         2*b*v[:,np.newaxis]*w[np.newaxis,:]))
-                         * np.exp(-2.*np.pi* 1j *(mu[0]*w[np.newaxis,:] + 
-                                                  mu[1]*v[:,np.newaxis])))
-
-            if Fsum is None:
-                Fsum = amp * F
-            else:
-                Fsum += amp * F
-
-        return Fsum        
+        # all components at once: arrays of shape (K, len(v), len(w))
+        iv = self.ivar
+        a = 0.5 * iv[:,0,0][:,np.newaxis,np.newaxis]
+        b = 0.5 * iv[:,0,1][:,np.newaxis,np.newaxis]
+        d = 0.5 * iv[:,1,1][:,np.newaxis,np.newaxis]
+        det = a*d - b**2
+        mux = self.mean[:,0][:,np.newaxis,np.newaxis]
+        muy = self.mean[:,1][:,np.newaxis,np.newaxis]
+        vv = v[np.newaxis,:,np.newaxis]
+        ww = w[np.newaxis,np.newaxis,:]
+        F = np.exp(-np.pi**2/det * (a * vv**2 + d * ww**2 - 2*b*vv*ww)
+                   - 2.*np.pi* 1j *(mux*ww + muy*vv))
+        return np.einsum('k,kij->ij', self.amp, F)
     
     # ideally pos is a numpy array shape (N, self.D)
     # returns a numpy array shape (N)
@@ -193,9 +251,9 @@ class MixtureOfGaussians():
             # pos is (N, D)
             # mean[k] is (D,)
             dpos = pos - self.mean[k]
-            dsq = np.sum(dpos * np.dot(dpos, np.linalg.inv(self.var[k])), axis=1)
+            dsq = np.sum(dpos * np.dot(dpos, self.ivar[k]), axis=1)
             I = (dsq < 700)
-            result[I] += (self.amp[k] / np.sqrt(twopitotheD * np.linalg.det(self.var[k]))) * np.exp(-0.5 * dsq[I])
+            result[I] += (self.amp[k] / np.sqrt(twopitotheD * self.det[k])) * np.exp(-0.5 * dsq[I])
         return result
 
     def evaluate_1(self, pos):
@@ -207,9 +265,9 @@ class MixtureOfGaussians():
         twopitotheD = (2.*np.pi)**self.D
         result = np.zeros(N)
         for k in range(self.K):
-            dsq = scp.cdist(pos, self.mean[np.newaxis, k], 'mahalanobis', VI=np.linalg.inv(self.var[k]))[:,0]**2
+            dsq = scp.cdist(pos, self.mean[np.newaxis, k], 'mahalanobis', VI=self.ivar[k])[:,0]**2
             I = (dsq < 700)
-            result[I] += (self.amp[k] / np.sqrt(twopitotheD * np.linalg.det(self.var[k]))) * np.exp(-0.5 * dsq[I])
+            result[I] += (self.amp[k] / np.sqrt(twopitotheD * self.det[k])) * np.exp(-0.5 * dsq[I])
         return result
 
     def evaluate_2(self, pos):
@@ -261,7 +319,7 @@ class MixtureOfGaussians():
 
     def evaluate_grid_approx3(self, x0, x1, y0, y1, fx, fy, minval,
                               derivs=False, minradius=3, doslice=True,
-                              maxmargin=100):
+                              maxmargin=100, dparams=None):
         '''
         minval: small value at which to stop evaluating
 
@@ -276,6 +334,13 @@ class MixtureOfGaussians():
         bounding-box.
 
         If 'derivs' is True, computes and returns x and y derivatives too.
+
+        If 'dparams' is not None, it must be a tuple (dmean, dvar) of
+        the derivatives of the component means, shape (K,P,2), and
+        covariances, shape (K,P,2,2), with respect to P parameters;
+        the derivatives of the rendered mixture with respect to those
+        parameters are computed in the same pass and returned as a
+        list of P Patches, after the x and y derivatives (if any).
         
         Unlike evaluate_grid_approx, returns a Patch object.
         '''
@@ -283,9 +348,13 @@ class MixtureOfGaussians():
 
         result = np.zeros((y1-y0, x1-x0))
         xderiv = yderiv = mask = None
+        dmean = dvar = dresult = None
         if derivs:
             xderiv = np.zeros_like(result)
             yderiv = np.zeros_like(result)
+        if dparams is not None:
+            dmean,dvar = dparams
+            dresult = np.zeros((dmean.shape[1],) + result.shape)
 
         # guess:
         cx = int(self.mean[0,0] + fx)
@@ -301,6 +370,7 @@ class MixtureOfGaussians():
                 float(fx), float(fy), float(minval),
                 self.amp, self.mean, self.var,
                 result, xderiv, yderiv, mask,
+                dmean, dvar, dresult,
                 cx, cy, int(minradius))
         except:
             print 'failure calling c_gauss_2d_approx3:'
@@ -318,14 +388,20 @@ class MixtureOfGaussians():
             if derivs:
                 xderiv = xderiv[slc].copy()
                 yderiv = yderiv[slc].copy()
+            if dresult is not None:
+                dresult = dresult[(slice(None),) + slc].copy()
             x0 += sx0
             y0 += sy0
 
+        rtn = Patch(x0,y0,result)
         if derivs:
-            return (Patch(x0,y0,result), Patch(x0,y0,xderiv),
-                    Patch(x0,y0,yderiv))
-
-        return Patch(x0,y0,result)
+            rtn = (rtn, Patch(x0,y0,xderiv), Patch(x0,y0,yderiv))
+        if dresult is not None:
+            dpatches = [Patch(x0,y0,d) for d in dresult]
+            if derivs:
+                return rtn + (dpatches,)
+            return rtn, dpatches
+        return rtn
     
     def evaluate_grid_hogg(self, xlo, xhi, ylo, yhi):
         assert(self.D == 2)
@@ -339,13 +415,140 @@ class MixtureOfGaussians():
     #evaluate_grid = evaluate_grid_hogg
     evaluate_grid = evaluate_grid_dstn
 
-def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False):
+def _merge_moments(a1, m1, v1, a2, m2, v2):
+    '''
+    Moment-matched merger of (arrays of) pairs of Gaussian components:
+    amplitudes *a*, means *m* (N,2) and covariances *v* (N,2,2).
+    '''
+    a = a1 + a2
+    w1 = (a1 / a)[:,np.newaxis]
+    w2 = (a2 / a)[:,np.newaxis]
+    m = w1 * m1 + w2 * m2
+    d = m1 - m2
+    v = (w1[:,:,np.newaxis] * v1 + w2[:,:,np.newaxis] * v2 +
+         (w1 * w2)[:,:,np.newaxis] * d[:,:,np.newaxis] * d[:,np.newaxis,:])
+    return a, m, v
+
+def multires_factors(mixture, tol, maxfactor=16):
+    '''
+    Returns the sampling factor, a power of two up to *maxfactor*, at
+    which each component of *mixture* can be evaluated and
+    interpolated back to the pixel grid (see
+    _mixture_to_patch_multires) with an error below *tol* times its
+    peak value.
+
+    For a Gaussian of width sigma sampled every s pixels the 4-point
+    cubic interpolation error is about 0.07 (s/sigma)^4 of the peak;
+    sigma is that of the narrowest direction of each component.
+    '''
+    V = mixture.var
+    a,b,d = V[:,0,0], V[:,0,1], V[:,1,1]
+    minvar = 0.5 * (a + d) - np.sqrt(0.25 * (a - d)**2 + b**2)
+    smax = np.sqrt(np.maximum(minvar, 0.)) * (tol / 0.07)**0.25
+    smax = np.clip(smax, 1., maxfactor)
+    return (2**np.floor(np.log2(smax))).astype(int)
+
+def _upsample2(A):
+    '''
+    Upsamples 2-d array *A* by a factor of 2 along both axes with
+    4-point cubic interpolation; result[2i,2j] = A[i,j].
+    '''
+    for axis in [0, 1]:
+        A = np.swapaxes(A, 0, axis)
+        E = np.concatenate([A[:1], A, A[-1:], A[-1:]])
+        U = np.empty((2 * len(A),) + A.shape[1:])
+        U[0::2] = A
+        U[1::2] = (9. * (E[1:-2] + E[2:-1]) - E[:-3] - E[3:]) / 16.
+        A = np.swapaxes(U, 0, axis)
+    return A
+
+def _mixture_to_patch_multires(mixture, x0, x1, y0, y1, minval, exactExtent,
+                               tol):
+    '''
+    Multi-resolution version of mixture_to_patch.  Components are
+    grouped by their multires_factors() s.  Starting from the largest
+    s, each group is evaluated on a grid s times coarser than the
+    pixels, added to the upsampled sum of the coarser levels, and the
+    total upsampled by 2 to the next level; components with s = 1 are
+    evaluated directly on the pixel grid.
+
+    Returns None if no component is broad enough to gain from this.
+    '''
+    fac = multires_factors(mixture, tol)
+    if np.all(fac == 1):
+        return None
+    H,W = y1-y0, x1-x0
+    # Each level's grid extends P of its samples beyond the pixel
+    # grid on each side, so interpolation near the edges is accurate.
+    P = 2
+    acc = None
+    s = fac.max()
+    while True:
+        nx = int(np.ceil((W-1) / float(s))) + 1 + 2*P
+        ny = int(np.ceil((H-1) / float(s))) + 1 + 2*P
+        if acc is not None:
+            # the level-2s grid point j is this level's point 2j-P
+            acc = _upsample2(acc)[P:P+ny, P:P+nx]
+        if s == 1:
+            break
+        I = np.flatnonzero(fac == s)
+        if len(I):
+            # Render in coordinates scaled down by s, with the origin
+            # at the level's first sample; scaling the amplitudes by
+            # 1/s^2 keeps the values those of the pixel-space density.
+            origin = np.array([x0, y0]) - P * s
+            sub = MixtureOfGaussians(mixture.amp[I] / float(s**2),
+                                     (mixture.mean[I] - origin) / float(s),
+                                     mixture.var[I] / float(s**2))
+            p = mixture_to_patch(sub, 0, nx, 0, ny, minval, exactExtent=True)
+            if p is not None:
+                acc = p.patch if acc is None else acc + p.patch
+        s /= 2
+
+    if acc is None:
+        result = np.zeros((H,W))
+    else:
+        result = acc[P:P+H, P:P+W].copy()
+        if minval:
+            result[np.abs(result) < minval] = 0.
+    I = np.flatnonzero(fac == 1)
+    if len(I):
+        sub = MixtureOfGaussians(mixture.amp[I], mixture.mean[I],
+                                 mixture.var[I])
+        p = mixture_to_patch(sub, x0, x1, y0, y1, minval, exactExtent=True)
+        if p is not None:
+            result += p.patch
+
+    if minval and not exactExtent:
+        # trim to the non-zero bounding box, like evaluate_grid_approx3
+        nz = (result != 0)
+        if not np.any(nz):
+            return None
+        ys = np.flatnonzero(np.any(nz, axis=1))
+        xs = np.flatnonzero(np.any(nz, axis=0))
+        result = result[ys[0]:ys[-1]+1, xs[0]:xs[-1]+1]
+        x0 += xs[0]
+        y0 += ys[0]
+    return Patch(x0, y0, result)
+
+def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False,
+                     multires=None):
     '''
     `mixture`: a MixtureOfGaussians
     `x0,x1,y0,y1`: integer bounds [x0,x1), [y0,y1) of the grid to evaluate
+    `multires`: if not None, a tolerance: components broad enough
+    that cubic-spline interpolation from a coarser grid is accurate
+    to this fraction of their peak are rendered that way; see
+    multires_factors().
 
     Returns: a Patch object
     '''
+    if multires is not None:
+        p = _mixture_to_patch_multires(mixture, x0, x1, y0, y1, minval,
+                                       exactExtent, multires)
+        if p is not None:
+            return p
+
     if minval == 0. or minval is None:
         return mixture.evaluate_grid(x0, x1, y0, y1, 0., 0.)
 
@@ -572,7 +775,7 @@ if __name__ == '__main__':
         result3 = np.zeros((H, W))
         xderiv, yderiv, mask = None, None, None
         xc,yc = int(mean[0,0] + dx), int(mean[0,1] + dy)
-        args = (x0, x1, y0, y1, dx, dy, minval, amp, mean, var, result3, xderiv, yderiv, mask, xc, yc, minradius)
+        args = (x0, x1, y0, y1, dx, dy, minval, amp, mean, var, result3, xderiv, yderiv, mask, None, None, None, xc, yc, minradius)
         print 'args (approx3):', args
         rtn = c_gauss_2d_approx3(*args)
         if rtn == -1:
@@ -5,7 +5,8 @@ from cache import Cache
 
 class CacheManager(BaseManager):
 	pass
-CacheManager.register('Cache', Cache, exposed=('get','put','printStats'))
+CacheManager.register('Cache', Cache, exposed=('get','put','printStats',
+											   'getStats'))
 
 def createManager():
 	manager = CacheManager()
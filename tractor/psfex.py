@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 from .basics import *
@@ -9,6 +10,59 @@ from . import ducks
 
 from astrometry.util.fits import *
 
+# Process pool (with a map() method, eg astrometry.util.multiproc) for
+# the PSF spline grid fits, and directory in which PsfEx fits are
+# saved; see set_psfex_fit_options().
+_fitmp = None
+_fitcachedir = None
+
+def set_psfex_fit_options(mp=None, cachedir=None):
+    '''
+    Sets the process pool *mp* across which the rows of
+    VaryingGaussianPSF spline grid fits are spread (None: fit
+    serially), and the directory *cachedir* in which PsfEx fits are
+    saved, keyed by the PsfEx file contents and fit settings, and
+    re-used (None: no saving).
+    '''
+    global _fitmp, _fitcachedir
+    _fitmp = mp
+    _fitcachedir = cachedir
+
+def _fit_psf_row(args):
+    '''
+    Fits the PSF mixture at the grid points *XX* of row *y*, starting
+    each fit from the previous one (the first from *p0*).  Returns the
+    list of parameter vectors, and the fit parameters at the first
+    point.
+    '''
+    (psf, y, XX, p0, fitfunc, kwargs) = args
+    if (fitfunc is None and psf.psfclass is GaussianMixturePSF and
+        set(kwargs).issubset(['alpha', 'emsteps', 'xy0'])):
+        # Fit the whole row in one call to the EM code.
+        ims = [psf.instantiateAt(x, y) for x in XX]
+        fits,iters,conv = GaussianMixturePSF.fromStamps(
+            ims, N=psf.K, P0=p0, warmstart=True, **kwargs)
+        pfirst = [a.copy() for a in fits[0].get_wmuvar()]
+        return [np.array(fit.getAllParams()) for fit in fits], pfirst
+    if fitfunc is None:
+        fitfunc = psf.psfclass.fromStamp
+    pprow = []
+    pfirst = None
+    for x in XX:
+        im = psf.instantiateAt(x, y)
+        fit = fitfunc(im, N=psf.K, P0=p0, **kwargs)
+        # GaussianMixturePSF.fromStamp() takes P0 = (w,mu,var), and
+        # fits in place; GaussianMixtureEllipsePSF.fromStamp() takes
+        # the parameter list.
+        if isinstance(fit, GaussianMixtureEllipsePSF):
+            p0 = fit.getAllParams()
+        else:
+            p0 = [a.copy() for a in fit.get_wmuvar()]
+        if pfirst is None:
+            pfirst = p0
+        pprow.append(np.array(fit.getAllParams()))
+    return pprow, pfirst
+
 class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
     '''
     A mixture-of-Gaussians (MoG) PSF with spatial variation,
@@ -16,6 +70,9 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
 
     This is a base class -- subclassers must implement "instantiateAt"
     '''
+    # (replaced, never modified in place, so a shared default is safe)
+    prefetched = {}
+
     def __init__(self, W, H, nx=11, ny=11, K=3, psfClass=GaussianMixturePSF):
         '''
         W,H: image size (for the image where this PSF lives)
@@ -32,6 +89,8 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
         self.nx = nx
         self.ny = ny
         self.savesplinedata = False
+        # PSF parameters at the positions given to prefetchPsfParams()
+        self.prefetched = {}
 
     def __str__(self):
         try:
@@ -57,6 +116,7 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
             spl = scipy.interpolate.RectBivariateSpline(XX, YY, data.T)
             splines.append(spl)
         self.splines = splines
+        self.prefetched = {}
 
     def ensureFit(self):
         '''
@@ -83,8 +143,22 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
     def psfParamsAt(self, x, y):
         '''
         Return PSF model parameters at the given pixel position x,y.
+
+        If *x*,*y* are arrays, returns an array of shape (N, number of
+        parameters) for the N positions, evaluating each spline at all
+        of them in one call.
         '''
         self.ensureFit()
+        if np.ndim(x) or np.ndim(y):
+            x,y = np.broadcast_arrays(np.atleast_1d(x).astype(float),
+                                      np.atleast_1d(y).astype(float))
+            vals = np.zeros((len(x), len(self.splines)))
+            for i,spl in enumerate(self.splines):
+                vals[:,i] = spl.ev(x, y)
+            return vals
+        vals = self.prefetched.get((float(x), float(y)))
+        if vals is not None:
+            return vals.copy()
         vals = np.zeros(len(self.splines))
         import scipy
         if scipy.__version__ >= '0.14.0':
@@ -95,6 +169,17 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
             vals[i] = spl(x, y, **kwa)
         return vals
 
+    def prefetchPsfParams(self, xs, ys):
+        '''
+        Evaluates the PSF parameters at all the pixel positions *xs*,
+        *ys* at once (eg, those of all the sources in an image), so
+        that subsequent psfAt() calls at exactly those positions just
+        look them up.  Replaces the previously prefetched positions.
+        '''
+        vals = self.psfParamsAt(xs, ys)
+        self.prefetched = dict(zip([(float(x), float(y))
+                                    for x,y in zip(xs, ys)], vals))
+
     def getMixtureOfGaussians(self, px=None, py=None):
         if px is None:
             px = 0.
@@ -103,42 +188,45 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
         psf = self.psfAt(px, py)
         return psf.getMixtureOfGaussians()
 
-    def _fitParamGrid(self, fitfunc=None, **kwargs):
-        # all MoG fit parameters (we need to make them shaped (ny,nx)
-        # for spline fitting)
-        pp = []
+    def _fitParamGrid(self, fitfunc=None, mp=None, **kwargs):
+        pp,XX,YY = self._fitParamGridData(fitfunc=fitfunc, mp=mp, **kwargs)
+        self.fitSavedData(pp, XX, YY)
+        if self.savesplinedata:
+            self.splinedata = (pp, XX, YY)
+
+    def _fitParamGridData(self, fitfunc=None, mp=None, **kwargs):
+        '''
+        Fits the PSF mixture at the ny x nx grid points; returns
+        (pp, XX, YY), the parameters, shape (ny,nx,number of
+        parameters), and the x and y grid coordinates.
+
+        With a process pool *mp* (default: that set by
+        set_psfex_fit_options()), the rows are fit in parallel, each
+        starting from scratch; otherwise each row starts from the fit
+        at the start of the previous row.
+        '''
         # x,y coords at which we will evaluate the PSF.
         YY = np.linspace(0, self.H, self.ny)
         XX = np.linspace(0, self.W, self.nx)
+        if mp is None:
+            mp = _fitmp
+        if mp is not None:
+            R = mp.map(_fit_psf_row, [(self, y, XX, None, fitfunc, kwargs)
+                                      for y in YY])
+            return np.array([pprow for pprow,nil in R]), XX, YY
+
+        # all MoG fit parameters (we need to make them shaped (ny,nx)
+        # for spline fitting)
+        pp = []
         # fit params at start of this row
         px0 = None
         for y in YY:
-            pprow = []
             # We start each row with the MoG fit parameters of the
             # start of the previous row (to try to make the fit
             # more continuous)
-            p0 = px0
-            for ix,x in enumerate(XX):
-                im = self.instantiateAt(x, y)
-
-                if fitfunc is not None:
-                    f = fitfunc
-                else:
-                    f = self.psfclass.fromStamp
-                psf = f(im, N=self.K, P0=p0, **kwargs)
-                
-                p0 = psf.getParams()
-                if ix == 0:
-                    px0 = p0
-
-                params = np.array(psf.getAllParams())
-                pprow.append(params)
+            pprow,px0 = _fit_psf_row((self, y, XX, px0, fitfunc, kwargs))
             pp.append(pprow)
-        pp = np.array(pp)
-
-        self.fitSavedData(pp, XX, YY)
-        if self.savesplinedata:
-            self.splinedata = (pp, XX, YY)
+        return np.array(pp), XX, YY
 
 class PsfEx(VaryingGaussianPSF):
     def __init__(self, fn, W, H, ext=1,
@@ -189,8 +277,53 @@ class PsfEx(VaryingGaussianPSF):
             self.x0,self.y0 = x0,y0
 
         self.scale = scale
+        self.fn = fn
+        self.ext = ext
         super(PsfEx, self).__init__(W, H, nx, ny, K, psfClass=psfClass)
 
+    def _fitParamGridData(self, fitfunc=None, mp=None, **kwargs):
+        # Re-use a saved fit, if any; see set_psfex_fit_options().
+        cachefn = self._getFitCacheFilename(fitfunc, kwargs)
+        if cachefn is not None and os.path.exists(cachefn):
+            X = np.load(cachefn)
+            return X['pp'], X['XX'], X['YY']
+        pp,XX,YY = super(PsfEx, self)._fitParamGridData(
+            fitfunc=fitfunc, mp=mp, **kwargs)
+        if cachefn is not None:
+            try:
+                os.makedirs(_fitcachedir)
+            except OSError:
+                pass
+            # write-and-rename so that concurrent readers never see a
+            # partial file
+            tmpfn = '%s.tmp-%i' % (cachefn, os.getpid())
+            f = open(tmpfn, 'wb')
+            np.savez(f, pp=pp, XX=XX, YY=YY)
+            f.close()
+            os.rename(tmpfn, cachefn)
+        return pp,XX,YY
+
+    def _getFitCacheFilename(self, fitfunc, kwargs):
+        '''
+        Returns the file in which the spline grid fit for this PsfEx
+        file and these fit settings is saved, or None if fits are not
+        being saved.
+        '''
+        fn = getattr(self, 'fn', None)
+        if _fitcachedir is None or fn is None:
+            return None
+        import hashlib
+        h = hashlib.sha1()
+        f = open(fn, 'rb')
+        h.update(f.read())
+        f.close()
+        settings = (getattr(self, 'ext', 1), self.W, self.H, self.nx, self.ny,
+                    self.K, self.scale, typestring(self.psfclass),
+                    getattr(fitfunc, '__name__', fitfunc),
+                    sorted(kwargs.items()))
+        h.update(repr(settings))
+        return os.path.join(_fitcachedir, 'psfex-fit-%s.npz' % h.hexdigest())
+
     # def scaledMogParamsAt(self, x, y):
     #     w,mu,var = self.mogParamsAt(x, y)
     #     if not self.scale:
@@ -375,15 +508,21 @@ class CachingPsfEx(PsfEx):
                          scale=psfex.scale, K=psfex.K,
                          psfClass=psfex.psfclass, **kwargs)
         for k in ['sampling', 'xscale', 'yscale', 'x0','y0','degree','radius',
-                  'psfbases', 'splinedata', 'splines']:
+                  'psfbases', 'splinedata', 'splines', 'fn', 'ext']:
             setattr(c, k, getattr(psfex, k, None))
         return c
 
     def __init__(self, *args, **kwargs):
+        '''
+        rounding: PSFs are computed at the center of the *rounding*
+        x *rounding* pixel cell containing the requested position,
+        and cached; with rounding=0, at the exact position.
+        '''
         from tractor.cache import Cache
         rounding = kwargs.pop('rounding', 100)
         super(CachingPsfEx, self).__init__(*args, **kwargs)
-        self.cache = Cache(maxsize=100)
+        self.cache = Cache(maxsize=None, maxbytes=1024*1024,
+                           name='CachingPsfEx')
         # round pixel coordinates to the nearest...
         self.rounding = rounding
 
@@ -396,7 +535,14 @@ class CachingPsfEx(PsfEx):
         self.cache.clear()
         return self.__dict__
 
+    def prefetchPsfParams(self, xs, ys):
+        # With rounding, PSFs are instead cached per cell in psfAt().
+        if not self.rounding:
+            super(CachingPsfEx, self).prefetchPsfParams(xs, ys)
+
     def psfAt(self, x, y):
+        if not self.rounding:
+            return super(CachingPsfEx, self).psfAt(x, y)
         # Center of rounding cell:
         cx = int(x / self.rounding) * self.rounding + self.rounding/2
         cy = int(y / self.rounding) * self.rounding + self.rounding/2
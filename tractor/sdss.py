@@ -1225,6 +1225,8 @@ class SdssWcs(ParamList):
               'dcol0', 'dcol1', 'dcol2', 'dcol3',
               'csrow', 'cscol', 'ccrow', 'cccol',
               'x0', 'y0']
+    # (_setThing is overridden)
+    _versionedHashkey = False
 
     @staticmethod
     def getNamedParams():
@@ -1288,6 +1290,7 @@ class SdssWcs(ParamList):
     def setX0Y0(self, x0, y0):
         self.x0 = x0
         self.y0 = y0
+        self._bumpVersion()
 
     # This function is not used by the tractor, and it works in
     # *original* pixel coords (no x0,y0 offsets)
@@ -1,6 +1,24 @@
 import numpy as np
 import scipy.interpolate as interp
 from utils import *
+from patch import Patch
+
+def _splineBasis(t, k, n):
+	'''
+	Evaluates each of the B-spline basis functions of degree *k* on
+	knots *t* at pixels 0..n-1.  Returns an array of shape (number of
+	coefficients, n).  Pixels outside the knot range are clamped to
+	it, as RectBivariateSpline does.
+	'''
+	x = np.clip(np.arange(n), t[k], t[-k-1])
+	nc = len(t) - k - 1
+	c = np.zeros(nc)
+	B = np.zeros((nc, n))
+	for j in range(nc):
+		c[j] = 1.
+		B[j,:] = interp.splev(x, (t, c, k))
+		c[j] = 0.
+	return B
 
 class SplineSky(ParamList):
 	def __init__(self, X, Y, bg, order=3):
@@ -33,6 +51,77 @@ class SplineSky(ParamList):
 
 		self.prior_smooth_sigma = None
 
+	# The sky is linear in the spline coefficients: it is the sum
+	# over coefficients c_ij of c_ij * bx_i(x) * by_j(y), for 1-d
+	# basis functions bx,by.  These caches hold the basis functions
+	# (and derivative patches) for an image shape, and the evaluated
+	# sky for (shape, parameter version).
+	_basis = None
+	_skycache = None
+
+	def __getstate__(self):
+		d = self.__dict__.copy()
+		d.pop('_basis', None)
+		d.pop('_skycache', None)
+		return d
+
+	def _getBasis(self, H, W):
+		'''
+		Returns (bx, by, derivs) for an H x W image: the 1-d basis
+		functions, of shape (NX, W) and (NY, H) where NX,NY are the
+		numbers of coefficients in x,y, and a list of Patches (or
+		None, where it misses the image) holding the derivative of
+		the sky with respect to each coefficient.
+		'''
+		if self._basis is not None and self._basis[0] == (H,W):
+			return self._basis[1]
+		tx,ty = self.spl.get_knots()
+		kx,ky = self.spl.degrees
+		bx = _splineBasis(tx, kx, W)
+		by = _splineBasis(ty, ky, H)
+		NX,NY = len(bx), len(by)
+		# "c" is stored x-major: c[ix * NY + iy]
+		assert(NX * NY == len(self.vals))
+
+		xr = []
+		for b in bx:
+			I = np.flatnonzero(b)
+			xr.append((I[0], I[-1]+1) if len(I) else None)
+		yr = []
+		for b in by:
+			I = np.flatnonzero(b)
+			yr.append((I[0], I[-1]+1) if len(I) else None)
+		derivs = []
+		for ix in range(NX):
+			for iy in range(NY):
+				if xr[ix] is None or yr[iy] is None:
+					derivs.append(None)
+					continue
+				x0,x1 = xr[ix]
+				y0,y1 = yr[iy]
+				d = np.outer(by[iy, y0:y1], bx[ix, x0:x1])
+				# (shared between calls)
+				d.flags.writeable = False
+				derivs.append(Patch(x0, y0, d))
+		basis = (bx, by, derivs)
+		self._basis = ((H,W), basis)
+		return basis
+
+	def getSkyImage(self, H, W):
+		'''
+		Returns the H x W sky image; it is cached until the spline
+		coefficients change, so must not be modified.
+		'''
+		key = (H, W, self.getVersion())
+		if self._skycache is not None and self._skycache[0] == key:
+			return self._skycache[1]
+		bx,by,nil = self._getBasis(H, W)
+		C = np.asarray(self.vals).reshape(len(bx), len(by))
+		S = np.dot(by.T, np.dot(C.T, bx))
+		S.flags.writeable = False
+		self._skycache = (key, S)
+		return S
+
 	def setPriorSmoothness(self, sigma):
 		'''
 		The smoothness sigma is proportional to sky-intensity units;
@@ -42,15 +131,11 @@ class SplineSky(ParamList):
 
 	def addTo(self, mod, scale=1.):
 		H,W = mod.shape
-		X = np.arange(W)
-		Y = np.arange(H)
-		#print 'Y', Y.shape, 'Y.T', Y.T.shape
-		#print 'X shape', X.shape, 'Y shape', Y.shape
-		#S = self.spl(X, Y.T)
-		S = self.spl(X, Y).T
-		#print 'mod', mod.shape
-		#print 'S', S.shape
-		mod += (S * scale)
+		S = self.getSkyImage(H, W)
+		if scale == 1.:
+			mod += S
+		else:
+			mod += (S * scale)
 
 	def getParamGrid(self):
 		arr = np.array(self.vals)
@@ -148,20 +233,22 @@ class SplineSky(ParamList):
 
 		return (rA, cA, vA, pb)
 
-	def getParamDerivatives(self, *args):
-		derivs = []
-		tx,ty = self.spl.get_knots()
-		print 'Knots:'
-		print 'x', len(tx), tx
-		print 'y', len(ty), ty
-		print 'W,H', self.W, self.H
-		#NX = len(tx) - self.order
-		#print 'NX', NX
+	def getParamDerivatives(self, tractor, img, srcs):
+		'''
+		The sky is linear in the coefficients, so the derivatives are
+		just the (cached, read-only) basis-function patches.  Each
+		call returns new Patch objects around them, since callers may
+		clip the Patches in place.
+		'''
+		H,W = img.shape
+		bx,by,derivs = self._getBasis(H, W)
+		rtn = []
 		for i in self.getThawedParamIndices():
-			ix = i % self.W
-			iy = i / self.W
-			derivs.append(False)
-		return derivs
+			d = derivs[i]
+			if d is not None:
+				d = Patch(d.x0, d.y0, d.patch)
+			rtn.append(d)
+		return rtn
 
 		
 if __name__ == '__main__':
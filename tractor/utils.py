@@ -40,6 +40,12 @@ def listmax(X, default=0):
     return np.max(mx)
     
 
+def _paramsDiffer(old, new):
+    for a,b in zip(old, new):
+        if a != b:
+            return True
+    return False
+
 def getClassName(obj):
     name = getattr(obj.__class__, 'classname', None)
     if name is not None:
@@ -161,7 +167,31 @@ class BaseParams(object):
     def copy(self):
         return self.__class__(*self.getAllParams())
     def hashkey(self):
-        return (getClassName(self),) + tuple(self.getAllParams())
+        return self._memoHashkey(
+            lambda: (getClassName(self),) + tuple(self.getAllParams()))
+    # Set (by classes) to True if every change to the values behind
+    # the hashkey goes through setters that call _bumpVersion(), so
+    # that the hashkey can be memoized on getVersion().  Subclasses
+    # that keep state elsewhere, or override the setters, must reset
+    # it to False.
+    _versionedHashkey = False
+    def _memoHashkey(self, compute):
+        '''
+        Returns the hashkey computed by *compute()*.  If this class has
+        _versionedHashkey set, it is memoized on getVersion(), so that
+        it is only rebuilt when the parameter values change.
+        '''
+        if not self._versionedHashkey:
+            return compute()
+        v = self.getVersion()
+        memo = self._hashkeyMemo
+        if memo is not None and memo[0] == v:
+            return memo[1]
+        hk = compute()
+        self._hashkeyMemo = (v, hk)
+        return hk
+    # (version, hashkey) memo; see _memoHashkey().
+    _hashkeyMemo = None
     def __hash__(self):
         return hash(self.hashkey())
     def __eq__(self, other):
@@ -234,6 +264,39 @@ class BaseParams(object):
     def getLogPriorDerivatives(self):
         return None
 
+    # Parameter-value version counter; see getVersion().
+    _version = 0
+
+    def getVersion(self):
+        '''
+        Returns a version stamp for the current parameter values: it
+        changes whenever the values are changed through the
+        Params interface (setParams(), setParam(), setAllParams(),
+        named-parameter setters), so that things derived from the
+        parameters (eg, model patches) can tell cheaply whether they
+        are stale.  Only equality of version stamps is meaningful.
+        '''
+        return self._version
+
+    def _bumpVersion(self):
+        self._version += 1
+
+    # Validity flags of the compiled ParamLayouts that include this
+    # object; see ParamLayout.
+    _layoutFlags = ()
+
+    def invalidateParamLayouts(self):
+        '''
+        Marks the compiled ParamLayouts that include this object as
+        stale.  This happens automatically when it is frozen or thawed
+        via the NamedParams methods, or when sub-Params are added,
+        removed or replaced via the MultiParams methods.  Call it after
+        changing a "liquid" list directly.
+        '''
+        for flag in self._layoutFlags:
+            flag[0] = False
+        self._layoutFlags = ()
+
 @total_ordering
 class ScalarParam(BaseParams):
     '''
@@ -242,6 +305,7 @@ class ScalarParam(BaseParams):
     '''
     stepsize = 1.
     strformat = '%g'
+    _versionedHashkey = True
     def __init__(self, val=0):
         self.val = val
     def __str__(self):
@@ -277,6 +341,7 @@ class ScalarParam(BaseParams):
         return oldval
     def _set(self, val):
         self.val = val
+        self._bumpVersion()
     def getValue(self):
         return self.val
     def setValue(self, v):
@@ -408,6 +473,7 @@ class NamedParams(object):
     def _getNamedThing(self, nm):
         return self._getThing(self.namedparams[nm])
     def _setNamedThing(self, nm, v):
+        self._bumpVersion()
         return self._setThing(self.namedparams[nm], v)
 
 
@@ -436,6 +502,7 @@ class NamedParams(object):
         return n
 
     def freezeParamsRecursive(self, *pnames):
+        self.invalidateParamLayouts()
         for nm in pnames:
             i = self.getNamedParamIndex(nm)
             if i is None:
@@ -445,6 +512,7 @@ class NamedParams(object):
             self.freezeAllParams()
 
     def thawParamsRecursive(self, *pnames):
+        self.invalidateParamLayouts()
         for nm in pnames:
             i = self.getNamedParamIndex(nm)
             if i is None:
@@ -463,6 +531,7 @@ class NamedParams(object):
             i = self.getNamedParamIndex(paramname)
             assert(i is not None)
         self.liquid[i] = False
+        self.invalidateParamLayouts()
     def freezeAllBut(self, *args):
         self.freezeAllParams()
         self.thawParams(*args)
@@ -478,6 +547,7 @@ class NamedParams(object):
                 continue
             self.liquid[i] = True
             thawed = True
+        self.invalidateParamLayouts()
         return thawed
 
     def thawParam(self, paramname):
@@ -491,17 +561,20 @@ class NamedParams(object):
             i = self._getThings().index(paramname)
             
         self.liquid[i] = True
+        self.invalidateParamLayouts()
     def thawParams(self, *args):
         for n in args:
             self.thawParam(n)
     def thawAllParams(self):
         self.liquid[:] = [True]*len(self.liquid)
+        self.invalidateParamLayouts()
     unfreezeParam = thawParam
     unfreezeParams = thawParams
     unfreezeAllParams = thawAllParams
     
     def freezeAllParams(self):
         self.liquid[:] = [False]*len(self.liquid)
+        self.invalidateParamLayouts()
     def getFrozenParams(self):
         return [self.getNamedParamName(i) for i in self.getFrozenParamIndices()]
     def getThawedParams(self):
@@ -594,6 +667,8 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     '''
     An implementation of Params that holds values in a list.
     '''
+    _versionedHashkey = True
+
     def __init__(self, *args):
         #print 'ParamList __init__()'
         # FIXME -- kwargs with named params?
@@ -635,6 +710,7 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     # the active/inactive state.
     def _setThing(self, i, val):
         self.vals[i] = val
+        self._bumpVersion()
     def _getThing(self, i):
         return self.vals[i]
     def _getThings(self):
@@ -647,10 +723,12 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
         ii = self._indexLiquid(i)
         oldval = self._getThing(ii)
         self._setThing(ii, val)
+        self._bumpVersion()
         return oldval
     def setParams(self, p):
         for i,j in self._indexBoth():
             self._setThing(j, p[i])
+        self._bumpVersion()
     def numberOfParams(self):
         return self._countLiquid()
     def getParams(self):
@@ -665,6 +743,7 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     def setAllParams(self, p):
         for i,pp in enumerate(p):
             self._setThing(i, pp)
+        self._bumpVersion()
 
     def getParam(self,i):
         ii = self._indexLiquid(i)
@@ -799,16 +878,24 @@ class MultiParams(BaseParams, NamedParams):
     def append(self, x):
         self.subs.append(x)
         self.liquid.append(True)
+        self._bumpVersion()
+        self.invalidateParamLayouts()
     def prepend(self, x):
         self.subs = [x] + self.subs
         self.liquid = [True] + self.liquid
+        self._bumpVersion()
+        self.invalidateParamLayouts()
     def extend(self, x):
         self.subs.extend(x)
         self.liquid.extend([True] * len(x))
+        self._bumpVersion()
+        self.invalidateParamLayouts()
     def remove(self, x):
         i = self.subs.index(x)
         self.subs = self.subs[:i] + self.subs[i+1:]
         self.liquid = self.liquid[:i] + self.liquid[i+1:]
+        self._bumpVersion()
+        self.invalidateParamLayouts()
         #self.subs.remove(x)
     def index(self, x):
         return self.subs.index(x)
@@ -819,6 +906,8 @@ class MultiParams(BaseParams, NamedParams):
     def __getitem__(self, key):
         return self.subs.__getitem__(key)
     def __setitem__(self, key, val):
+        self._bumpVersion()
+        self.invalidateParamLayouts()
         return self.subs.__setitem__(key, val)
     def __iter__(self):
         return self.subs.__iter__()
@@ -847,6 +936,8 @@ class MultiParams(BaseParams, NamedParams):
     #   return MultiParams.MultiParamsIter(self)
 
     def hashkey(self):
+        # (not memoized: the sub-Params memoize their own hashkeys
+        # where that is safe)
         t = [getClassName(self)]
         for s in self.subs:
             if s is None:
@@ -855,6 +946,16 @@ class MultiParams(BaseParams, NamedParams):
                 t.append(s.hashkey())
         return tuple(t)
 
+    def getVersion(self):
+        '''
+        Returns a version stamp combining this object's own counter
+        (which changes when sub-Params are replaced, or when a
+        sub-Params that does not keep its own counter changes value
+        via this object's setters) with those of its sub-Params.
+        '''
+        return (self._version,) + tuple(
+            None if s is None else s.getVersion() for s in self.subs)
+
     def __str__(self):
         s = []
         for n,v in self._iterNamesAndVals():
@@ -868,6 +969,8 @@ class MultiParams(BaseParams, NamedParams):
     # the active/inactive state.
     def _setThing(self, i, val):
         self.subs[i] = val
+        self._bumpVersion()
+        self.invalidateParamLayouts()
     def _getThing(self, i):
         return self.subs[i]
     def _getThings(self):
@@ -967,23 +1070,34 @@ class MultiParams(BaseParams, NamedParams):
             
         return n
 
+    # Compiled layout of the thawed leaf Params; see ParamLayout.
+    _layout = None
+
+    def _getLayout(self):
+        layout = self._layout
+        if layout is None or not layout.isValid():
+            layout = self._layout = ParamLayout(self)
+        return layout
+
+    def __getstate__(self):
+        # (layouts and hashkeys are only valid within this process)
+        d = self.__dict__.copy()
+        d.pop('_layout', None)
+        d.pop('_layoutFlags', None)
+        d.pop('_hashkeyMemo', None)
+        return d
+
     def numberOfParams(self):
         '''
         Count unpinned (active) params.
         '''
-        return sum(s.numberOfParams() for s in self._getActiveSubs())
+        return self._getLayout().n
 
     def getParams(self):
         '''
         Returns a *copy* of the current active parameter values (as a flat list)
         '''
-        p = []
-        for s in self._getActiveSubs():
-            pp = s.getParams()
-            if pp is None:
-                continue
-            p.extend(pp)
-        return p
+        return self._getLayout().getParams()
 
     def getAllParams(self):
         p = []
@@ -998,22 +1112,25 @@ class MultiParams(BaseParams, NamedParams):
         i = 0
         for s in self.subs:
             n = s.numberOfParams()
-            s.setAllParams(p[i:i+n])
+            if isinstance(s, MultiParams):
+                s.setAllParams(p[i:i+n])
+            elif _paramsDiffer(s.getAllParams(), p[i:i+n]):
+                s.setAllParams(p[i:i+n])
+                self._bumpVersion()
             i += n
 
     def setParams(self, p):
-        i = 0
-        for s in self._getActiveSubs():
-            n = s.numberOfParams()
-            s.setParams(p[i:i+n])
-            i += n
+        self._getLayout().setParams(p)
 
     def setParam(self, i, p):
         off = 0
         for s in self._getActiveSubs():
             n = s.numberOfParams()
             if i < off+n:
-                return s.setParam(i-off, p)
+                old = s.setParam(i-off, p)
+                if not isinstance(s, MultiParams):
+                    self._bumpVersion()
+                return old
             off += n
         raise RuntimeError('setParam(%i,...) for a %s that only has %i elements' %
                            (i, getClassName(self), self.numberOfParams()))
@@ -1084,6 +1201,8 @@ class NpArrayParams(ParamList):
     '''
     An implementation of Params that holds values in an np.ndarray
     '''
+    _versionedHashkey = False
+
     def __init__(self, a):
         self.a = np.array(a)
         super(NpArrayParams, self).__init__()
@@ -1102,3 +1221,158 @@ class NpArrayParams(ParamList):
     def __getstate__(self): return self.__dict__
     def __setstate__(self, d): self.__dict__.update(d)
 
+    # Vectorized versions of the ParamList methods.
+    def _liquidIndices(self):
+        if all(self.liquid):
+            return slice(None)
+        return np.array([j for i,j in self._indexBoth()], int)
+    def getParams(self):
+        return list(self.a.flat[self._liquidIndices()])
+    def setParams(self, p):
+        self.a.flat[self._liquidIndices()] = p
+        self._bumpVersion()
+
+
+
+class ParamLayout(object):
+    '''
+    A "compiled" description of the thawed parameters of a MultiParams
+    tree: the thawed leaf Params in order, with their offsets in the
+    flat parameter vector and (for ScalarParam, ParamList and
+    NpArrayParams) the raw indices of their thawed values.  With this,
+    MultiParams.getParams() and setParams() are a single loop over
+    the leaves, reading and writing the leaves' storage directly
+    (one slice copy for an NpArrayParams), rather than a recursive
+    walk of the tree re-checking the freeze state at every level.
+
+    Leaf Params whose values do not change are not touched by
+    setParams(), so their version stamps stay valid.
+
+    A layout registers a validity flag with each MultiParams and
+    freezable leaf that it walked; freezing or thawing one of them, or
+    changing its sub-Params, clears the flag (see
+    BaseParams.invalidateParamLayouts()), so only the layouts that
+    include it are rebuilt.  The few other leaves (eg, PSFs, WCSes)
+    are checked for a change in their number of parameters.
+    MultiParams subclasses that override the getParams()/setParams()
+    machinery, and other Params classes, are treated as opaque leaves.
+    '''
+    def __init__(self, root):
+        self.valid = [True]
+        # (leaf, parent, i0, i1, kind, indices)
+        self.leaves = []
+        # (leaf, number of params) for opaque leaves
+        self.generic = []
+        self.n = 0
+        self._register(root)
+        self._compile(root)
+
+    def isValid(self):
+        if not self.valid[0]:
+            return False
+        for s,n in self.generic:
+            if s.numberOfParams() != n:
+                return False
+        return True
+
+    def _register(self, obj):
+        # (dropping the flags of stale layouts)
+        flags = [f for f in obj._layoutFlags if f[0]]
+        flags.append(self.valid)
+        obj._layoutFlags = flags
+
+    def _compile(self, node):
+        for s in node._getActiveSubs():
+            if (isinstance(s, MultiParams) and
+                not _overrides(s, MultiParams, _multiParamsMethods)):
+                self._register(s)
+                self._compile(s)
+                continue
+            n = s.numberOfParams()
+            kind,idx = _leafKind(s)
+            if kind in ['list', 'array']:
+                self._register(s)
+            elif kind == 'generic':
+                self._register(s)
+                self.generic.append((s, n))
+            if n == 0:
+                continue
+            self.leaves.append((s, node, self.n, self.n + n, kind, idx))
+            self.n += n
+
+    def getParams(self):
+        p = []
+        for (s, parent, i0, i1, kind, idx) in self.leaves:
+            if kind == 'scalar':
+                p.append(s.val)
+            elif kind == 'list':
+                vals = s.vals
+                p.extend([vals[j] for j in idx])
+            elif kind == 'array':
+                if idx is None:
+                    p.extend(s.a.ravel())
+                else:
+                    p.extend(s.a.flat[idx])
+            else:
+                pp = s.getParams()
+                if pp is not None:
+                    p.extend(pp)
+        return p
+
+    def setParams(self, p):
+        for (s, parent, i0, i1, kind, idx) in self.leaves:
+            if kind == 'scalar':
+                v = p[i0]
+                if s.val != v:
+                    s.val = v
+                    s._bumpVersion()
+            elif kind == 'list':
+                vals = s.vals
+                changed = False
+                for j,v in zip(idx, p[i0:i1]):
+                    if vals[j] != v:
+                        vals[j] = v
+                        changed = True
+                if changed:
+                    s._bumpVersion()
+            elif kind == 'array':
+                pp = np.asarray(p[i0:i1])
+                if idx is None:
+                    if not np.array_equal(s.a.ravel(), pp):
+                        s.a.flat[:] = pp
+                        s._bumpVersion()
+                elif not np.array_equal(s.a.flat[idx], pp):
+                    s.a.flat[idx] = pp
+                    s._bumpVersion()
+            else:
+                pp = p[i0:i1]
+                if _paramsDiffer(s.getParams(), pp):
+                    s.setParams(pp)
+                    # (the leaf may not keep a version counter)
+                    parent._bumpVersion()
+
+_multiParamsMethods = ['getParams', 'setParams', 'numberOfParams',
+                       '_getActiveSubs']
+_listMethods = ['getParams', 'setParams', 'numberOfParams',
+                '_getThing', '_setThing', '_getThings']
+
+def _overrides(obj, base, names):
+    for nm in names:
+        if getattr(type(obj), nm).__func__ is not getattr(base, nm).__func__:
+            return True
+    return False
+
+def _leafKind(s):
+    if isinstance(s, ScalarParam):
+        if not _overrides(s, ScalarParam,
+                          ['getParams', 'setParams', 'numberOfParams', '_set']):
+            return 'scalar', None
+    elif isinstance(s, NpArrayParams):
+        if not _overrides(s, NpArrayParams, _listMethods):
+            if all(s.liquid):
+                return 'array', None
+            return 'array', np.array([j for i,j in s._indexBoth()], int)
+    elif isinstance(s, ParamList):
+        if not _overrides(s, ParamList, _listMethods):
+            return 'list', [j for i,j in s._indexBoth()]
+    return 'generic', None